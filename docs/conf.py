@@ -66,6 +66,9 @@ MOCK_MODULES = [
     "matplotlib_scalebar.scalebar",
     "numpy.core.multiarray",
     "matplotlib.offsetbox",
+    "scipy.sparse",
+    "scipy.fft",
+    "scipy.spatial",
 ]
 
 for mod_name in MOCK_MODULES:
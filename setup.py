@@ -22,8 +22,8 @@ if not os.getenv("READTHEDOCS"):
         install_requires=[
             "pyfftw >= 0.10.3",
             "pywavelets >= 0.5.2",
-            "numpy >= 1.13.0",
-            "scipy >= 1.0.0",
+            "numpy >= 1.20.0",
+            "scipy >= 1.4.0",
             "matplotlib >= 2.2.0",
             "pillow > 5.0.0",
             "numba >= 0.45.0",
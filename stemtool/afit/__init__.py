@@ -1,2 +1,6 @@
+from .atom_index import *
 from .atom_positions import *
+from .joint_fit import *
+from .atom_tracking import *
 from .drift_corr import *
+from .nonrigid_drift import *
@@ -0,0 +1,236 @@
+import numpy as np
+import scipy.spatial as scsp
+
+
+class atom_index(object):
+    """
+    Spatial index of atom column positions
+
+    Parameters
+    ----------
+    positions: ndarray
+               Atom positions, of shape (N, 2) or larger, where
+               only the first two columns as y, x are used
+
+    Notes
+    -----
+    The positions are stored once in a KD-tree, so every query
+    only visits the atoms close to the point of interest instead
+    of calculating the distances to all the atoms. Building the
+    tree is O(N log N), and a single query is O(log N), so that
+    nearest neighbor distances, radius searches, duplicate removal
+    and lattice vector lookups for all the atoms in the image are
+    all O(N log N) instead of O(N^2).
+
+    Examples
+    --------
+    >>> index = st.afit.atom_index(peaks)
+    >>> med_dist = index.median_distance()
+    >>> unique_peaks = peaks[index.unique(limit=0.5 * med_dist), :]
+
+    See Also
+    --------
+    remove_close_vals
+    med_dist_numba
+    three_neighbors
+    """
+
+    def __init__(self, positions):
+        self.positions = np.asarray(np.asarray(positions)[:, 0:2], dtype=np.float64)
+        self.no_atoms = len(self.positions)
+        self.tree = scsp.cKDTree(self.positions)
+
+    def nearest_distance(self, no_check=4):
+        """
+        Distance of every atom to its nearest neighbor
+
+        Parameters
+        ----------
+        no_check: int, optional
+                  Number of neighbors checked for every atom.
+                  Default is 4
+
+        Returns
+        -------
+        dist: ndarray
+              Distance from every atom to the closest other atom
+
+        Notes
+        -----
+        Atoms sitting exactly on top of each other are not counted
+        as neighbors, so duplicated positions don't give zero
+        distances. If all the `no_check` closest atoms of an atom
+        are duplicates, the distance is NaN.
+        """
+        no_check = int(min(no_check, self.no_atoms))
+        dist, _ = self.tree.query(self.positions, k=no_check)
+        dist = np.reshape(dist, (self.no_atoms, -1))
+        dist[dist == 0] = np.inf
+        dist = np.amin(dist, axis=1)
+        dist[np.isinf(dist)] = np.nan
+        return dist
+
+    def median_distance(self):
+        """
+        Median of the nearest neighbor distances of all atoms
+        """
+        return np.nanmedian(self.nearest_distance())
+
+    def within(self, points, radius):
+        """
+        Find the atoms within a distance of given points
+
+        Parameters
+        ----------
+        points: ndarray
+                Positions as y, x of shape (M, 2), or a single
+                position
+        radius: float
+                Search radius in pixels
+
+        Returns
+        -------
+        neighbors: list
+                   For every point, a list of the indices of the
+                   atoms at most `radius` away from it. If a single
+                   position was given, this is a single list.
+        """
+        return self.tree.query_ball_point(np.asarray(points, dtype=np.float64), radius)
+
+    def pixels_within(self, imshape, radius):
+        """
+        Find the image pixels within a distance of every atom
+
+        Parameters
+        ----------
+        imshape: tuple
+                 Shape of the image as (Y, X)
+        radius:  float
+                 Search radius in pixels
+
+        Returns
+        -------
+        pixels: ndarray
+                Flattened image index of every pixel and atom pair
+        atoms:  ndarray
+                Index of the atom of every pair
+
+        Notes
+        -----
+        The pixels already sit on a regular grid, which is its own
+        spatial index, so every atom lists the pixels of the disk
+        around it directly instead of querying the tree once for
+        every pixel. A pixel close to several atoms shows up once
+        for each of them, and pixels outside the image are dropped.
+        """
+        reach = int(np.ceil(radius))
+        yy, xx = np.mgrid[-reach : (reach + 1), -reach : (reach + 1)]
+        base = np.round(self.positions).astype(np.int64)
+        yy = base[:, 0:1] + np.ravel(yy)[None, :]
+        xx = base[:, 1:2] + np.ravel(xx)[None, :]
+        dist2 = ((yy - self.positions[:, 0:1]) ** 2) + (
+            (xx - self.positions[:, 1:2]) ** 2
+        )
+        inside = np.logical_and(dist2 <= (radius ** 2), yy >= 0)
+        inside = np.logical_and(inside, yy < imshape[0])
+        inside = np.logical_and(inside, xx >= 0)
+        inside = np.logical_and(inside, xx < imshape[1])
+        atoms = np.broadcast_to(np.arange(self.no_atoms)[:, None], inside.shape)
+        pixels = (yy[inside] * int(imshape[1])) + xx[inside]
+        return pixels, atoms[inside]
+
+    def nearest_other(self, points, owners):
+        """
+        Distance of every point to the closest atom other
+        than its own atom
+
+        Parameters
+        ----------
+        points: ndarray
+                Positions as y, x of shape (M, 2)
+        owners: ndarray
+                Index of the atom every point belongs to
+
+        Returns
+        -------
+        dist: ndarray
+              Distance from every point to the closest atom
+              that is not its owner
+
+        Notes
+        -----
+        Comparing this to the distance of the point to its own
+        atom gives the Voronoi cell membership of the point.
+        """
+        dist, index = self.tree.query(
+            np.asarray(points, dtype=np.float64), k=min(2, self.no_atoms)
+        )
+        dist = np.reshape(dist, (len(points), -1))
+        index = np.reshape(index, (len(points), -1))
+        own_first = index[:, 0] == np.asarray(owners)
+        if dist.shape[1] == 1:
+            return np.where(own_first, np.inf, dist[:, 0])
+        return np.where(own_first, dist[:, 1], dist[:, 0])
+
+    def unique(self, limit):
+        """
+        Suppress atoms that duplicate an earlier atom
+
+        Parameters
+        ----------
+        limit: float
+               Atoms closer than or at this distance are
+               considered duplicates
+
+        Returns
+        -------
+        keep: ndarray
+              Boolean array, which is True for the atoms kept
+
+        Notes
+        -----
+        The atoms are visited in their original order, and every
+        atom that has not been removed yet removes all the later
+        atoms within `limit` of it. Only the pairs of atoms closer
+        than `limit` are ever looked at, which are found from the
+        tree in a single pass.
+        """
+        keep = np.ones(self.no_atoms, dtype=bool)
+        pairs = self.tree.query_pairs(limit, output_type="ndarray")
+        if len(pairs) == 0:
+            return keep
+        pairs = np.sort(pairs, axis=1)
+        pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0])), :]
+        firsts, starts = np.unique(pairs[:, 0], return_index=True)
+        stops = np.append(starts[1:], len(pairs))
+        for ii in range(len(firsts)):
+            if keep[firsts[ii]]:
+                keep[pairs[starts[ii] : stops[ii], 1]] = False
+        return keep
+
+    def lattice_neighbors(self, vectors):
+        """
+        Find the atoms closest to every atom shifted by
+        lattice vectors
+
+        Parameters
+        ----------
+        vectors: ndarray
+                 Lattice vectors as y, x of shape (M, 2)
+
+        Returns
+        -------
+        neighbors: ndarray
+                   Shape is (N, M), the index of the atom closest
+                   to every atom shifted by every lattice vector
+        distances: ndarray
+                   Shape is (N, M), the distance of every atom to
+                   its neighbor along every lattice vector
+        """
+        vectors = np.reshape(np.asarray(vectors, dtype=np.float64), (-1, 2))
+        shifted = self.positions[:, None, :] + vectors[None, :, :]
+        _, neighbors = self.tree.query(shifted, k=1)
+        distances = np.linalg.norm(
+            self.positions[neighbors, :] - self.positions[:, None, :], axis=-1
+        )
+        return neighbors, distances
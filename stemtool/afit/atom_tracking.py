@@ -0,0 +1,269 @@
+import numpy as np
+import stemtool as st
+
+
+def column_patches(image_data, params, mask_radius):
+    """
+    Pixels around the predicted position of every atom column
+
+    Parameters
+    ----------
+    image_data:  ndarray
+                 The image
+    params:      ndarray
+                 Shape is (N, 6), the Gaussian parameters of every
+                 column in the order of `util.fit_gaussian2D_mask`
+    mask_radius: float
+                 Radius of the circular mask around every column
+
+    Returns
+    -------
+    xx:   ndarray
+          X positions of the window pixels, of shape (N, P)
+    yy:   ndarray
+          Y positions of the window pixels, of shape (N, P)
+    zz:   ndarray
+          Image values of the window pixels, of shape (N, P)
+    mask: ndarray
+          Boolean array, which is True for the finite pixels
+          within `mask_radius` of the column
+
+    See Also
+    --------
+    atom_windows
+    """
+    half_size = int(np.ceil(mask_radius)) + 1
+    positions = np.flip(params[:, 0:2], axis=1)
+    windows, centers, origins = st.afit.atom_windows(image_data, positions, half_size)
+    win_size = (2 * half_size) + 1
+    zz = np.reshape(windows[centers[:, 0], centers[:, 1]], (len(params), -1))
+    y_win, x_win = np.mgrid[0:win_size, 0:win_size]
+    yy = origins[:, 0:1] + np.ravel(y_win)[None, :]
+    xx = origins[:, 1:2] + np.ravel(x_win)[None, :]
+    dist2 = ((xx - params[:, 0:1]) ** 2) + ((yy - params[:, 1:2]) ** 2)
+    mask = np.logical_and(dist2 <= (mask_radius ** 2), np.isfinite(zz))
+    return xx, yy, np.where(mask, zz, 0), mask
+
+
+def column_residuals(xx, yy, zz, mask, params):
+    """
+    Misfit of the atom columns with their shapes kept fixed
+
+    Parameters
+    ----------
+    xx:     ndarray
+            X positions of the window pixels, of shape (N, P)
+    yy:     ndarray
+            Y positions of the window pixels, of shape (N, P)
+    zz:     ndarray
+            Image values of the window pixels, of shape (N, P)
+    mask:   ndarray
+            Boolean array, which is True for the pixels of
+            every column
+    params: ndarray
+            Shape is (N, 6), the Gaussian parameters of every
+            column in the order of `util.fit_gaussian2D_mask`
+
+    Returns
+    -------
+    amplitude:  ndarray
+                Best amplitude of every column above the background
+    background: ndarray
+                Best background under every column
+    residual:   ndarray
+                Root mean square misfit of every column, relative
+                to its amplitude
+
+    Notes
+    -----
+    With the position, rotation and widths of every Gaussian fixed,
+    the model is linear in the amplitude and the background, so the
+    best values of both come from a 2x2 linear system for every
+    column, solved for all the columns at once. This is much cheaper
+    than a Gaussian fit, and the residual tells whether the column
+    still sits where it is predicted to be.
+    """
+    shape = np.reshape(
+        st.util.gaussian_2D_function(
+            (xx, yy),
+            params[:, 0:1],
+            params[:, 1:2],
+            params[:, 2:3],
+            params[:, 3:4],
+            params[:, 4:5],
+            1,
+        ),
+        xx.shape,
+    )
+    shape = np.where(mask, shape, 0)
+    no_pixels = np.sum(mask, axis=1)
+    sum_s = np.sum(shape, axis=1)
+    sum_ss = np.sum(shape ** 2, axis=1)
+    sum_z = np.sum(zz, axis=1)
+    sum_sz = np.sum(shape * zz, axis=1)
+    det = (no_pixels * sum_ss) - (sum_s ** 2)
+    amplitude = ((no_pixels * sum_sz) - (sum_s * sum_z)) / det
+    background = (sum_z - (amplitude * sum_s)) / no_pixels
+    misfit = np.where(
+        mask, zz - (amplitude[:, None] * shape) - background[:, None], 0
+    )
+    residual = ((np.sum(misfit ** 2, axis=1) / no_pixels) ** 0.5) / np.abs(
+        amplitude
+    )
+    return amplitude, background, residual
+
+
+def track_atoms(
+    image_stack,
+    positions,
+    mask_radius=0,
+    threshold=1.5,
+    usfac=100,
+    tol_val=0.01,
+    workers=1,
+):
+    """
+    Follow every atom column through an image series
+
+    Parameters
+    ----------
+    image_stack: ndarray
+                 Image series of shape (frames, Y, X), which can be
+                 a memory mapped array
+    positions:   ndarray
+                 Atom positions in the first frame as y, x, such as
+                 from `peaks_vis`. If the array has six or more
+                 columns, such as `atom_fit.refined_peaks`, the
+                 columns are taken as already refined in the first
+                 frame.
+    mask_radius: float, optional
+                 Radius of the fitting mask around every column.
+                 Default is 0, upon which half the median nearest
+                 neighbor distance is used.
+    threshold:   float, optional
+                 Columns are only refitted in a frame when their
+                 residual, from `column_residuals`, exceeds this
+                 multiple of the median residual of all the columns
+                 in the frame. Default is 1.5
+    usfac:       int, optional
+                 Upsampling factor of the drift registration.
+                 Default is 100
+    tol_val:     float, optional
+                 Tolerance of the refits. Default is 0.01
+    workers:     int, optional
+                 Number of worker processes refining the first
+                 frame. Default is 1
+
+    Returns
+    -------
+    tracks:   ndarray
+              Shape is (frames, N, 6), the position as y, x, the
+              rotation, standard deviations and peak intensity of
+              every column in every frame
+    drift:    ndarray
+              Shape is (frames, 2), the rigid drift of every frame
+              relative to the first one as y, x
+    refitted: ndarray
+              Boolean array of shape (frames, N), which is True
+              where a column was refitted
+
+    Notes
+    -----
+    The columns are only detected and fully refined once, in the
+    first frame. For every following frame, the drift from the
+    previous frame is measured by upsampled cross-correlation, and
+    all the columns are moved along with it. The position, rotation
+    and widths of every column are then kept fixed while the best
+    amplitude and background are solved for directly. Most columns
+    then fit down to the noise, so the median residual is a measure
+    of the noise in the frame, and only the columns whose residual
+    is well above it are refitted. These refits start from the
+    parameters of the previous frame, and are all done at once by
+    `util.fit_gaussian2D_batch`. As columns mostly move with the
+    drift, only a few columns need a new fit in every frame, and
+    every frame is read only once, so the cost of a long series is
+    a small fraction of refining every frame from scratch.
+
+    Examples
+    --------
+    Detect the columns in the first frame with `atom_fit`, and then:
+
+    >>> tracks, drift, refitted = st.afit.track_atoms(movie, atoms.refined_peaks)
+    >>> plt.plot(tracks[:, 10, 1], tracks[:, 10, 0])
+
+    See Also
+    --------
+    column_residuals
+    refine_atoms
+    util.dftregistration
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    no_frames = int(image_stack.shape[0])
+    no_atoms = len(positions)
+    if mask_radius == 0:
+        mask_radius = 0.5 * st.afit.atom_index(positions).median_distance()
+    frame = np.asarray(image_stack[0], dtype=np.float64)
+    if positions.shape[1] >= 6:
+        ref_arr = np.copy(positions[:, 0:6])
+    else:
+        ref_arr = st.afit.refine_atoms(frame, positions, workers)
+    params = np.zeros((no_atoms, 6), dtype=np.float64)
+    params[:, 0:2] = np.flip(ref_arr[:, 0:2], axis=1)
+    params[:, 2:5] = ref_arr[:, 2:5]
+    amplitude, background, _ = column_residuals(
+        *column_patches(frame, params, mask_radius), params
+    )
+    tracks = np.zeros((no_frames, no_atoms, 6), dtype=np.float64)
+    tracks[0, :, 0:5] = ref_arr[:, 0:5]
+    tracks[0, :, 5] = amplitude + background
+    drift = np.zeros((no_frames, 2), dtype=np.float64)
+    refitted = np.zeros((no_frames, no_atoms), dtype=bool)
+    refitted[0, :] = positions.shape[1] < 6
+    frame_ft = np.fft.fft2(frame)
+    for ii in range(1, no_frames):
+        frame = np.asarray(image_stack[ii], dtype=np.float64)
+        previous_ft = frame_ft
+        frame_ft = np.fft.fft2(frame)
+        row_shift, col_shift, _, _, _ = st.util.dftregistration(
+            previous_ft, frame_ft, usfac
+        )
+        drift[ii, 0] = drift[ii - 1, 0] - row_shift
+        drift[ii, 1] = drift[ii - 1, 1] - col_shift
+        params[:, 0] -= col_shift
+        params[:, 1] -= row_shift
+        xx, yy, zz, mask = column_patches(frame, params, mask_radius)
+        amplitude, background, residual = column_residuals(xx, yy, zz, mask, params)
+        valid = np.logical_and(np.sum(mask, axis=1) > 6, np.isfinite(residual))
+        refit = np.logical_and(
+            valid, residual > (threshold * np.median(residual[valid]))
+        )
+        if np.any(refit):
+            initial = np.copy(params[refit, :])
+            initial[:, 5] = amplitude[refit]
+            lower = np.copy(initial)
+            upper = np.copy(initial)
+            lower[:, 0:2] -= mask_radius
+            upper[:, 0:2] += mask_radius
+            lower[:, 2] = -180
+            upper[:, 2] = 180
+            lower[:, 3:5] = 0.001
+            upper[:, 3:5] = 2.5 * mask_radius
+            lower[:, 5] = (-2.5) * np.abs(amplitude[refit])
+            upper[:, 5] = 2.5 * np.abs(amplitude[refit])
+            popt = st.util.fit_gaussian2D_batch(
+                xx[refit],
+                yy[refit],
+                zz[refit] - background[refit, None],
+                mask[refit],
+                initial,
+                lower,
+                upper,
+                tol_val,
+            )
+            params[refit, :] = popt
+            amplitude[refit] = popt[:, 5]
+        refitted[ii, :] = refit
+        tracks[ii, :, 0:2] = np.flip(params[:, 0:2], axis=1)
+        tracks[ii, :, 2:5] = params[:, 2:5]
+        tracks[ii, :, 5] = amplitude + background
+    return tracks, drift, refitted
@@ -1,12 +1,86 @@
 import numpy as np
-import numba
 import pyfftw.interfaces as pfi
 import stemtool as st
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as mpgs
 
 
-@numba.jit(parallel=True, cache=True)
+def register_pairs(stack_ft, pairs, sampling=500):
+    """
+    Upsampled registration of pairs of images from their
+    Fourier transforms
+
+    Parameters
+    ----------
+    stack_ft: ndarray
+              Unshifted Fourier transforms of the images in the
+              stack, of shape (N, Y, X)
+    pairs:    ndarray
+              Shape is (M, 2), the stack positions of the two
+              images of every pair
+    sampling: int, optional
+              Fraction of the pixel to calculate upsampled
+              cross-correlation for. Default is 500
+
+    Returns
+    -------
+    shifts: ndarray
+            Shape is (M, 2), the row and column shifts that
+            register the second image of every pair to the first
+
+    See Also
+    --------
+    util.dftregistration
+    """
+    shifts = np.zeros((len(pairs), 2), dtype=np.float64)
+    for pp in range(len(pairs)):
+        shifts[pp, 0], shifts[pp, 1], _, _, _ = st.util.dftregistration(
+            stack_ft[pairs[pp, 0]], stack_ft[pairs[pp, 1]], sampling
+        )
+    return shifts
+
+
+def reconcile_shifts(pairs, shifts, no_im):
+    """
+    Shift of every image from the shifts between pairs of
+    images by least squares
+
+    Parameters
+    ----------
+    pairs:  ndarray
+            Shape is (M, 2), the stack positions of the two
+            images of every pair
+    shifts: ndarray
+            Shape is (M, 2), the row and column shifts that
+            register the second image of every pair to the first
+    no_im:  int
+            Number of images in the stack
+
+    Returns
+    -------
+    im_shifts: ndarray
+               Shape is (no_im, 2), the row and column shift of
+               every image, with a mean of zero
+
+    Notes
+    -----
+    The shift between two images is the difference of the shifts
+    of the images, so every pair gives one equation, and with more
+    pairs than images the shifts are overdetermined. The least
+    squares solution spreads the registration errors over all the
+    pairs, instead of accumulating them along a chain of images.
+    Only the differences of the shifts are fixed by the pairs, and
+    the minimum norm solution has a mean of zero.
+    """
+    design = np.zeros((len(pairs), no_im), dtype=np.float64)
+    design[np.arange(len(pairs)), pairs[:, 0]] = -1
+    design[np.arange(len(pairs)), pairs[:, 1]] = 1
+    im_shifts, _, rank, _ = np.linalg.lstsq(design, shifts, rcond=None)
+    if rank < (no_im - 1):
+        raise RuntimeError("The pairs do not connect all the images")
+    return im_shifts
+
+
 def numba_shift_stack(image_stack, row_stack, col_stack, stack_pos, sampling=500):
     """
     Cross-Correlate stack of images
@@ -33,10 +107,12 @@ def numba_shift_stack(image_stack, row_stack, col_stack, stack_pos, sampling=500
     For a rapidly collected image stack, each image in the stack is 
     cross-correlated with all the other images of the stack, to generate
     a skew matrix of row shifts and column shifts, calculated with sub
-    pixel precision.
+    pixel precision. The Fourier transform of every image in
+    `stack_pos` is only calculated once.
     
     See Also
     --------
+    register_pairs
     util.dftregistration
     
     References
@@ -45,31 +121,16 @@ def numba_shift_stack(image_stack, row_stack, col_stack, stack_pos, sampling=500
           Baek, D.J., Sheckelton, J.P., Pasco, C., Nair, H., Schreiber, N.J. and 
           Hoffman, J., 2018. Image registration of low signal-to-noise cryo-STEM data. 
           Ultramicroscopy, 191, pp.56-65.
-    
-    Examples
-    --------
-    Since this is a `numba` function, to initialize the JIT we need
-    to call the function with a small dataset first. Running it once also
-    allows `pyFFTW` to figure out the fastest FFT route.
-    
-    >>> numba_shift_stack(image_stack,row_stack,col_stack,stack_pos[0:10,:])
-    
-    Once the JIT is initialized run the function as:
-    
-    >>> numba_shift_stack(image_stack,row_stack,col_stack,stack_pos)
     """
-    pfi.cache.enable()
-    for pp in numba.prange(len(stack_pos)):
-        ii = stack_pos[pp, 0]
-        jj = stack_pos[pp, 1]
-        row_stack[ii, jj], col_stack[ii, jj], _, _, _ = st.util.dftregistration(
-            pfi.numpy_fft.fft2(image_stack[ii, :, :]),
-            pfi.numpy_fft.fft2(image_stack[jj, :, :]),
-            sampling,
-        )
+    stack_pos = np.asarray(stack_pos)
+    used, pairs = np.unique(stack_pos, return_inverse=True)
+    pairs = np.reshape(pairs, stack_pos.shape)
+    stack_ft = pfi.numpy_fft.fft2(image_stack[used, :, :], axes=(-2, -1))
+    shifts = register_pairs(stack_ft, pairs, sampling)
+    row_stack[stack_pos[:, 0], stack_pos[:, 1]] = shifts[:, 0]
+    col_stack[stack_pos[:, 0], stack_pos[:, 1]] = shifts[:, 1]
 
 
-@numba.jit(parallel=True, cache=True)
 def numba_stack_corr(image_stack, moved_stack, rowshifts, colshifts):
     """
     Get corrected image stack
@@ -110,24 +171,125 @@ def numba_stack_corr(image_stack, moved_stack, rowshifts, colshifts):
     
     Examples
     --------
-    Since this is a `numba` function, to initialize the JIT we need
-    to call the function with a small dataset first
-    
-    >>> corrected_stack(image_stack,moved_stack,rowshifts,colshifts)
-    
-    Once the JIT is initialized run the function as:
-    
-    >>> corr_stack = corrected_stack(image_stack,rowshifts,colshifts)
+    >>> numba_stack_corr(image_stack,moved_stack,rowshifts,colshifts)
     
     """
     row_mean = np.median(rowshifts, axis=0)
     col_mean = np.median(colshifts, axis=0)
-    for ii in numba.prange(len(row_mean)):
+    for ii in range(len(row_mean)):
         moved_stack[ii, :, :] = np.abs(
             st.util.move_by_phase(image_stack[ii, :, :], col_mean[ii], row_mean[ii])
         )
 
 
+def drift_average(image_stack, sampling=100, batch_size=16, variance=False):
+    """
+    Drift corrected average of a long image series, reading
+    every image only once
+
+    Parameters
+    ----------
+    image_stack: ndarray
+                 Image series of shape (frames, Y, X), which can be
+                 a memory mapped array or a HDF5 dataset
+    sampling:    int, optional
+                 Fraction of the pixel to calculate upsampled
+                 cross-correlation for. Default is 100
+    batch_size:  int, optional
+                 Number of images read and shifted together.
+                 Default is 16
+    variance:    bool, optional
+                 Also calculate the variance of the drift corrected
+                 images. Default is False
+
+    Returns
+    -------
+    mean_image: ndarray
+                Mean of the drift corrected images
+    var_image:  ndarray
+                Variance of the drift corrected images, only
+                returned if `variance` is True
+    shifts:     ndarray
+                Shape is (frames, 2), the row and column shift
+                applied to every image
+
+    Notes
+    -----
+    The images are read in batches, and every image is registered
+    to the mean of all the images before its batch, which becomes
+    less noisy as more images are added and never drifts along the
+    series. The shifts of a whole batch are then applied together as
+    Fourier space phase ramps, and the shifted batch is added to a
+    running sum that is also kept in Fourier space, so it is both the
+    reference for the next batch and, after one inverse transform,
+    the mean image. The variance is accumulated batch by batch with
+    the pairwise update of Chan et al. Only one batch of images is
+    ever held in memory, never the whole shifted stack. The shifts
+    wrap the images around their edges, like `util.move_by_phase`.
+
+    References
+    ----------
+    .. [1] Chan, T.F., Golub, G.H. and LeVeque, R.J., 1983. Algorithms
+       for computing the sample variance: analysis and recommendations.
+       The American Statistician, 37(3), pp.242-247.
+
+    Examples
+    --------
+    >>> movie = np.load("movie.npy", mmap_mode="r")
+    >>> mean_image, var_image, shifts = st.afit.drift_average(movie, variance=True)
+
+    See Also
+    --------
+    multi_image_drift
+    util.dftregistration
+    """
+    if sampling < 1:
+        raise RuntimeError("Sampling factor should be a positive integer")
+    no_im = int(image_stack.shape[0])
+    imshape = tuple(image_stack.shape[1:3])
+    q_y = np.fft.fftfreq(imshape[0])[None, :, None]
+    q_x = np.fft.fftfreq(imshape[1])[None, None, :]
+    shifts = np.zeros((no_im, 2), dtype=np.float64)
+    sum_ft = np.zeros(imshape, dtype=np.complex128)
+    mean_image = np.zeros(imshape, dtype=np.float64)
+    m2_image = np.zeros(imshape, dtype=np.float64)
+    batch_size = int(max(batch_size, 1))
+    pfi.cache.enable()
+    for start in range(0, no_im, batch_size):
+        stop = min(start + batch_size, no_im)
+        batch_ft = pfi.numpy_fft.fft2(
+            np.asarray(image_stack[start:stop], dtype=np.float64), axes=(-2, -1)
+        )
+        if start == 0:
+            ref_ft = np.copy(batch_ft[0])
+        else:
+            ref_ft = sum_ft / start
+        for ii in range(stop - start):
+            shifts[start + ii, 0], shifts[start + ii, 1], _, _, _ = (
+                st.util.dftregistration(ref_ft, batch_ft[ii], sampling)
+            )
+        batch_ft *= np.exp(
+            (-2j * np.pi)
+            * (
+                (shifts[start:stop, 0, None, None] * q_y)
+                + (shifts[start:stop, 1, None, None] * q_x)
+            )
+        )
+        sum_ft += np.sum(batch_ft, axis=0)
+        if variance:
+            moved = np.real(pfi.numpy_fft.ifft2(batch_ft, axes=(-2, -1)))
+            batch_mean = np.mean(moved, axis=0)
+            delta = batch_mean - mean_image
+            mean_image += delta * ((stop - start) / stop)
+            m2_image += np.sum((moved - batch_mean[None, :, :]) ** 2, axis=0) + (
+                (delta ** 2) * (start * (stop - start) / stop)
+            )
+    mean_image = np.real(pfi.numpy_fft.ifft2(sum_ft)) / no_im
+    if variance:
+        return mean_image, m2_image / no_im, shifts
+    return mean_image, shifts
+
+
 class multi_image_drift(object):
     """
     Correct for scan drift through cross-correlating a
@@ -159,6 +321,16 @@ class multi_image_drift(object):
     >>> cc.get_shift_stack()
     >>> corrected = cc.corrected_stack()
     
+    For long stacks, only register every image to its next few
+    neighbors instead of registering all the pairs:
+    
+    >>> cc.get_shape_stack(mode="sparse", no_neighbors=3)
+    
+    For movies too long to hold in memory, register and average the
+    images in a single streaming pass with `drift_average`, or as:
+    
+    >>> corrected, variance = cc.stream_average(variance=True)
+    
     """
 
     def __init__(self, image_stack, sampling=500):
@@ -175,37 +347,104 @@ class multi_image_drift(object):
         self.corr_image = np.empty(
             (image_stack.shape[1], image_stack.shape[2]), dtype=image_stack.dtype
         )
-        self.moved_stack = np.empty_like(image_stack, dtype=image_stack.dtype)
+        self.moved_stack = None
         self.stack_check = False
 
-    def get_shape_stack(self):
+    def get_shape_stack(self, mode="all", reference=0, no_neighbors=3):
         """
         Cross-Correlate stack of images
 
+        Parameters
+        ----------
+        mode:         str, optional
+                      Which pairs of images are registered. "all"
+                      registers every pair, "reference" registers
+                      every image to the reference image,
+                      "sequential" registers every image to the one
+                      before it, and "sparse" registers every image
+                      to the next `no_neighbors` images and finds the
+                      shift of every image by least squares. Default
+                      is "all"
+        reference:    int, optional
+                      Position of the reference image in the stack
+                      for the "reference" mode. Default is 0
+        no_neighbors: int, optional
+                      Number of following images every image is
+                      registered to in the "sparse" mode. Default is 3
+
         Notes
         -----
         For a rapidly collected image stack, each image in the stack is 
         cross-correlated with all the other images of the stack, to generate
         a skew matrix of row shifts and column shifts, calculated with sub
-        pixel precision.
+        pixel precision. The Fourier transform of every image is calculated
+        once, and as the shift of image j to image i is the negative of the
+        shift of image i to image j, only one of the two is calculated.
+
+        Registering all the pairs needs N(N-1)/2 registrations. The other
+        modes only need about N, or N times `no_neighbors` for "sparse",
+        registrations. They find the shift of every image, and the skew
+        matrices are filled in with the differences of those shifts, so
+        `corrected_stack` works the same for all the modes. The
+        "sequential" mode is best for slowly changing images, but
+        accumulates the registration errors along the stack, which the
+        least squares fit of the "sparse" mode spreads out instead.
+
+        See Also
+        --------
+        register_pairs
+        reconcile_shifts
         """
+        no_im = self.no_im
+        if mode == "all":
+            pairs = np.transpose(np.triu_indices(no_im, 1))
+        elif mode == "reference":
+            if (reference < 0) or (reference >= no_im):
+                raise ValueError("The reference image is not in the stack")
+            pairs = np.zeros((no_im, 2), dtype=int)
+            pairs[:, 0] = reference
+            pairs[:, 1] = np.arange(no_im)
+        elif mode == "sequential":
+            pairs = np.transpose(
+                np.asarray((np.arange(no_im - 1), np.arange(1, no_im)))
+            )
+        elif mode == "sparse":
+            if no_neighbors < 1:
+                raise ValueError("Every image needs at least one neighbor")
+            pairs = np.concatenate(
+                [
+                    np.transpose(
+                        np.asarray((np.arange(no_im - kk), np.arange(kk, no_im)))
+                    )
+                    for kk in range(1, int(min(no_neighbors, no_im - 1)) + 1)
+                ]
+            )
+        else:
+            raise ValueError(
+                "Mode must be one of 'all', 'reference', 'sequential' or 'sparse'"
+            )
+        pairs = np.reshape(np.asarray(pairs, dtype=int), (-1, 2))
         pfi.cache.enable()
-        rows, cols = np.mgrid[0 : self.no_im, 0 : self.no_im]
-        pos_stack = np.asarray((np.ravel(rows), np.ravel(cols))).transpose()
-
-        # Initialize JIT
-        numba_shift_stack(
-            self.image_stack,
-            self.row_stack,
-            self.col_stack,
-            pos_stack[0:10, :],
-            self.sampling,
-        )
-
-        # Run JITted function
-        numba_shift_stack(
-            self.image_stack, self.row_stack, self.col_stack, pos_stack, self.sampling
-        )
+        stack_ft = pfi.numpy_fft.fft2(self.image_stack, axes=(-2, -1))
+        shifts = register_pairs(stack_ft, pairs, self.sampling)
+        if mode == "all":
+            self.row_stack[:, :] = 0
+            self.col_stack[:, :] = 0
+            self.row_stack[pairs[:, 0], pairs[:, 1]] = shifts[:, 0]
+            self.col_stack[pairs[:, 0], pairs[:, 1]] = shifts[:, 1]
+            self.row_stack[pairs[:, 1], pairs[:, 0]] = -shifts[:, 0]
+            self.col_stack[pairs[:, 1], pairs[:, 0]] = -shifts[:, 1]
+        else:
+            if mode == "reference":
+                im_shifts = shifts
+            elif mode == "sequential":
+                im_shifts = np.concatenate(
+                    (np.zeros((1, 2)), np.cumsum(shifts, axis=0)), axis=0
+                )
+            else:
+                im_shifts = reconcile_shifts(pairs, shifts, no_im)
+            self.row_stack[:, :] = im_shifts[None, :, 0] - im_shifts[:, None, 0]
+            self.col_stack[:, :] = im_shifts[None, :, 1] - im_shifts[:, None, 1]
 
         self.max_shift = np.amax(
             np.asarray((np.amax(self.row_stack), np.amax(self.col_stack)))
@@ -226,26 +465,51 @@ class multi_image_drift(object):
         The mean of the shift stacks for every image position are the 
         amount by which each image is to be shifted. We calculate the 
         mean and move each image by that amount in the stack and then
-        sum them up.
+        sum them up. The moved images are kept as `moved_stack`, so for
+        long stacks use `stream_average` instead.
         """
         if not self.stack_check:
             raise RuntimeError(
                 "Please get the images correlated first as get_shape_stack()"
             )
-        image_stack = np.copy(self.image_stack[0:3, :, :])
-        moved_stack = np.copy(self.moved_stack[0:3, :, :])
-        row_stack = np.copy(self.row_stack[0:3, 0:3])
-        col_stack = np.copy(self.col_stack[0:3, 0:3])
-        # Initialize JIT
-        numba_stack_corr(image_stack, moved_stack, row_stack, col_stack)
-
-        # Run JITted code
+        if self.moved_stack is None:
+            self.moved_stack = np.empty(
+                self.image_stack.shape, dtype=self.image_stack.dtype
+            )
         numba_stack_corr(
             self.image_stack, self.moved_stack, self.row_stack, self.col_stack
         )
         self.corr_image = np.sum(self.moved_stack, axis=0) / self.no_im
         return self.corr_image
 
+    def stream_average(self, batch_size=16, variance=False):
+        """
+        Drift corrected average of the stack without keeping the
+        shifted images, see `drift_average`
+
+        Parameters
+        ----------
+        batch_size: int, optional
+                    Number of images read and shifted together.
+                    Default is 16
+        variance:   bool, optional
+                    Also return the variance of the drift corrected
+                    images. Default is False
+
+        Returns
+        -------
+        corr_image: ndarray
+                    Mean of the drift corrected images
+        var_image:  ndarray
+                    Variance of the drift corrected images, only
+                    returned if `variance` is True
+        """
+        results = drift_average(self.image_stack, self.sampling, batch_size, variance)
+        self.corr_image = results[0]
+        if variance:
+            return results[0], results[1]
+        return results[0]
+
     def plot_shifts(self):
         """
         Notes
@@ -0,0 +1,265 @@
+import numpy as np
+import scipy.optimize as spo
+import scipy.sparse as sps
+import stemtool as st
+
+
+def joint_fit_window(image_data, params, radius, ftol=1e-04, xtol=1e-04):
+    """
+    Fit the sum of overlapping 2D Gaussians and a constant
+    background to an image together
+
+    Parameters
+    ----------
+    image_data: ndarray
+                Image or image tile
+    params:     ndarray
+                Shape is (N, 6), the starting parameters of every
+                Gaussian in the order of `util.fit_gaussian2D_mask`,
+                in the pixel coordinates of `image_data`
+    radius:     float
+                Every Gaussian is evaluated on the pixels within
+                this distance of its starting center
+    ftol:       float, optional
+                Tolerance of the cost. Default is 1e-04
+    xtol:       float, optional
+                Tolerance of the parameters. Default is 1e-04
+
+    Returns
+    -------
+    popt:       ndarray
+                Shape is (N, 6), the fitted parameters of every
+                Gaussian
+    background: float
+                The fitted background
+
+    Notes
+    -----
+    The model of every pixel is the background plus all the
+    Gaussians within `radius` of it, so the intensity shared by
+    overlapping atom columns is split between them, instead of
+    every atom being fitted as if its neighbors were not there.
+    Every pixel only depends on the parameters of the few atoms
+    close to it, which are found with `atom_index.pixels_within`,
+    so the Jacobian of the whole image is sparse. Its sparsity
+    pattern is built once, and the trust region reflective solver
+    of `scipy.optimize.least_squares` solves the sparse normal
+    equations with LSMR, so the cost of every iteration grows
+    linearly with the number of atoms. The LSMR steps are only
+    solved to a relative accuracy of 1e-04, which is enough to
+    point every step in the right direction. The values and analytic
+    derivatives of all the Gaussians come from one call to
+    `util.gaussian_2D_fused`.
+
+    See Also
+    --------
+    joint_fit
+    atom_index.pixels_within
+    util.gaussian_2D_fused
+    """
+    image_data = np.asarray(image_data, dtype=np.float64)
+    params = np.asarray(params, dtype=np.float64)
+    no_atoms = len(params)
+    index = st.afit.atom_index(np.flip(params[:, 0:2], axis=1))
+    pixels, atoms = index.pixels_within(image_data.shape, radius)
+    image_flat = np.ravel(image_data)
+    valid = np.isfinite(image_flat[pixels])
+    pixels = pixels[valid]
+    atoms = atoms[valid]
+    fit_pixels, pair_rows = np.unique(pixels, return_inverse=True)
+    no_rows = len(fit_pixels)
+    if no_rows <= ((6 * no_atoms) + 1):
+        raise RuntimeError("Not enough pixels to fit all the atoms")
+    fit_data = image_flat[fit_pixels]
+    pair_x = np.asarray(pixels % image_data.shape[1], dtype=np.float64)
+    pair_y = np.asarray(pixels // image_data.shape[1], dtype=np.float64)
+
+    rows = np.concatenate((np.tile(pair_rows, 6), np.arange(no_rows)))
+    cols = np.concatenate(
+        (
+            np.ravel((6 * atoms[None, :]) + np.arange(6)[:, None]),
+            np.full(no_rows, 6 * no_atoms),
+        )
+    )
+    pattern = sps.csr_matrix(
+        (np.arange(1, len(rows) + 1, dtype=np.float64), (rows, cols)),
+        shape=(no_rows, (6 * no_atoms) + 1),
+    )
+    order = np.asarray(pattern.data, dtype=np.int64) - 1
+    cache = {}
+
+    def residuals(p_vals):
+        atom_p = np.reshape(p_vals[:-1], (no_atoms, 6))[atoms, :]
+        gauss, jacobian = st.util.gaussian_2D_fused(
+            (pair_x, pair_y), *np.transpose(atom_p)
+        )
+        model = np.bincount(pair_rows, weights=gauss, minlength=no_rows)
+        cache["params"] = np.copy(p_vals)
+        cache["jacobian"] = np.concatenate((np.ravel(jacobian), np.ones(no_rows)))
+        return model + p_vals[-1] - fit_data
+
+    def jacobian(p_vals):
+        if not np.array_equal(cache.get("params"), p_vals):
+            residuals(p_vals)
+        return sps.csr_matrix(
+            (cache["jacobian"][order], pattern.indices, pattern.indptr),
+            shape=pattern.shape,
+        )
+
+    lower_bound = np.zeros_like(params)
+    upper_bound = np.zeros_like(params)
+    lower_bound[:, 0:2] = params[:, 0:2] - (0.5 * radius)
+    upper_bound[:, 0:2] = params[:, 0:2] + (0.5 * radius)
+    lower_bound[:, 2] = -180
+    upper_bound[:, 2] = 180
+    upper_bound[:, 3:5] = 2.5 * radius
+    upper_bound[:, 5] = np.inf
+    p_start = np.append(np.ravel(params), np.amin(fit_data))
+    lower_bound = np.append(np.ravel(lower_bound), -np.inf)
+    upper_bound = np.append(np.ravel(upper_bound), np.inf)
+    margin = 1e-06 * np.minimum(upper_bound - lower_bound, 1)
+    p_start = np.clip(p_start, lower_bound + margin, upper_bound - margin)
+    result = spo.least_squares(
+        residuals,
+        p_start,
+        jac=jacobian,
+        bounds=(lower_bound, upper_bound),
+        method="trf",
+        tr_solver="lsmr",
+        x_scale="jac",
+        tr_options={"atol": 1e-04, "btol": 1e-04},
+        ftol=ftol,
+        xtol=xtol,
+    )
+    if not result.success:
+        raise RuntimeError("Optimal parameters not found: " + result.message)
+    popt = np.reshape(result.x[:-1], (no_atoms, 6))
+    return popt, result.x[-1]
+
+
+def joint_fit(image_data, positions, radius=0, tile_size=512, ftol=1e-04, xtol=1e-04):
+    """
+    Refine all the atoms of an image with one joint fit of
+    overlapping 2D Gaussians
+
+    Parameters
+    ----------
+    image_data: ndarray
+                Original atomic resolution image
+    positions:  ndarray
+                Starting atom positions as y, x. If the array has
+                six columns, such as the output of `refine_atoms`,
+                the rotations, standard deviations and amplitudes
+                are used as the starting values as well.
+    radius:     float, optional
+                Every Gaussian is evaluated on the pixels within
+                this distance of it. Default is 0, upon which the
+                median nearest neighbor distance is used.
+    tile_size:  int, optional
+                The image is fitted in square tiles of this size,
+                including the overlap. Default is 512. If 0, the
+                whole image is fitted at once.
+    ftol:       float, optional
+                Tolerance of the cost. Default is 1e-04
+    xtol:       float, optional
+                Tolerance of the parameters. Default is 1e-04
+
+    Returns
+    -------
+    ref_arr:    ndarray
+                Refined atom positions as y, x, followed by the
+                rotation, standard deviations and amplitude of the
+                fitted Gaussians, like `refine_atoms`
+    background: ndarray
+                The fitted background under every atom
+
+    Notes
+    -----
+    Atoms in dumbbells or other closely spaced columns overlap, so
+    fitting every atom on its own biases its position towards its
+    neighbors. Here, the image is modelled as the sum of all the
+    Gaussians and a background, which is fitted in one go with the
+    sparse Jacobian of `joint_fit_window`. Without starting
+    parameters, the standard deviations start at a third of the
+    radius, and the amplitudes at the image intensity above the
+    background at every position.
+
+    For large images, the tiles overlap by four times the radius.
+    Every tile is fitted with all the atoms inside it, and only the
+    atoms in the core of the tile are kept, which are at least twice
+    the radius from the tile edge, so their neighbors are complete.
+    The radius should reach the tails of the Gaussians, which for
+    closely spaced columns can be farther than the nearest neighbor
+    distance, in which case it should be set explicitly.
+
+    Examples
+    --------
+    >>> ref_arr = st.afit.refine_atoms(image, peaks)
+    >>> joint_arr, background = st.afit.joint_fit(image, ref_arr, radius=8)
+
+    See Also
+    --------
+    joint_fit_window
+    refine_atoms
+    mpfit
+    """
+    image_data = np.asarray(image_data, dtype=np.float64)
+    positions = np.asarray(positions, dtype=np.float64)
+    if radius == 0:
+        radius = st.afit.atom_index(positions).median_distance()
+    params = np.zeros((len(positions), 6), dtype=np.float64)
+    params[:, 0:2] = np.flip(positions[:, 0:2], axis=1)
+    if positions.shape[1] >= 6:
+        params[:, 2:6] = positions[:, 2:6]
+    else:
+        ref_y = np.clip(np.round(positions[:, 0]), 0, image_data.shape[0] - 1)
+        ref_x = np.clip(np.round(positions[:, 1]), 0, image_data.shape[1] - 1)
+        peak_vals = image_data[ref_y.astype(int), ref_x.astype(int)]
+        params[:, 3:5] = radius / 3
+        params[:, 5] = np.maximum(
+            peak_vals - np.nanpercentile(image_data, 5), 1e-03 * np.ptp(peak_vals)
+        )
+    if tile_size == 0:
+        tile_size = np.amax(image_data.shape)
+    overlap = 4 * int(np.ceil(radius))
+    ref_arr = np.zeros((len(positions), 6), dtype=np.float64)
+    background = np.zeros(len(positions), dtype=np.float64)
+    for y_window in st.util.tile_slices(image_data.shape[0], tile_size, overlap):
+        for x_window in st.util.tile_slices(image_data.shape[1], tile_size, overlap):
+            in_window = np.logical_and(
+                np.logical_and(
+                    positions[:, 0] >= y_window[0], positions[:, 0] < y_window[1]
+                ),
+                np.logical_and(
+                    positions[:, 1] >= x_window[0], positions[:, 1] < x_window[1]
+                ),
+            )
+            in_core = np.logical_and(
+                np.logical_and(
+                    np.floor(positions[:, 0]) >= y_window[2],
+                    np.floor(positions[:, 0]) < y_window[3],
+                ),
+                np.logical_and(
+                    np.floor(positions[:, 1]) >= x_window[2],
+                    np.floor(positions[:, 1]) < x_window[3],
+                ),
+            )
+            if not np.any(in_core):
+                continue
+            window_params = params[in_window, :]
+            window_params[:, 0] -= x_window[0]
+            window_params[:, 1] -= y_window[0]
+            popt, window_bg = joint_fit_window(
+                image_data[y_window[0] : y_window[1], x_window[0] : x_window[1]],
+                window_params,
+                radius,
+                ftol,
+                xtol,
+            )
+            keep = in_core[in_window]
+            core_atoms = np.where(in_core)[0]
+            ref_arr[core_atoms, 0] = popt[keep, 1] + y_window[0]
+            ref_arr[core_atoms, 1] = popt[keep, 0] + x_window[0]
+            ref_arr[core_atoms, 2:6] = popt[keep, 2:6]
+            background[core_atoms] = window_bg
+    return ref_arr, background
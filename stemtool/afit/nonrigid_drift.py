@@ -0,0 +1,430 @@
+import numpy as np
+import scipy.ndimage as scnd
+import concurrent.futures
+import stemtool as st
+
+
+def patch_grid(imshape, patch_size, step):
+    """
+    Centers of the registration patches
+
+    Parameters
+    ----------
+    imshape:    tuple
+                Shape of the images as (Y, X)
+    patch_size: int
+                Size of the square patches
+    step:       int
+                Distance between the centers of neighboring patches
+
+    Returns
+    -------
+    centers_y: ndarray
+               Y positions of the patch centers
+    centers_x: ndarray
+               X positions of the patch centers
+    """
+    half_size = int(patch_size / 2)
+    if (imshape[0] < patch_size) or (imshape[1] < patch_size):
+        raise ValueError("The patches must be smaller than the images")
+    centers_y = np.arange(half_size, imshape[0] - patch_size + half_size + 1, step)
+    centers_x = np.arange(half_size, imshape[1] - patch_size + half_size + 1, step)
+    return centers_y, centers_x
+
+
+def patch_stack(image, centers_y, centers_x, offsets, patch_size):
+    """
+    Cut out the patches around a grid of centers
+
+    Parameters
+    ----------
+    image:      ndarray
+                The image
+    centers_y:  ndarray
+                Y positions of the patch centers
+    centers_x:  ndarray
+                X positions of the patch centers
+    offsets:    tuple
+                Integer shift of all the patches as (y, x)
+    patch_size: int
+                Size of the square patches
+
+    Returns
+    -------
+    patches: ndarray
+             Shape is (GY, GX, patch_size, patch_size), the
+             patches with their means removed
+    shifts:  ndarray
+             Shape is (2, GY, GX), the actual shift of every patch
+             as (y, x), which is less than `offsets` for patches
+             that would otherwise leave the image
+    """
+    half_size = int(patch_size / 2)
+    y_start = np.clip(
+        centers_y - half_size + int(offsets[0]), 0, image.shape[0] - patch_size
+    )
+    x_start = np.clip(
+        centers_x - half_size + int(offsets[1]), 0, image.shape[1] - patch_size
+    )
+    windows = np.lib.stride_tricks.sliding_window_view(
+        np.asarray(image, dtype=np.float64), (patch_size, patch_size)
+    )
+    patches = np.array(windows[y_start[:, None], x_start[None, :]])
+    patches -= np.mean(patches, axis=(-2, -1), keepdims=True)
+    shifts = np.zeros((2, len(centers_y), len(centers_x)), dtype=np.float64)
+    shifts[0] = (y_start - (centers_y - half_size))[:, None]
+    shifts[1] = (x_start - (centers_x - half_size))[None, :]
+    return patches, shifts
+
+
+def patch_displacements(
+    image, ref_ft, centers_y, centers_x, offsets, patch_size, sampling
+):
+    """
+    Displacement of every patch of an image relative to the
+    reference image
+
+    Parameters
+    ----------
+    image:      ndarray
+                The image
+    ref_ft:     ndarray
+                Fourier transforms of the windowed reference patches,
+                of shape (GY, GX, patch_size, patch_size)
+    centers_y:  ndarray
+                Y positions of the patch centers
+    centers_x:  ndarray
+                X positions of the patch centers
+    offsets:    tuple
+                Integer shift of the image as (y, x), around which
+                the patches are cut out
+    patch_size: int
+                Size of the square patches
+    sampling:   int
+                Fraction of the pixel to calculate upsampled
+                cross-correlation for
+
+    Returns
+    -------
+    displacement: ndarray
+                  Shape is (2, GY, GX), the displacement as (y, x)
+                  of the image content at every patch center,
+                  relative to the reference
+
+    See Also
+    --------
+    util.dftregistration
+    """
+    window = np.outer(np.hanning(patch_size), np.hanning(patch_size))
+    patches, displacement = patch_stack(
+        image, centers_y, centers_x, offsets, patch_size
+    )
+    patch_ft = np.fft.fft2(patches * window, axes=(-2, -1))
+    for iy in range(len(centers_y)):
+        for ix in range(len(centers_x)):
+            row_shift, col_shift, _, _, _ = st.util.dftregistration(
+                ref_ft[iy, ix], patch_ft[iy, ix], sampling
+            )
+            displacement[0, iy, ix] -= row_shift
+            displacement[1, iy, ix] -= col_shift
+    return displacement
+
+
+def smooth_displacements(displacement, smoothing=1):
+    """
+    Remove outliers from a grid of patch displacements and
+    smooth it
+
+    Parameters
+    ----------
+    displacement: ndarray
+                  Shape is (2, GY, GX), the displacement of
+                  every patch
+    smoothing:    float, optional
+                  Standard deviation of the Gaussian smoothing in
+                  patches. Default is 1
+
+    Returns
+    -------
+    displacement: ndarray
+                  The smoothed displacements
+
+    Notes
+    -----
+    Patches without enough contrast give random displacements, so
+    every displacement is first replaced with the median of its
+    3x3 neighborhood, before the smooth Gaussian filter.
+    """
+    displacement = scnd.median_filter(displacement, size=(1, 3, 3), mode="nearest")
+    if smoothing > 0:
+        displacement = scnd.gaussian_filter(
+            displacement, (0, smoothing, smoothing), mode="nearest"
+        )
+    return displacement
+
+
+def grid_coordinates(imshape, centers_y, centers_x):
+    """
+    Position of every pixel in units of the patch grid, for
+    interpolating the patch displacements to every pixel with
+    `scipy.ndimage.map_coordinates`
+    """
+    grid_y = (np.arange(imshape[0]) - centers_y[0]) / max(
+        centers_y[-1] - centers_y[0], 1
+    )
+    grid_x = (np.arange(imshape[1]) - centers_x[0]) / max(
+        centers_x[-1] - centers_x[0], 1
+    )
+    grid_y = grid_y * (len(centers_y) - 1)
+    grid_x = grid_x * (len(centers_x) - 1)
+    return np.asarray(np.meshgrid(grid_y, grid_x, indexing="ij"))
+
+
+def warp_image(image, displacement, grid_coords, order=3):
+    """
+    Undistort an image with a smooth displacement field
+
+    Parameters
+    ----------
+    image:        ndarray
+                  The image
+    displacement: ndarray
+                  Shape is (2, GY, GX), the displacement of the
+                  image content at the patch centers
+    grid_coords:  ndarray
+                  Position of every pixel on the patch grid, from
+                  `grid_coordinates`
+    order:        int, optional
+                  Order of the spline interpolation of the image.
+                  Default is 3. The displacements are always
+                  interpolated with cubic splines, which keeps the
+                  coordinate map smooth.
+
+    Returns
+    -------
+    warped: ndarray
+            The image with the content of every pixel moved back
+            to where it is in the reference
+
+    Notes
+    -----
+    The displacements of the patches are interpolated with cubic
+    splines to every pixel, and added to the pixel positions, which
+    gives one coordinate map for the whole image. The image is then
+    resampled once at those coordinates.
+    """
+    coords = np.zeros((2,) + np.shape(image), dtype=np.float64)
+    coords[0] = scnd.map_coordinates(
+        displacement[0], grid_coords, order=3, mode="nearest"
+    )
+    coords[1] = scnd.map_coordinates(
+        displacement[1], grid_coords, order=3, mode="nearest"
+    )
+    coords[0] += np.arange(image.shape[0])[:, None]
+    coords[1] += np.arange(image.shape[1])[None, :]
+    return scnd.map_coordinates(
+        np.asarray(image, dtype=np.float64), coords, order=order, mode="nearest"
+    )
+
+
+def nonrigid_frames(
+    frames, ref_ft, centers_y, centers_x, offsets, patch_size, sampling, smoothing
+):
+    """
+    Register and undistort a block of frames
+
+    Parameters
+    ----------
+    frames:     ndarray
+                Block of frames of shape (F, Y, X)
+    ref_ft:     ndarray
+                Fourier transforms of the windowed reference patches
+    centers_y:  ndarray
+                Y positions of the patch centers
+    centers_x:  ndarray
+                X positions of the patch centers
+    offsets:    ndarray
+                Shape is (F, 2), the integer rigid shift of every
+                frame as (y, x)
+    patch_size: int
+                Size of the square patches
+    sampling:   int
+                Fraction of the pixel to calculate upsampled
+                cross-correlation for
+    smoothing:  float
+                Standard deviation of the smoothing in patches
+
+    Returns
+    -------
+    displacements: ndarray
+                   Shape is (F, 2, GY, GX), the smoothed patch
+                   displacements of every frame
+    warped_sum:    ndarray
+                   Sum of the undistorted frames
+    """
+    grid_coords = grid_coordinates(frames.shape[1:3], centers_y, centers_x)
+    displacements = np.zeros(
+        (len(frames), 2, len(centers_y), len(centers_x)), dtype=np.float64
+    )
+    warped_sum = np.zeros(frames.shape[1:3], dtype=np.float64)
+    for ii in range(len(frames)):
+        displacements[ii] = smooth_displacements(
+            patch_displacements(
+                frames[ii],
+                ref_ft,
+                centers_y,
+                centers_x,
+                offsets[ii],
+                patch_size,
+                sampling,
+            ),
+            smoothing,
+        )
+        warped_sum += warp_image(frames[ii], displacements[ii], grid_coords)
+    return displacements, warped_sum
+
+
+def nonrigid_average(
+    image_stack,
+    patch_size=64,
+    step=32,
+    sampling=20,
+    smoothing=1,
+    iterations=2,
+    workers=1,
+    chunk_size=8,
+):
+    """
+    Correct the scan distortions of every frame of an image
+    series and average the undistorted frames
+
+    Parameters
+    ----------
+    image_stack: ndarray
+                 Image series of shape (frames, Y, X), which can be
+                 a memory mapped array or a HDF5 dataset
+    patch_size:  int, optional
+                 Size of the square registration patches. Default
+                 is 64
+    step:        int, optional
+                 Distance between the centers of neighboring patches.
+                 Default is 32
+    sampling:    int, optional
+                 Fraction of the pixel to calculate upsampled
+                 cross-correlation for. Default is 20
+    smoothing:   float, optional
+                 Standard deviation of the Gaussian smoothing of the
+                 displacements in patches. Default is 1
+    iterations:  int, optional
+                 Number of times the frames are registered to the
+                 improved average. Default is 2
+    workers:     int, optional
+                 Number of worker processes. Default is 1, where
+                 the frames are processed in this process
+    chunk_size:  int, optional
+                 Number of frames given to a worker at a time.
+                 Default is 8
+
+    Returns
+    -------
+    corr_image:    ndarray
+                   Mean of the undistorted frames
+    displacements: ndarray
+                   Shape is (frames, 2, GY, GX), the displacement as
+                   (y, x) of every frame at the patch centers, which
+                   can be expanded to every pixel with `warp_image`
+    centers:       tuple
+                   Y and X positions of the patch centers
+
+    Notes
+    -----
+    A single shift per frame cannot undo the scan line jitter and
+    the slow drift during the scan, which distort every frame
+    differently. Here, the frames are first aligned rigidly with
+    `drift_average`, whose mean is the first reference. Every frame
+    is then cut into overlapping Hann windowed patches around its
+    rigid shift, and every patch is registered to the same patch of
+    the reference with `util.dftregistration`. The displacements of
+    the patches are cleaned of outliers and smoothed, and
+    interpolated to one coordinate map per frame, with which the
+    frame is resampled once by `scipy.ndimage.map_coordinates`. The
+    mean of the undistorted frames is the reference of the next
+    iteration. Blocks of frames are processed in parallel worker
+    processes, which only return their patch displacements and the
+    sum of their undistorted frames, so the undistorted frames are
+    never held in memory together. A new block is only read from
+    the stack once fewer than twice `workers` blocks are in flight,
+    so a memory mapped or HDF5 stack is never read into memory
+    as a whole.
+
+    Examples
+    --------
+    >>> corr_image, displacements, centers = st.afit.nonrigid_average(movie)
+
+    See Also
+    --------
+    drift_average
+    patch_displacements
+    warp_image
+    """
+    no_im = int(image_stack.shape[0])
+    imshape = tuple(image_stack.shape[1:3])
+    patch_size = int(patch_size)
+    centers_y, centers_x = patch_grid(imshape, patch_size, int(step))
+    reference, shifts = st.afit.drift_average(image_stack, sampling)
+    offsets = np.round(-shifts).astype(int)
+    window = np.outer(np.hanning(patch_size), np.hanning(patch_size))
+    displacements = np.zeros(
+        (no_im, 2, len(centers_y), len(centers_x)), dtype=np.float64
+    )
+    chunk_size = int(max(chunk_size, 1))
+    starts = np.arange(0, no_im, chunk_size)
+    for _ in range(int(max(iterations, 1))):
+        ref_patches, _ = patch_stack(
+            reference, centers_y, centers_x, (0, 0), patch_size
+        )
+        ref_ft = np.fft.fft2(ref_patches * window, axes=(-2, -1))
+        common_args = (ref_ft, centers_y, centers_x)
+        job_args = (patch_size, sampling, smoothing)
+        warped_sum = np.zeros(imshape, dtype=np.float64)
+
+        def add_block(start, block):
+            displacements[start : start + len(block[0])] = block[0]
+            warped_sum[:, :] += block[1]
+
+        if workers > 1:
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers
+            ) as executor:
+                pending = {}
+                for start in starts:
+                    if len(pending) >= (2 * workers):
+                        done, _ = concurrent.futures.wait(
+                            pending, return_when=concurrent.futures.FIRST_COMPLETED
+                        )
+                        for future in done:
+                            add_block(pending.pop(future), future.result())
+                    future = executor.submit(
+                        nonrigid_frames,
+                        np.asarray(image_stack[start : start + chunk_size]),
+                        *common_args,
+                        offsets[start : start + chunk_size],
+                        *job_args,
+                    )
+                    pending[future] = start
+                for future in concurrent.futures.as_completed(pending):
+                    add_block(pending[future], future.result())
+        else:
+            for start in starts:
+                add_block(
+                    start,
+                    nonrigid_frames(
+                        np.asarray(image_stack[start : start + chunk_size]),
+                        *common_args,
+                        offsets[start : start + chunk_size],
+                        *job_args,
+                    ),
+                )
+        reference = warped_sum / no_im
+    return reference, displacements, (centers_y, centers_x)
+
@@ -1,3 +1,6 @@
 from .atomic_dpc import *
 from .nbed_dpc import *
 from .dpc_utils import *
+from .segmented_dpc import *
+from .progressive_dpc import *
+from .ssb_ptycho import *
@@ -128,6 +128,54 @@ class atomic_dpc(object):
         cbar = plt.colorbar(im, cax=ax_cbar, orientation="horizontal")
         cbar.set_label(r"$\mathrm{Beam\: Shift\: \left(pm^{-1}\right)}$", **sc_font)
 
+    def preview_dpc(self, levels=((8, 4), (4, 2), (2, 1), (1, 1)), background=True):
+        """
+        Start a progressive center of mass preview
+
+        Parameters
+        ----------
+        levels:     tuple, optional
+                    Sequence of (scan_step, detector_bin) pairs from
+                    the coarsest to the finest level
+        background: bool, optional
+                    Refine the finer levels in a background thread.
+                    Default is True
+
+        Returns
+        -------
+        preview: progressive_4D
+                 The running preview, whose `levels` attribute is
+                 filled in as the levels are finished
+
+        Notes
+        -----
+        The coarsest shifts are scaled to reciprocal picometers and
+        stored as `XCom` and `YCom` before this returns, so they can
+        be looked at or used with `correct_dpc` right away. Call
+        `finish_dpc` once the preview is done to replace them with
+        the full resolution shifts. `get_cbed` needs to be run first.
+        """
+        self.preview = st.dpc.progressive_4D(
+            self.data_4D,
+            levels=levels,
+            center=(self.beam_x, self.beam_y),
+            scan_first=True,
+        )
+        coarse = self.preview.start(background)
+        self.XCom = self.inverse * coarse["com_x"]
+        self.YCom = self.inverse * coarse["com_y"]
+        return self.preview
+
+    def finish_dpc(self, timeout=None):
+        """
+        Wait for the progressive preview and store the finest
+        center of mass shifts as `XCom` and `YCom`
+        """
+        finest = self.preview.wait(timeout)
+        self.XCom = self.inverse * finest["com_x"]
+        self.YCom = self.inverse * finest["com_y"]
+        return self.preview.done
+
     def correct_dpc(self, imsize=(30, 15)):
         flips = np.zeros(4, dtype=bool)
         flips[2:4] = True
@@ -0,0 +1,290 @@
+import numpy as np
+import threading
+
+
+def bin_detector(data4D, bin_factor):
+    """
+    Sum the diffraction dimensions of a 4D dataset in
+    square blocks
+
+    Parameters
+    ----------
+    data4D:     ndarray
+                4D dataset where the first two dimensions are the
+                diffraction dimensions and the last two dimensions
+                are the scan dimensions
+    bin_factor: int
+                Number of diffraction pixels along each axis that
+                are summed into one binned pixel
+
+    Returns
+    -------
+    binned_4D: ndarray
+               Dataset with the diffraction dimensions binned. Any
+               remainder pixels at the edges are cropped off.
+
+    Notes
+    -----
+    Unlike `nbed.bin4D` this is a pure reshape and sum, which is
+    what we want for previews - it never loops over scan positions.
+    """
+    bin_factor = int(bin_factor)
+    if bin_factor < 2:
+        return np.asarray(data4D, dtype=np.float64)
+    qy = int(data4D.shape[0] / bin_factor)
+    qx = int(data4D.shape[1] / bin_factor)
+    cropped = np.asarray(
+        data4D[0 : qy * bin_factor, 0 : qx * bin_factor, ...], dtype=np.float64
+    )
+    binned_4D = np.sum(
+        np.reshape(
+            cropped,
+            (qy, bin_factor, qx, bin_factor, data4D.shape[2], data4D.shape[3]),
+        ),
+        axis=(1, 3),
+    )
+    return binned_4D
+
+
+class progressive_4D(object):
+    """
+    Progressive multi-resolution preview of center of mass and
+    virtual detector images from a 4D-STEM dataset
+
+    Parameters
+    ----------
+    data4D:     ndarray
+                4D dataset, which can also be a memory mapped array
+                or a HDF5 dataset. By default the first two dimensions
+                are the diffraction dimensions and the last two
+                dimensions are the scan dimensions.
+    apertures:  list of tuples, optional
+                Virtual apertures as (center_x, center_y, radius) in
+                diffraction pixels. One virtual image is generated for
+                every aperture. Default is no apertures
+    levels:     tuple, optional
+                Sequence of (scan_step, detector_bin) pairs from the
+                coarsest to the finest level. Default is
+                ((8, 4), (4, 2), (2, 1), (1, 1))
+    center:     tuple, optional
+                Center of the unscattered beam as (x, y) in diffraction
+                pixels, with respect to which the center of mass is
+                calculated. If None, the center of mass of the mean
+                diffraction pattern of the coarsest level is used.
+    scan_first: bool, optional
+                Set to True if the first two dimensions of the dataset
+                are the scan dimensions. Default is False
+    chunk_size: int, optional
+                Number of subsampled scan rows processed at once.
+                Default is 16
+
+    Notes
+    -----
+    The coarsest level is calculated on a subsampled scan grid with a
+    binned detector, and is returned by `start` as soon as it is ready.
+    The finer levels are then calculated one after the other in a
+    background thread, and every finished level is appended to the
+    `levels` attribute, so intermediate previews can be inspected while
+    the full resolution result is being computed. Every level is a
+    dictionary with the scan step, the detector binning, the center of
+    mass shifts in diffraction pixels and the stack of virtual images.
+
+    Examples
+    --------
+    Run as:
+
+    >>> preview = st.dpc.progressive_4D(data4D, apertures=[(64, 64, 10)])
+    >>> coarse = preview.start()
+
+    Look at `coarse["com_x"]`, `coarse["com_y"]` and `coarse["virtual"]`
+    to decide if the dataset is worth analyzing. The latest available
+    level is always `preview.levels[-1]`, and to block till the full
+    resolution level is ready:
+
+    >>> full = preview.wait()
+    """
+
+    def __init__(
+        self,
+        data4D,
+        apertures=(),
+        levels=((8, 4), (4, 2), (2, 1), (1, 1)),
+        center=None,
+        scan_first=False,
+        chunk_size=16,
+    ):
+        self.data4D = data4D
+        self.apertures = [tuple(aperture) for aperture in apertures]
+        self.level_list = [(int(ll[0]), int(ll[1])) for ll in levels]
+        if len(self.level_list) == 0:
+            raise ValueError("At least one preview level is needed")
+        self.scan_first = scan_first
+        if scan_first:
+            self.det_shape = np.asarray(data4D.shape[2:4])
+            self.scan_shape = np.asarray(data4D.shape[0:2])
+        else:
+            self.det_shape = np.asarray(data4D.shape[0:2])
+            self.scan_shape = np.asarray(data4D.shape[2:4])
+        self.center = center
+        self.chunk_size = int(max(chunk_size, 1))
+        self.levels = []
+        self.error = None
+        self.worker = None
+
+    def read_rows(self, start, stop, scan_step):
+        """
+        Read a block of subsampled scan rows as a diffraction
+        first array
+        """
+        if self.scan_first:
+            block = np.asarray(
+                self.data4D[start:stop:scan_step, ::scan_step, :, :]
+            ).transpose((2, 3, 0, 1))
+        else:
+            block = np.asarray(self.data4D[:, :, start:stop:scan_step, ::scan_step])
+        return block
+
+    def compute_level(self, scan_step, det_bin):
+        """
+        Calculate the center of mass and virtual images for
+        a single level
+
+        Parameters
+        ----------
+        scan_step: int
+                   Step between the scan positions that are used
+        det_bin:   int
+                   Binning factor of the diffraction pattern
+
+        Returns
+        -------
+        level: dict
+               Dictionary with the keys `scan_step`, `det_bin`,
+               `com_x`, `com_y` and `virtual`
+        """
+        scan_step = int(max(scan_step, 1))
+        det_bin = int(max(det_bin, 1))
+        out_shape = np.ceil(self.scan_shape / scan_step).astype(int)
+        binned_shape = (self.det_shape / det_bin).astype(int)
+        # centers of the binned pixels in the original pixel units
+        qy = (np.arange(binned_shape[0]) * det_bin) + (0.5 * (det_bin - 1))
+        qx = (np.arange(binned_shape[1]) * det_bin) + (0.5 * (det_bin - 1))
+        yy, xx = np.meshgrid(qy, qx, indexing="ij")
+        masks = np.zeros(
+            (len(self.apertures), binned_shape[0], binned_shape[1]), dtype=np.float64
+        )
+        for ii, aperture in enumerate(self.apertures):
+            masks[ii, :, :] = (
+                ((yy - aperture[1]) ** 2) + ((xx - aperture[0]) ** 2)
+            ) <= (aperture[2] ** 2)
+        masks = np.reshape(
+            masks, (len(self.apertures), binned_shape[0] * binned_shape[1])
+        )
+        total = np.zeros(out_shape, dtype=np.float64)
+        sum_y = np.zeros(out_shape, dtype=np.float64)
+        sum_x = np.zeros(out_shape, dtype=np.float64)
+        virtual = np.zeros(
+            (len(self.apertures), out_shape[0], out_shape[1]), dtype=np.float64
+        )
+        mean_pattern = np.zeros(binned_shape, dtype=np.float64)
+        rows_per_chunk = self.chunk_size * scan_step
+        for start in range(0, int(self.scan_shape[0]), rows_per_chunk):
+            stop = int(min(start + rows_per_chunk, self.scan_shape[0]))
+            out_start = int(start / scan_step)
+            block = bin_detector(self.read_rows(start, stop, scan_step), det_bin)
+            out_stop = out_start + block.shape[2]
+            flat = np.reshape(block, (binned_shape[0] * binned_shape[1], -1))
+            mean_pattern += np.sum(block, axis=(-1, -2))
+            total[out_start:out_stop, :] = np.reshape(
+                np.sum(flat, axis=0), block.shape[2:4]
+            )
+            sum_y[out_start:out_stop, :] = np.reshape(
+                np.ravel(yy) @ flat, block.shape[2:4]
+            )
+            sum_x[out_start:out_stop, :] = np.reshape(
+                np.ravel(xx) @ flat, block.shape[2:4]
+            )
+            if len(self.apertures) > 0:
+                virtual[:, out_start:out_stop, :] = np.reshape(
+                    masks @ flat, (len(self.apertures),) + block.shape[2:4]
+                )
+        if self.center is None:
+            pattern_sum = np.sum(mean_pattern)
+            self.center = (
+                np.sum(xx * mean_pattern) / pattern_sum,
+                np.sum(yy * mean_pattern) / pattern_sum,
+            )
+        total[total == 0] = 1
+        level = {
+            "scan_step": scan_step,
+            "det_bin": det_bin,
+            "com_x": (sum_x / total) - self.center[0],
+            "com_y": (sum_y / total) - self.center[1],
+            "virtual": virtual,
+        }
+        return level
+
+    def refine_levels(self):
+        """
+        Calculate all the levels after the first one, in order
+        """
+        try:
+            for scan_step, det_bin in self.level_list[1:]:
+                self.levels.append(self.compute_level(scan_step, det_bin))
+        except Exception as err:
+            self.error = err
+
+    def start(self, background=True):
+        """
+        Calculate the coarsest level and start refining
+
+        Parameters
+        ----------
+        background: bool, optional
+                    If True, the finer levels are calculated in a
+                    background thread, else they are calculated before
+                    this method returns. Default is True
+
+        Returns
+        -------
+        level: dict
+               The coarsest preview level
+        """
+        self.levels = []
+        self.error = None
+        scan_step, det_bin = self.level_list[0]
+        self.levels.append(self.compute_level(scan_step, det_bin))
+        if background:
+            self.worker = threading.Thread(target=self.refine_levels, daemon=True)
+            self.worker.start()
+        else:
+            self.refine_levels()
+        return self.levels[0]
+
+    @property
+    def done(self):
+        """
+        True once every level has been calculated
+        """
+        return len(self.levels) == len(self.level_list)
+
+    def wait(self, timeout=None):
+        """
+        Block till the finest level has been calculated
+
+        Parameters
+        ----------
+        timeout: float, optional
+                 Maximum time in seconds to wait for. Default
+                 is None, which waits till completion
+
+        Returns
+        -------
+        level: dict
+               The finest level calculated so far
+        """
+        if self.worker is not None:
+            self.worker.join(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.levels[-1]
@@ -0,0 +1,224 @@
+import numpy as np
+import scipy.sparse as sps
+import stemtool as st
+
+
+def segment_operator(
+    det_shape,
+    det_inner,
+    det_outer,
+    segments=4,
+    rotation=0,
+    det_center=(0, 0),
+    mrad_calib=0,
+):
+    """
+    Generate the sparse detector operator for an annular
+    segmented detector
+
+    Parameters
+    ----------
+    det_shape:  tuple
+                Shape of the diffraction pattern as (Y, X)
+    det_inner:  float
+                Inner radius of the detector annulus
+    det_outer:  float
+                Outer radius of the detector annulus
+    segments:   int, optional
+                Number of azimuthal segments of the detector.
+                Default is 4, which is a quadrant detector
+    rotation:   float, optional
+                Rotation of the segment boundaries in degrees,
+                measured counter-clockwise from the X axis.
+                Default is 0
+    det_center: tuple, optional
+                Offset of the detector center from the center of
+                the diffraction pattern as (X, Y). Default is (0, 0)
+    mrad_calib: float, optional
+                Pixels per milliradian. If this is greater than 0, then
+                the radii and the center offset are taken to be in
+                milliradians. Default is 0
+
+    Returns
+    -------
+    operator:   scipy.sparse.csr_matrix
+                Sparse matrix of shape (segments, Y * X), where every
+                row is the flattened mask of one detector segment
+    seg_angles: ndarray
+                Azimuthal angle in radians of the center of every
+                segment
+
+    Notes
+    -----
+    Every diffraction pixel inside the annulus belongs to exactly one
+    segment, so the operator has only as many non-zero entries as there
+    are pixels on the detector. Operators for different detector
+    geometries can be stacked with `scipy.sparse.vstack` to image all of
+    them in a single pass through the data.
+
+    See Also
+    --------
+    segment_images
+    """
+    if mrad_calib > 0:
+        det_inner = det_inner * mrad_calib
+        det_outer = det_outer * mrad_calib
+        det_center = np.asarray(det_center) * mrad_calib
+    det_center = np.asarray(det_center, dtype=np.float64)
+    segments = int(segments)
+    yy, xx = np.mgrid[0 : det_shape[0], 0 : det_shape[1]]
+    yy = yy - (0.5 * det_shape[0]) - det_center[1]
+    xx = xx - (0.5 * det_shape[1]) - det_center[0]
+    rr = ((yy ** 2) + (xx ** 2)) ** 0.5
+    phi = np.mod(np.arctan2(yy, xx) - np.deg2rad(rotation), 2 * np.pi)
+    seg_no = np.floor(phi / ((2 * np.pi) / segments)).astype(int)
+    seg_no[seg_no == segments] = segments - 1
+    on_detector = np.ravel(np.logical_and((rr >= det_inner), (rr <= det_outer)))
+    columns = np.arange(rr.size)[on_detector]
+    rows = np.ravel(seg_no)[on_detector]
+    operator = sps.csr_matrix(
+        (np.ones(columns.size, dtype=np.float64), (rows, columns)),
+        shape=(segments, rr.size),
+    )
+    seg_angles = np.deg2rad(rotation) + (
+        (np.arange(segments) + 0.5) * ((2 * np.pi) / segments)
+    )
+    return operator, seg_angles
+
+
+def segment_images(data4D, operator, chunk_size=16):
+    """
+    Image every segment of a sparse detector operator
+
+    Parameters
+    ----------
+    data4D:     ndarray
+                The 4 dimensional dataset that will be analyzed
+                The first two dimensions are the Fourier space
+                diffraction dimensions and the last two dimensions
+                are the real space scanning dimensions
+    operator:   scipy.sparse matrix
+                Detector operator of shape (segments, Y * X)
+    chunk_size: int, optional
+                Number of scan rows read from the dataset at once.
+                Default is 16
+
+    Returns
+    -------
+    seg_images: ndarray
+                Images of shape (segments, scan Y, scan X) where each
+                image is the signal recorded on one segment
+
+    Notes
+    -----
+    The scan rows are read in chunks, and the diffraction patterns
+    of every chunk are flattened into a dense (Y * X, positions)
+    matrix. All the segment images of the chunk are then obtained from
+    a single sparse-dense matrix multiplication. This works equally well
+    on memory mapped or HDF5 backed datasets since only one chunk is
+    ever held in memory.
+
+    See Also
+    --------
+    segment_operator
+    """
+    data_shape = np.asarray(data4D.shape)
+    no_pixels = int(data_shape[0] * data_shape[1])
+    if operator.shape[1] != no_pixels:
+        raise ValueError("Detector operator does not match the diffraction pattern")
+    chunk_size = int(max(chunk_size, 1))
+    seg_images = np.zeros(
+        (operator.shape[0], data_shape[2], data_shape[3]), dtype=np.float64
+    )
+    for start in range(0, int(data_shape[2]), chunk_size):
+        stop = int(min(start + chunk_size, data_shape[2]))
+        chunk = np.reshape(
+            np.asarray(data4D[:, :, start:stop, :], dtype=np.float64), (no_pixels, -1)
+        )
+        seg_images[:, start:stop, :] = np.reshape(
+            operator @ chunk, (operator.shape[0], stop - start, data_shape[3])
+        )
+    return seg_images
+
+
+def segmented_dpc(
+    data4D,
+    det_inner,
+    det_outer,
+    segments=4,
+    rotation=0,
+    det_center=(0, 0),
+    mrad_calib=0,
+    chunk_size=16,
+):
+    """
+    Emulate a segmented DPC detector on a 4D-STEM dataset
+
+    Parameters
+    ----------
+    data4D:     ndarray
+                The 4 dimensional dataset that will be analyzed
+                The first two dimensions are the Fourier space
+                diffraction dimensions and the last two dimensions
+                are the real space scanning dimensions
+    det_inner:  float
+                Inner radius of the detector annulus
+    det_outer:  float
+                Outer radius of the detector annulus
+    segments:   int, optional
+                Number of azimuthal segments. Default is 4
+    rotation:   float, optional
+                Rotation of the segment boundaries in degrees.
+                Default is 0
+    det_center: tuple, optional
+                Offset of the detector center from the center of
+                the diffraction pattern as (X, Y). Default is (0, 0)
+    mrad_calib: float, optional
+                Pixels per milliradian. Default is 0, when the radii
+                are in pixels
+    chunk_size: int, optional
+                Number of scan rows read from the dataset at once.
+                Default is 16
+
+    Returns
+    -------
+    seg_images: ndarray
+                Images of shape (segments, scan Y, scan X) recorded
+                by every detector segment
+    dpc_x:      ndarray
+                Normalized differential signal along X
+    dpc_y:      ndarray
+                Normalized differential signal along Y
+    potential:  ndarray
+                Integrated DPC signal
+
+    Notes
+    -----
+    The differential signals are the segment images weighted by the
+    cosine and sine of the segment center angles, normalized by the
+    total signal on the detector. For a quadrant detector this is
+    the familiar (A + D) - (B + C) difference signal. The differential
+    signals are then integrated with `integrate_dpc`.
+
+    See Also
+    --------
+    segment_operator
+    segment_images
+    integrate_dpc
+    """
+    operator, seg_angles = segment_operator(
+        data4D.shape[0:2],
+        det_inner,
+        det_outer,
+        segments,
+        rotation,
+        det_center,
+        mrad_calib,
+    )
+    seg_images = segment_images(data4D, operator, chunk_size)
+    total = np.sum(seg_images, axis=0)
+    total[total == 0] = 1
+    dpc_x = np.einsum("i,ijk->jk", np.cos(seg_angles), seg_images) / total
+    dpc_y = np.einsum("i,ijk->jk", np.sin(seg_angles), seg_images) / total
+    potential = st.dpc.integrate_dpc(dpc_x, dpc_y)
+    return seg_images, dpc_x, dpc_y, potential
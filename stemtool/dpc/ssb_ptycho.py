@@ -0,0 +1,275 @@
+import numpy as np
+import scipy.sparse as sps
+import pyfftw.interfaces as pfi
+import concurrent.futures
+import stemtool as st
+
+
+def bright_field_pixels(det_shape, beam_center, beam_radius):
+    """
+    Find the diffraction pixels inside the bright field disk
+
+    Parameters
+    ----------
+    det_shape:   tuple
+                 Shape of the diffraction pattern as (Y, X)
+    beam_center: tuple
+                 Center of the unscattered beam as (X, Y)
+    beam_radius: float
+                 Radius of the bright field disk in pixels
+
+    Returns
+    -------
+    bf_y: ndarray
+          Y pixel index of every bright field pixel
+    bf_x: ndarray
+          X pixel index of every bright field pixel
+
+    Notes
+    -----
+    The pixels are returned in row major order, so consecutive
+    pixels come from consecutive detector rows.
+    """
+    yy, xx = np.mgrid[0 : det_shape[0], 0 : det_shape[1]]
+    rr = (((yy - beam_center[1]) ** 2) + ((xx - beam_center[0]) ** 2)) ** 0.5
+    inside = rr <= beam_radius
+    return yy[inside], xx[inside]
+
+
+def ssb_weights(
+    kx, ky, scan_shape, scan_calib, alpha, wavelength, defocus=0, c3=0, c5=0
+):
+    """
+    Precompute the single sideband weights for every bright field
+    pixel and every scan spatial frequency
+
+    Parameters
+    ----------
+    kx:         ndarray
+                X coordinate of every bright field pixel in inverse
+                angstroms, with respect to the beam center
+    ky:         ndarray
+                Y coordinate of every bright field pixel in inverse
+                angstroms, with respect to the beam center
+    scan_shape: tuple
+                Shape of the scan as (Y, X)
+    scan_calib: float
+                Scan step size in angstroms
+    alpha:      float
+                Probe convergence semi-angle in inverse angstroms
+    wavelength: float
+                Electron wavelength in angstroms
+    defocus:    float, optional
+                Defocus in angstroms. Default is 0
+    c3:         float, optional
+                Spherical aberration in mm. Default is 0
+    c5:         float, optional
+                Fifth order spherical aberration in mm. Default is 0
+
+    Returns
+    -------
+    weights: scipy.sparse.csr_matrix
+             Complex matrix of shape (bright field pixels, Y * X)
+
+    Notes
+    -----
+    For every scan spatial frequency Q, a bright field pixel k only
+    contributes to the single sideband sum if it lies in the left
+    double overlap region (the trotter) between the central disk and
+    the disk shifted by Q, and not in the disk shifted by -Q.
+    The weight there cancels the aberration phase difference between
+    k and k - Q, so the contributions of all pixels add up in phase. The pixels outside the trotter carry no phase
+    information and are left out of the sparse matrix. At Q = 0 every
+    bright field pixel is given a unit weight so that the zero
+    frequency gets the mean bright field intensity.
+
+    References
+    ----------
+    Pennycook, T.J., Lupini, A.R., Yang, H., Murfitt, M.F., Jones, L.
+    and Nellist, P.D., 2015. Efficient phase contrast imaging in STEM
+    using a pixelated detector. Part 1: Experimental demonstration at
+    atomic resolution. Ultramicroscopy, 151, pp.160-167.
+    """
+    qy = np.fft.fftfreq(scan_shape[0], scan_calib)
+    qx = np.fft.fftfreq(scan_shape[1], scan_calib)
+    qyy, qxx = np.meshgrid(qy, qx, indexing="ij")
+    qyy = np.ravel(qyy)
+    qxx = np.ravel(qxx)
+    chi_k = st.sim.aberration(
+        ((kx ** 2) + (ky ** 2)) ** 0.5, wavelength, defocus, c3, c5
+    )
+    rows = []
+    columns = []
+    values = []
+    for ii in range(len(kx)):
+        kmq = (((kx[ii] - qxx) ** 2) + ((ky[ii] - qyy) ** 2)) ** 0.5
+        kpq = (((kx[ii] + qxx) ** 2) + ((ky[ii] + qyy) ** 2)) ** 0.5
+        trotter = np.where(np.logical_and(kmq <= alpha, kpq > alpha))[0]
+        chi_kmq = st.sim.aberration(kmq[trotter], wavelength, defocus, c3, c5)
+        rows.append(np.full(trotter.size + 1, ii))
+        columns.append(np.append(trotter, 0))
+        values.append(np.append(np.exp(-1j * (chi_k[ii] - chi_kmq)), 1))
+    weights = sps.csr_matrix(
+        (np.concatenate(values), (np.concatenate(rows), np.concatenate(columns))),
+        shape=(len(kx), scan_shape[0] * scan_shape[1]),
+        dtype=np.complex128,
+    )
+    return weights
+
+
+def ssb_chunk(data4D, bf_y, bf_x, weights, start, stop):
+    """
+    Single sideband sum from a contiguous block of bright field pixels
+
+    Parameters
+    ----------
+    data4D:  ndarray
+             The 4 dimensional dataset, diffraction dimensions first
+    bf_y:    ndarray
+             Y pixel index of every bright field pixel
+    bf_x:    ndarray
+             X pixel index of every bright field pixel
+    weights: scipy.sparse.csr_matrix
+             Precomputed single sideband weights
+    start:   int
+             First bright field pixel of the block
+    stop:    int
+             One past the last bright field pixel of the block
+
+    Returns
+    -------
+    psi_chunk: ndarray
+               Contribution of the block to the flattened Fourier
+               transform of the object wave
+    """
+    row_start = int(bf_y[start])
+    row_stop = int(bf_y[stop - 1]) + 1
+    block = np.asarray(data4D[row_start:row_stop, :, :, :], dtype=np.float64)
+    intensity = block[bf_y[start:stop] - row_start, bf_x[start:stop], :, :]
+    g_chunk = pfi.numpy_fft.fft2(intensity, axes=(-2, -1))
+    g_chunk = np.reshape(g_chunk, (stop - start, -1))
+    psi_chunk = np.asarray(
+        weights[start:stop, :].multiply(g_chunk).sum(axis=0)
+    ).ravel()
+    return psi_chunk
+
+
+def ssb_ptycho(
+    data4D,
+    scan_calib,
+    aperture,
+    voltage,
+    beam_center=None,
+    beam_radius=None,
+    defocus=0,
+    c3=0,
+    c5=0,
+    chunk_size=256,
+    workers=1,
+):
+    """
+    Single sideband ptychographic phase reconstruction
+
+    Parameters
+    ----------
+    data4D:      ndarray
+                 The 4 dimensional dataset that will be analyzed
+                 The first two dimensions are the Fourier space
+                 diffraction dimensions and the last two dimensions
+                 are the real space scanning dimensions. This can
+                 also be a memory mapped array or a HDF5 dataset.
+    scan_calib:  float
+                 Scan step size in angstroms
+    aperture:    float
+                 Probe convergence semi-angle in milliradians
+    voltage:     float
+                 Accelerating voltage in kV
+    beam_center: tuple, optional
+                 Center of the bright field disk as (X, Y) in pixels.
+                 If None, it is found from the mean diffraction pattern
+    beam_radius: float, optional
+                 Radius of the bright field disk in pixels. If None,
+                 it is found from the mean diffraction pattern
+    defocus:     float, optional
+                 Defocus in angstroms. Default is 0
+    c3:          float, optional
+                 Spherical aberration in mm. Default is 0
+    c5:          float, optional
+                 Fifth order spherical aberration in mm. Default is 0
+    chunk_size:  int, optional
+                 Number of bright field pixels transformed at once.
+                 Default is 256
+    workers:     int, optional
+                 Number of threads working on separate chunks.
+                 Default is 1
+
+    Returns
+    -------
+    phase: ndarray
+           Reconstructed phase of the object
+    psi:   ndarray
+           Fourier transform of the reconstructed object wave
+
+    Notes
+    -----
+    Only the bright field pixels contribute to the single sideband
+    reconstruction, and they are processed in chunks of detector
+    pixels. Every chunk is Fourier transformed along the scan
+    dimensions, multiplied with the precomputed sparse trotter weights
+    and summed over the detector pixels, so the complex Fourier
+    transform of the full 4D dataset is never held in memory. The
+    chunks are independent of each other and are processed in parallel,
+    and their sums are added together to give the Fourier transform of
+    the object, whose inverse Fourier transform gives the phase.
+
+    See Also
+    --------
+    ssb_weights
+    sim.aberration
+    """
+    det_shape = data4D.shape[0:2]
+    scan_shape = data4D.shape[2:4]
+    if (beam_center is None) or (beam_radius is None):
+        mean_cbed = np.zeros(det_shape, dtype=np.float64)
+        for ii in range(scan_shape[0]):
+            mean_cbed += np.sum(
+                np.asarray(data4D[:, :, ii, :], dtype=np.float64), axis=-1
+            )
+        found_x, found_y, found_r = st.util.sobel_circle(mean_cbed)
+        if beam_center is None:
+            beam_center = (found_x, found_y)
+        if beam_radius is None:
+            beam_radius = found_r
+    wavelength = st.sim.wavelength_ang(voltage)
+    alpha = (aperture / 1000) / wavelength
+    det_calib = alpha / beam_radius
+    bf_y, bf_x = bright_field_pixels(det_shape, beam_center, beam_radius)
+    if len(bf_y) == 0:
+        raise RuntimeError("No diffraction pixels inside the bright field disk")
+    kx = (bf_x - beam_center[0]) * det_calib
+    ky = (bf_y - beam_center[1]) * det_calib
+    weights = ssb_weights(
+        kx, ky, scan_shape, scan_calib, alpha, wavelength, defocus, c3, c5
+    )
+    chunk_size = int(max(chunk_size, 1))
+    starts = np.arange(0, len(bf_y), chunk_size)
+    psi = np.zeros(scan_shape[0] * scan_shape[1], dtype=np.complex128)
+    pfi.cache.enable()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                ssb_chunk,
+                data4D,
+                bf_y,
+                bf_x,
+                weights,
+                start,
+                min(start + chunk_size, len(bf_y)),
+            )
+            for start in starts
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            psi += future.result()
+    psi = np.reshape(psi, scan_shape)
+    phase = np.angle(pfi.numpy_fft.ifft2(psi))
+    return phase, psi
@@ -1,43 +1,117 @@
 import numpy as np
 import pywt
-import numba
-import scipy.optimize as spo
+import concurrent.futures
+import scipy.ndimage as scnd
 import scipy.signal as scisig
 import matplotlib.pyplot as plt
 import matplotlib as mpl
 
 
-def cleanEELS_wavelet(data, threshold):
+def cleanEELS_wavelet(data, threshold, axis=0):
+    """
+    Wavelet denoising of EELS spectra
+
+    Parameters
+    ----------
+    data:      ndarray
+               Spectrum, or spectra with the energy along
+               axis
+    threshold: float
+               Detail coefficients are soft thresholded at
+               this fraction of their maximum in every
+               spectrum
+    axis:      int, optional
+               Energy axis. Default is 0
+
+    Returns
+    -------
+    data2: ndarray
+           Denoised spectra, of the same shape as data
+
+    Notes
+    -----
+    The spectra are decomposed with the sym4 wavelet to the
+    deepest level their length allows, and all the spectra
+    are decomposed and rebuilt together along the energy axis.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    no_points = data.shape[axis]
     wave = pywt.Wavelet("sym4")
-    max_level = pywt.dwt_max_level(len(data), wave.dec_len)
-    coeffs = pywt.wavedec(data, "sym4", level=max_level)
-    coeffs2 = coeffs
-    threshold = 0.1
-    for ii in numba.prange(1, len(coeffs)):
-        coeffs2[ii] = pywt.threshold(coeffs[ii], threshold * np.amax(coeffs[ii]))
-    data2 = pywt.waverec(coeffs2, "sym4")
-    return data2
+    max_level = pywt.dwt_max_level(no_points, wave.dec_len)
+    coeffs = pywt.wavedec(data, wave, level=max_level, axis=axis)
+    for ii in range(1, len(coeffs)):
+        coeffs[ii] = pywt.threshold(
+            coeffs[ii], threshold * np.amax(coeffs[ii], axis=axis, keepdims=True)
+        )
+    data2 = pywt.waverec(coeffs, wave, axis=axis)
+    return np.take(data2, np.arange(no_points), axis=axis)
 
 
-def cleanEELS_3D(data3D, method, threshold=0):
+def cleanEELS_3D(data3D, method, threshold=0, workers=1, chunk_size=16):
+    """
+    Denoise every spectrum of a spectrum image
+
+    Parameters
+    ----------
+    data3D:     ndarray
+                Spectrum image, with the energy along the
+                first axis, which can be a memory mapped
+                array
+    method:     str
+                "wavelet" or "median"
+    threshold:  float, optional
+                Wavelet threshold of `cleanEELS_wavelet`, or
+                the length of the median filter along the
+                energy. Default is 0, upon which the data
+                is returned as it is
+    workers:    int, optional
+                Number of threads. Default is 1
+    chunk_size: int, optional
+                Number of scan rows denoised together.
+                Default is 16
+
+    Returns
+    -------
+    cleaned_3D: ndarray
+                Denoised spectrum image
+
+    Notes
+    -----
+    The spectrum image is cut into chunks of scan rows, and
+    every chunk is denoised along the energy axis in one call,
+    with the wavelet decomposition of `cleanEELS_wavelet` or
+    `scipy.ndimage.median_filter` with a footprint that only
+    spans the energy axis. The median filter pads the spectra
+    with zeros, like `scipy.signal.medfilt`. The chunks are
+    read and denoised in a thread pool, so only the chunks in
+    flight of a memory mapped spectrum image are in memory.
+    """
+    if method not in ("wavelet", "median"):
+        raise ValueError("method must be wavelet or median")
+    if threshold <= 0:
+        return data3D
     data_shape = np.asarray(np.shape(data3D)).astype(int)
     cleaned_3D = np.zeros(data_shape)
-    if method == "wavelet":
-        if threshold > 0:
-            for ii in range(data_shape[2]):
-                for jj in range(data_shape[1]):
-                    cleaned_3D[:, jj, ii] = cleanEELS_wavelet(
-                        data3D[:, jj, ii], threshold
-                    )
-        else:
-            cleaned_3D = data3D
-    if method == "median":
-        if threshold > 0:
-            for ii in range(data_shape[2]):
-                for jj in range(data_shape[1]):
-                    cleaned_3D[:, jj, ii] = scisig.medfilt(data3D[:, jj, ii], threshold)
+    footprint = np.ones((int(threshold), 1, 1), dtype=bool)
+
+    def clean_rows(start):
+        chunk = np.asarray(data3D[:, start : start + chunk_size, :], dtype=np.float64)
+        if method == "wavelet":
+            cleaned = cleanEELS_wavelet(chunk, threshold, axis=0)
         else:
-            cleaned_3D = data3D
+            cleaned = scnd.median_filter(
+                chunk, footprint=footprint, mode="constant", cval=0
+            )
+        cleaned_3D[:, start : start + chunk_size, :] = cleaned
+
+    chunk_size = int(max(chunk_size, 1))
+    starts = range(0, data_shape[1], chunk_size)
+    if workers > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(clean_rows, starts))
+    else:
+        for start in starts:
+            clean_rows(start)
     return cleaned_3D
 
 
@@ -159,42 +233,187 @@ def region_intensity(xdata, ydata, xrange, peak_range, showdata=True):
     return peak_sum
 
 
-@numba.jit
+def energy_index(xdata, energy):
+    """
+    Array indices of energy values
+
+    Parameters
+    ----------
+    xdata:  ndarray
+            energy values in electron-volts
+    energy: ndarray
+            energy values to be located in electron
+            volts, of any shape
+
+    Returns
+    -------
+    index: ndarray
+           Index of every energy value in xdata, with
+           the same shape as energy
+    """
+    step = np.median(np.diff(xdata))
+    return ((np.asarray(energy) - np.amin(xdata)) / step).astype(int)
+
+
+def local_average(data3D, radius):
+    """
+    Average of every spectrum with its neighbors
+
+    Parameters
+    ----------
+    data3D: ndarray
+            Spectrum image, with the energy along the
+            first axis
+    radius: float
+            Radius of the disk of scan positions that
+            are averaged together
+
+    Returns
+    -------
+    averaged: ndarray
+              Mean of the spectra within radius of every
+              scan position
+
+    Notes
+    -----
+    The disk averages of all the scan positions are
+    one convolution of every energy slice with a disk
+    kernel, which is done with FFTs over the two scan
+    axes. Near the edges of the scan, only the scan
+    positions inside the scan are averaged, so the sum
+    is divided by the number of such positions.
+    """
+    reach = int(np.floor(radius))
+    yy, xx = np.mgrid[-reach : (reach + 1), -reach : (reach + 1)]
+    disk = ((yy ** 2) + (xx ** 2) <= (radius ** 2)).astype(np.float64)
+    counts = scisig.fftconvolve(np.ones(data3D.shape[1:3]), disk, mode="same")
+    summed = scisig.fftconvolve(
+        np.asarray(data3D, dtype=np.float64), disk[None, :, :], mode="same", axes=(1, 2)
+    )
+    return summed / np.round(counts)[None, :, :]
+
+
+def powerlaw_fit_3D(xdata, ydata):
+    """
+    Power Law Fitting of every spectrum of a spectrum image
+
+    Parameters
+    ----------
+    xdata: ndarray
+           energy values in electron-volts of the fitting
+           region
+    ydata: ndarray
+           intensity values in A.U. of the fitting region,
+           with the energy along the first axis
+
+    Returns
+    -------
+    power: ndarray
+           The power term of every spectrum
+    const: ndarray
+           Constant of multiplication of every spectrum
+
+    Notes
+    -----
+    This is the same fit as `powerlaw_fit`, a straight line
+    in log-log space through the positive intensity values,
+    but the least squares line has a closed form, so the
+    sums it needs are taken along the energy axis for all
+    the spectra at once.
+
+    See Also
+    --------
+    powerlaw_fit
+    """
+    xlog = np.reshape(np.log(xdata), (-1,) + ((1,) * (np.ndim(ydata) - 1)))
+    valid = ydata > 0
+    ylog = np.where(valid, np.log(np.where(valid, ydata, 1)), 0)
+    no_points = np.sum(valid, axis=0)
+    sum_x = np.sum(np.where(valid, xlog, 0), axis=0)
+    sum_y = np.sum(ylog, axis=0)
+    sum_xx = np.sum(np.where(valid, xlog ** 2, 0), axis=0)
+    sum_xy = np.sum(ylog * xlog, axis=0)
+    power = ((no_points * sum_xy) - (sum_x * sum_y)) / (
+        (no_points * sum_xx) - (sum_x ** 2)
+    )
+    const = np.exp((sum_y - (power * sum_x)) / no_points)
+    return power, const
+
+
 def eels_3D(eels_dict, fit_range, peak_range, LBA_radius=3):
-    fit_range = np.asarray(fit_range)
-    peak_range = np.asarray(peak_range)
+    """
+    Background subtracted elemental maps from a
+    spectrum image
+
+    Parameters
+    ----------
+    eels_dict:  dict
+                Spectrum image dictionary, with the data
+                in "data" with the energy along the first
+                axis, and the energy calibration in
+                "pixelOrigin" and "pixelSize"
+    fit_range:  ndarray
+                Starting and stopping energy values of the
+                power law fit for every element
+    peak_range: ndarray
+                Starting and stopping energy values of the
+                edge of every element
+    LBA_radius: float, optional
+                Radius of the local background average.
+                Default is 3
+
+    Returns
+    -------
+    peak_values:          ndarray
+                          Background subtracted intensity of
+                          every element at every scan position
+    elemental_subtracted: ndarray
+                          Background subtracted spectra for
+                          every element
+
+    Notes
+    -----
+    The background of every spectrum is a power law, which
+    is fitted to the mean of the spectra within LBA_radius
+    of it to keep the fit stable in noisy data. The local
+    averages are one convolution of the spectrum image with
+    a disk, only over the energies of the fitting region,
+    and the power laws of all the spectra are fitted at once
+    in log-log space. The energy indices are found once for
+    every element.
+
+    See Also
+    --------
+    local_average
+    powerlaw_fit_3D
+    """
+    fit_range = np.reshape(np.asarray(fit_range), (-1, 2))
+    peak_range = np.reshape(np.asarray(peak_range), (-1, 2))
     no_elements = len(peak_range)
-    eels_array = eels_dict["data"]
+    eels_array = np.asarray(eels_dict["data"], dtype=np.float64)
     elemental_subtracted = np.zeros(
         (eels_array.shape[0], eels_array.shape[1], eels_array.shape[2], no_elements),
         dtype=np.float64,
     )
-    yy, xx = np.mgrid[0 : eels_array.shape[1], 0 : eels_array.shape[2]]
     xdata = (np.arange(eels_array.shape[0]) - eels_dict["pixelOrigin"][0]) * eels_dict[
         "pixelSize"
     ][0]
     peak_values = np.zeros(
         (eels_array.shape[-2], eels_array.shape[-1], no_elements), dtype=np.float64
     )
-    for ii in range(eels_array.shape[-2]):
-        for jj in range(eels_array.shape[-1]):
-            for qq in range(no_elements):
-                eels_data = eels_array[:, ii, jj]
-                fit_points = fit_range[qq, :]
-                peak_point = peak_range[qq, :]
-                lbi = ((yy - ii) ** 2) + ((xx - jj) ** 2) <= LBA_radius ** 2
-                eels_lbi = np.mean(eels_array[:, lbi], axis=-1)
-                bg, _, _ = powerlaw_fit(xdata, eels_lbi, fit_points)
-                subtracted_data = eels_data - bg
-                elemental_subtracted[:, ii, jj, qq] = subtracted_data
-                start_val = np.int(
-                    (peak_point[0] - np.amin(xdata)) / (np.median(np.diff(xdata)))
-                )
-                stop_val = np.int(
-                    (peak_point[1] - np.amin(xdata)) / (np.median(np.diff(xdata)))
-                )
-                peak_sum = np.sum(subtracted_data[start_val:stop_val])
-                peak_values[ii, jj, qq] = peak_sum
+    fit_index = energy_index(xdata, fit_range)
+    peak_index = energy_index(xdata, peak_range)
+    for qq in range(no_elements):
+        start_val, stop_val = fit_index[qq, :]
+        eels_lbi = local_average(eels_array[start_val:stop_val], LBA_radius)
+        power, const = powerlaw_fit_3D(xdata[start_val:stop_val], eels_lbi)
+        elemental_subtracted[:, :, :, qq] = eels_array - (
+            const[None, :, :] * (xdata[:, None, None] ** power[None, :, :])
+        )
+        start_val, stop_val = peak_index[qq, :]
+        peak_values[:, :, qq] = np.sum(
+            elemental_subtracted[start_val:stop_val, :, :, qq], axis=0
+        )
     return peak_values, elemental_subtracted
 
 
@@ -203,95 +422,350 @@ def lcpl(xx, c1, p1, c2, p2):
     return yy
 
 
-@numba.jit
-def eels_3D_LCPL(eels_dict, fit_range, peak_range, LBA_radius=3, percentile=5):
-    fit_range = np.asarray(fit_range)
-    peak_range = np.asarray(peak_range)
+def lcpl_fused(xx, c1, p1, c2, p2):
+    """
+    Values and analytic Jacobian of the linear combination
+    of power laws from a single evaluation
+
+    Parameters
+    ----------
+    xx: ndarray
+        energy values in electron-volts
+    c1: ndarray
+        Constant of multiplication of the first power law
+    p1: ndarray
+        The power term of the first power law
+    c2: ndarray
+        Constant of multiplication of the second power law
+    p2: ndarray
+        The power term of the second power law
+
+    Returns
+    -------
+    yy:       ndarray
+              The background at the energy values
+    jacobian: ndarray
+              Derivatives of the background with respect to
+              the four parameters, stacked along the first axis
+
+    See Also
+    --------
+    lcpl
+    """
+    xlog = np.log(xx)
+    term1 = xx ** p1
+    term2 = xx ** p2
+    yy = (c1 * term1) + (c2 * term2)
+    jacobian = np.empty((4,) + np.shape(yy), dtype=np.float64)
+    jacobian[0] = term1
+    jacobian[1] = c1 * term1 * xlog
+    jacobian[2] = term2
+    jacobian[3] = c2 * term2 * xlog
+    return yy, jacobian
+
+
+def fit_lcpl_batch(xdata, ydata, initial, lower, upper, tol_val=0.0001, max_iter=50):
+    """
+    Fit the linear combination of power laws to many
+    spectra at once
+
+    Parameters
+    ----------
+    xdata:    ndarray
+              energy values in electron-volts, of shape (P,)
+    ydata:    ndarray
+              intensity values of shape (N, P)
+    initial:  ndarray
+              Starting parameters of shape (N, 4), in the order
+              of `lcpl`
+    lower:    ndarray
+              Lower bounds of the parameters, of shape (N, 4)
+    upper:    ndarray
+              Upper bounds of the parameters, of shape (N, 4)
+    tol_val:  float, optional
+              Relative tolerance of the cost and the parameters.
+              Default is 0.0001
+    max_iter: int, optional
+              Maximum number of iterations. Default is 50
+
+    Returns
+    -------
+    popt: ndarray
+          Fitted parameters of shape (N, 4)
+
+    Notes
+    -----
+    This is the Levenberg-Marquardt solver of
+    `util.fit_gaussian2D_batch` for the `lcpl` model. Every
+    iteration takes the analytic Jacobians of all the spectra
+    from `lcpl_fused`, solves the N damped 4x4 normal equations
+    with one batched call, clips the steps to the bounds, and
+    accepts or rejects the step of every spectrum separately.
+    The damping is scaled by the diagonal of the normal
+    equations, so the very different scales of the constants
+    and the powers don't matter. The model is linear in the
+    two constants, and when the two powers are close the two
+    power laws are nearly collinear, which stalls plain
+    Levenberg-Marquardt steps in a long narrow valley. So
+    after every step, the constants are also solved for
+    directly from a 2x2 linear system and clipped to the
+    bounds. When one constant is clipped, the other one is
+    solved for again with the clipped one held fixed, and
+    whichever of these parameter sets fits best is kept.
+    Spectra that have converged drop out of the following
+    iterations.
+
+    See Also
+    --------
+    lcpl_fused
+    util.fit_gaussian2D_batch
+    """
+    xdata = np.asarray(xdata, dtype=np.float64)
+    ydata = np.asarray(ydata, dtype=np.float64)
+    lower = np.asarray(lower, dtype=np.float64)
+    upper = np.asarray(upper, dtype=np.float64)
+    popt = np.clip(np.asarray(initial, dtype=np.float64), lower, upper)
+
+    def residuals(sel, params, jacobian=False):
+        params = tuple(params[:, ii : (ii + 1)] for ii in range(4))
+        if not jacobian:
+            return lcpl(xdata[None, :], *params) - ydata[sel]
+        yy, jac = lcpl_fused(xdata[None, :], *params)
+        return yy - ydata[sel], np.transpose(jac, (1, 0, 2))
+
+    def linear_constants(sel, params):
+        term1 = xdata[None, :] ** params[:, 1:2]
+        term2 = xdata[None, :] ** params[:, 3:4]
+        s11 = np.sum(term1 ** 2, axis=1)
+        s12 = np.sum(term1 * term2, axis=1)
+        s22 = np.sum(term2 ** 2, axis=1)
+        s1y = np.sum(term1 * ydata[sel], axis=1)
+        s2y = np.sum(term2 * ydata[sel], axis=1)
+        det = (s11 * s22) - (s12 ** 2)
+        joint = np.copy(params)
+        joint[:, 0] = ((s22 * s1y) - (s12 * s2y)) / det
+        joint[:, 2] = ((s11 * s2y) - (s12 * s1y)) / det
+        joint = np.clip(joint, lower[sel], upper[sel])
+        first = np.copy(joint)
+        first[:, 2] = (s2y - (s12 * first[:, 0])) / s22
+        second = np.copy(joint)
+        second[:, 0] = (s1y - (s12 * second[:, 2])) / s11
+        return [
+            np.where(np.isfinite(solved), solved, params)
+            for solved in (
+                joint,
+                np.clip(first, lower[sel], upper[sel]),
+                np.clip(second, lower[sel], upper[sel]),
+            )
+        ]
+
+    def best_of(sel, params):
+        res = residuals(sel, params)
+        cost = np.sum(res ** 2, axis=1)
+        for solved in linear_constants(sel, params):
+            res_s = residuals(sel, solved)
+            cost_s = np.sum(res_s ** 2, axis=1)
+            use_s = cost_s < cost
+            params = np.where(use_s[:, None], solved, params)
+            res = np.where(use_s[:, None], res_s, res)
+            cost = np.where(use_s, cost_s, cost)
+        return params, res, cost
+
+    all_sets = np.arange(len(popt))
+    popt, res, cost = best_of(all_sets, popt)
+    damping = np.full(len(popt), 1e-03, dtype=np.float64)
+    active = np.ones(len(popt), dtype=bool)
+    diag = np.arange(4)
+    for _ in range(max_iter):
+        sel = all_sets[active]
+        if len(sel) == 0:
+            break
+        params = popt[sel]
+        res_sel, jacobian = residuals(sel, params, True)
+        jtj = np.matmul(jacobian, np.transpose(jacobian, (0, 2, 1)))
+        jtr = np.matmul(jacobian, res_sel[:, :, None])
+        lhs = np.copy(jtj)
+        lhs[:, diag, diag] += (damping[sel, None] * jtj[:, diag, diag]) + 1e-30
+        delta = -np.linalg.solve(lhs, jtr)[:, :, 0]
+        new_params, new_res, new_cost = best_of(
+            sel, np.clip(params + delta, lower[sel], upper[sel])
+        )
+        better = new_cost < cost[sel]
+        converged = np.logical_or(
+            (cost[sel] - new_cost) <= (tol_val * cost[sel]),
+            np.all(
+                np.abs(new_params - params) <= (tol_val * (np.abs(params) + tol_val)),
+                axis=1,
+            ),
+        )
+        accepted = sel[better]
+        popt[accepted] = new_params[better]
+        res[accepted] = new_res[better]
+        cost[accepted] = new_cost[better]
+        damping[sel] = np.where(
+            better, np.maximum(damping[sel] / 10, 1e-06), damping[sel] * 10
+        )
+        active[sel[np.logical_and(better, converged)]] = False
+        active[damping > 1e10] = False
+    return popt
+
+
+def eels_3D_LCPL(
+    eels_dict,
+    fit_range,
+    peak_range,
+    LBA_radius=3,
+    percentile=5,
+    workers=1,
+    chunk_size=4096,
+):
+    """
+    Background subtracted elemental maps from a spectrum
+    image, with a linear combination of power laws as the
+    background
+
+    Parameters
+    ----------
+    eels_dict:  dict
+                Spectrum image dictionary, with the data
+                in "data" with the energy along the first
+                axis, and the energy calibration in
+                "pixelOrigin" and "pixelSize"
+    fit_range:  ndarray
+                Starting and stopping energy values of the
+                background fit for every element
+    peak_range: ndarray
+                Starting and stopping energy values of the
+                edge of every element
+    LBA_radius: float, optional
+                Radius of the local background average.
+                Default is 3
+    percentile: float, optional
+                The powers of the two power laws are held
+                close to this lower and upper percentile of
+                the single power law fits. Default is 5
+    workers:    int, optional
+                Number of worker processes. Default is 1, where
+                the chunks are fitted in this process
+    chunk_size: int, optional
+                Number of scan positions fitted together in
+                a worker. Default is 4096
+
+    Returns
+    -------
+    peak_values:          ndarray
+                          Background subtracted intensity of
+                          every element at every scan position
+    elemental_subtracted: ndarray
+                          Background subtracted spectra for
+                          every element
+
+    Notes
+    -----
+    A single power law is first fitted to every spectrum, all
+    at once with `powerlaw_fit_3D`. The percentiles of these
+    powers and the range of their constants set the bounds of
+    the two power laws of `lcpl`, which is then fitted to the
+    local background average of every scan position. The scan
+    is cut into chunks of scan positions, every chunk is fitted
+    with one call to `fit_lcpl_batch` in a worker process, and
+    every fit starts from the single power law fit of its own
+    spectrum, split evenly between the two power laws at the
+    middle of the fitting region.
+
+    See Also
+    --------
+    eels_3D
+    fit_lcpl_batch
+    local_average
+    """
+    fit_range = np.reshape(np.asarray(fit_range), (-1, 2))
+    peak_range = np.reshape(np.asarray(peak_range), (-1, 2))
     no_elements = len(peak_range)
-    eels_array = eels_dict["data"]
+    eels_array = np.asarray(eels_dict["data"], dtype=np.float64)
+    scan_shape = eels_array.shape[1:3]
+    no_pixels = int(np.prod(scan_shape))
     elemental_subtracted = np.zeros(
         (eels_array.shape[0], eels_array.shape[1], eels_array.shape[2], no_elements),
         dtype=np.float32,
     )
-    yy, xx = np.mgrid[0 : eels_array.shape[1], 0 : eels_array.shape[2]]
     xdata = (np.arange(eels_array.shape[0]) - eels_dict["pixelOrigin"][0]) * eels_dict[
         "pixelSize"
     ][0]
     peak_values = np.zeros(
         (eels_array.shape[-2], eels_array.shape[-1], no_elements), dtype=np.float32
     )
-    power_values = np.zeros(
-        (eels_array.shape[-2], eels_array.shape[-1], no_elements), dtype=np.float32
-    )
-    const_values = np.zeros(
-        (eels_array.shape[-2], eels_array.shape[-1], no_elements), dtype=np.float32
-    )
-
-    for ii in range(eels_array.shape[-2]):
-        for jj in range(eels_array.shape[-1]):
-            for kk in range(no_elements):
-                eels_data = eels_array[:, ii, jj]
-                fit_points = fit_range[kk, :]
-                peak_point = peak_range[kk, :]
-                _, power, const = powerlaw_fit(xdata, eels_data, fit_points)
-                power_values[ii, jj, kk] = power
-                const_values[ii, jj, kk] = const
-
-    percentile1 = np.zeros(no_elements, dtype=np.float32)
-    percentile2 = np.zeros(no_elements, dtype=np.float32)
-    lower_bound = np.zeros((4, no_elements), dtype=np.float32)
-    upper_bound = np.zeros((4, no_elements), dtype=np.float32)
-
-    for ll in range(no_elements):
-        percentile1[ll] = np.percentile(np.ravel(power_values[:, :, ll]), percentile)
-        percentile2[ll] = np.percentile(
-            np.ravel(power_values[:, :, ll]), 100 - percentile
-        )
-        lower_bound[:, ll] = (
-            0.5 * np.amin(const_values[:, :, ll]),
-            1.001 * percentile1[ll],
-            0.5 * np.amin(const_values[:, :, ll]),
-            1.001 * percentile2[ll],
+    fit_index = energy_index(xdata, fit_range)
+    peak_index = energy_index(xdata, peak_range)
+    chunk_size = int(max(chunk_size, 1))
+    starts = np.arange(0, no_pixels, chunk_size)
+    for rr in range(no_elements):
+        star_val, stop_val = fit_index[rr, :]
+        x_fit = xdata[star_val:stop_val]
+        power, const = powerlaw_fit_3D(x_fit, eels_array[star_val:stop_val])
+        power = np.ravel(power)
+        const = np.ravel(const)
+        percentile1 = np.nanpercentile(power, percentile)
+        percentile2 = np.nanpercentile(power, 100 - percentile)
+        lower_bound = np.asarray(
+            (
+                0.5 * np.nanmin(const),
+                min(1.001 * percentile1, 0.999 * percentile1),
+                0.5 * np.nanmin(const),
+                min(1.001 * percentile2, 0.999 * percentile2),
+            )
         )
-        upper_bound[:, ll] = (
-            2 * np.amax(const_values[:, :, ll]),
-            0.999 * percentile1[ll],
-            2 * np.amax(const_values[:, :, ll]),
-            0.999 * percentile2[ll],
+        upper_bound = np.asarray(
+            (
+                2 * np.nanmax(const),
+                max(1.001 * percentile1, 0.999 * percentile1),
+                2 * np.nanmax(const),
+                max(1.001 * percentile2, 0.999 * percentile2),
+            )
         )
-
-    for pp in range(eels_array.shape[-2]):
-        for qq in range(eels_array.shape[-1]):
-            for rr in range(no_elements):
-                eels_data = eels_array[:, pp, qq]
-                fit_points = fit_range[rr, :]
-                peak_point = peak_range[rr, :]
-                star_val = np.int(
-                    (fit_points[0] - np.amin(xdata)) / (np.median(np.diff(xdata)))
-                )
-                stop_val = np.int(
-                    (fit_points[1] - np.amin(xdata)) / (np.median(np.diff(xdata)))
+        x_mid = np.median(x_fit)
+        initial = np.zeros((no_pixels, 4), dtype=np.float64)
+        initial[:, 1] = 0.5 * (lower_bound[1] + upper_bound[1])
+        initial[:, 3] = 0.5 * (lower_bound[3] + upper_bound[3])
+        initial[:, 0] = 0.5 * const * (x_mid ** (power - initial[:, 1]))
+        initial[:, 2] = 0.5 * const * (x_mid ** (power - initial[:, 3]))
+        initial = np.where(np.isfinite(initial), initial, lower_bound[None, :])
+        eels_lbi = np.reshape(
+            local_average(eels_array[star_val:stop_val], LBA_radius),
+            (len(x_fit), no_pixels),
+        ).T
+        jobs = []
+        for start in starts:
+            chunk = slice(start, start + chunk_size)
+            jobs.append(
+                (
+                    x_fit,
+                    eels_lbi[chunk, :],
+                    initial[chunk, :],
+                    np.broadcast_to(lower_bound, initial[chunk, :].shape),
+                    np.broadcast_to(upper_bound, initial[chunk, :].shape),
                 )
-
-                lbi = (((yy - ii) ** 2) + ((xx - jj) ** 2)) <= (LBA_radius ** 2)
-                eels_lbi = np.mean(eels_array[:, lbi], axis=-1)
-                popt, _ = spo.curve_fit(
-                    lcpl,
-                    xdata[star_val:stop_val],
-                    eels_lbi[star_val:stop_val],
-                    bounds=(lower_bound[:, rr], upper_bound[:, rr]),
-                    ftol=0.0001,
-                    xtol=0.0001,
-                )
-                background = lcpl(xdata, popt[0], popt[1], popt[2], popt[3])
-                subtracted_data = eels_data - background
-                elemental_subtracted[:, pp, qq, rr] = subtracted_data
-                star_sum = np.int(
-                    (peak_point[0] - np.amin(xdata)) / (np.median(np.diff(xdata)))
-                )
-                stop_sum = np.int(
-                    (peak_point[1] - np.amin(xdata)) / (np.median(np.diff(xdata)))
-                )
-                peak_values[pp, qq, rr] = np.sum(subtracted_data[star_sum:stop_sum])
-
+            )
+        popt = np.zeros((no_pixels, 4), dtype=np.float64)
+        if workers > 1:
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers
+            ) as executor:
+                for start, result in zip(
+                    starts, executor.map(fit_lcpl_batch, *zip(*jobs))
+                ):
+                    popt[start : start + len(result), :] = result
+        else:
+            for start, job in zip(starts, jobs):
+                popt[start : start + len(job[1]), :] = fit_lcpl_batch(*job)
+        background = lcpl(
+            xdata[:, None], popt[:, 0], popt[:, 1], popt[:, 2], popt[:, 3]
+        )
+        elemental_subtracted[:, :, :, rr] = eels_array - np.reshape(
+            background, eels_array.shape
+        )
+        star_sum, stop_sum = peak_index[rr, :]
+        peak_values[:, :, rr] = np.sum(
+            elemental_subtracted[star_sum:stop_sum, :, :, rr], axis=0
+        )
     return peak_values, elemental_subtracted
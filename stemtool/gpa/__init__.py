@@ -1 +1,3 @@
 from .gpa import *
+from .tiled_gpa import *
+from .gpa_series import *
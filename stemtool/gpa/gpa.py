@@ -1,13 +1,14 @@
 import numpy as np
-import skimage.restoration as skr
 import scipy.ndimage as scnd
+import scipy.fft as sfft
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import stemtool as st
 import matplotlib.offsetbox as mploff
 import matplotlib.gridspec as mpgs
 import matplotlib_scalebar.scalebar as mpss
-import numba
+import os
+import pyfftw.interfaces as pfi
 
 
 def phase_diff(angle_image):
@@ -19,7 +20,9 @@ def phase_diff(angle_image):
     Parameters
     ----------
     angle_image:  ndarray
-                  Wrapped phase image 
+                  Wrapped phase image, or a stack of phase
+                  images where the last two dimensions are
+                  the image dimensions
 
     Returns
     -------
@@ -33,7 +36,10 @@ def phase_diff(angle_image):
     The basic idea of this is that we differentiate the 
     complex exponential of the phase image, and then obtain the 
     differentiation result by multiplying the differential with 
-    the conjugate of the complex phase image.
+    the conjugate of the complex phase image. The imaginary part
+    of this product is the sine of the difference between the
+    neighboring phases, which is what is calculated, so no complex
+    arrays are allocated.
 
     Reference
     ---------
@@ -41,16 +47,11 @@ def phase_diff(angle_image):
        of displacement and strain fields from HREM micrographs." 
        Ultramicroscopy 74.3 (1998): 131-146.
     """
-    imaginary_image = np.exp(1j * angle_image)
-    diff_imaginary_x = np.zeros(imaginary_image.shape, dtype="complex_")
-    diff_imaginary_x[:, 0:-1] = np.diff(imaginary_image, axis=1)
-    diff_imaginary_y = np.zeros(imaginary_image.shape, dtype="complex_")
-    diff_imaginary_y[0:-1, :] = np.diff(imaginary_image, axis=0)
-    conjugate_imaginary = np.conj(imaginary_image)
-    diff_complex_x = np.multiply(conjugate_imaginary, diff_imaginary_x)
-    diff_complex_y = np.multiply(conjugate_imaginary, diff_imaginary_y)
-    diff_x = np.imag(diff_complex_x)
-    diff_y = np.imag(diff_complex_y)
+    angle_image = np.asarray(angle_image, dtype=np.float64)
+    diff_x = np.zeros_like(angle_image)
+    diff_x[..., 0:-1] = np.sin(np.diff(angle_image, axis=-1))
+    diff_y = np.zeros_like(angle_image)
+    diff_y[..., 0:-1, :] = np.sin(np.diff(angle_image, axis=-2))
     return diff_x, diff_y
 
 
@@ -81,6 +82,67 @@ def phase_subtract(matrix_1, matrix_2):
     return np.angle(np.exp(1j * (matrix_1 - matrix_2)))
 
 
+def unwrap_ls(angle_image):
+    """
+    Least squares phase unwrapping with discrete
+    cosine transforms
+
+    Parameters
+    ----------
+    angle_image: ndarray
+                 Wrapped phase image, or a stack of phase
+                 images where the last two dimensions are
+                 the image dimensions
+
+    Returns
+    -------
+    unwrapped: ndarray
+               Unwrapped phase image
+
+    Notes
+    -----
+    The wrapped phase differences between neighboring pixels
+    are the best estimate of the true phase gradient, and the
+    unwrapped phase is the function whose gradient matches them
+    in the least squares sense. This is a Poisson equation with
+    Neumann boundary conditions, which the discrete cosine transform
+    diagonalizes, so the whole solution costs one forward and one
+    inverse transform. The unknown constant is chosen so that the
+    unwrapped phase wraps back onto the input.
+
+    References
+    ----------
+    .. [1] Ghiglia, D. C., and L. A. Romero. "Robust two-dimensional
+       weighted and unweighted phase unwrapping that uses fast
+       transforms and iterative methods." JOSA A 11.1 (1994): 107-117.
+
+    See Also
+    --------
+    phase_diff
+    """
+    angle_image = np.asarray(angle_image, dtype=np.float64)
+    im_y, im_x = angle_image.shape[-2:]
+    wrap_x = np.zeros_like(angle_image)
+    wrap_x[..., 0:-1] = np.angle(np.exp(1j * np.diff(angle_image, axis=-1)))
+    wrap_y = np.zeros_like(angle_image)
+    wrap_y[..., 0:-1, :] = np.angle(np.exp(1j * np.diff(angle_image, axis=-2)))
+    rho = np.copy(wrap_x) + wrap_y
+    rho[..., 1:] -= wrap_x[..., 0:-1]
+    rho[..., 1:, :] -= wrap_y[..., 0:-1, :]
+    denom = (2 * np.cos(np.pi * np.arange(im_y) / im_y)[:, None]) + (
+        2 * np.cos(np.pi * np.arange(im_x) / im_x)[None, :]
+    )
+    denom -= 4
+    denom[0, 0] = 1
+    rho_dct = sfft.dctn(rho, type=2, axes=(-2, -1), norm="ortho") / denom
+    rho_dct[..., 0, 0] = 0
+    unwrapped = sfft.idctn(rho_dct, type=2, axes=(-2, -1), norm="ortho")
+    offset = np.angle(
+        np.mean(np.exp(1j * (angle_image - unwrapped)), axis=(-2, -1), keepdims=True)
+    )
+    return unwrapped + offset
+
+
 def circ_to_G(circ_pos, image):
     """
     Convert a pixel position to g vectors in
@@ -165,7 +227,179 @@ def g_matrix(g_vector, image):
     return G_r
 
 
-def phase_matrix(gvec, image, circ_size=0, g_blur=True):
+def detect_gvecs(
+    image,
+    image_ft=None,
+    no_spots=2,
+    min_radius=0,
+    peak_dist=5,
+    angle_tol=15,
+    usfac=20,
+):
+    """
+    Automatically locate the strongest non-collinear
+    diffraction spots in the Fourier transform of an image
+
+    Parameters
+    ----------
+    image:      ndarray
+                The image matrix
+    image_ft:   ndarray, optional
+                Shifted Fourier transform of the Hamming windowed
+                image, such as `GPA.image_ft`. Calculated if not given
+    no_spots:   int, optional
+                Number of spots to find. Default is 2
+    min_radius: float, optional
+                Spots closer than this many pixels to the center
+                of the Fourier transform are ignored. Default is 0,
+                which uses 2% of the image size, or 4 pixels if that
+                is larger
+    peak_dist:  int, optional
+                Minimum separation in pixels between two spots.
+                Default is 5
+    angle_tol:  float, optional
+                Minimum angle in degrees between any two of the
+                returned spots. Default is 15
+    usfac:      int, optional
+                Upsampling factor for the sub-pixel refinement.
+                Default is 20
+
+    Returns
+    -------
+    gvecs: ndarray
+           Shape is (no_spots, 2), the g vectors in inverse pixels
+           as (y, x), strongest first
+
+    Notes
+    -----
+    The local maxima of the lightly smoothed Fourier amplitude are
+    found with a maximum filter in a single pass. As the image is real,
+    the Fourier transform is centrosymmetric, so only one half plane is
+    searched. The strongest maximum is the first spot, and each further
+    spot is the strongest remaining maximum that is at least `angle_tol`
+    away from all the spots picked so far, so that the g vectors are
+    never collinear. Every spot is then refined to 1/`usfac` of a pixel
+    with the upsampled DFT `util.dftups` of the windowed image, computed
+    only in a small neighborhood of the spot. No figures are made, so
+    this can run unattended.
+
+    See Also
+    --------
+    GPA.auto_spots
+    util.dftups
+    """
+    imshape = np.asarray(image.shape)
+    ham = np.sqrt(np.outer(np.hamming(imshape[0]), np.hamming(imshape[1])))
+    if image_ft is None:
+        image_ft = np.fft.fftshift(np.fft.fft2(image * ham))
+    if min_radius == 0:
+        min_radius = np.amax((4, 0.02 * np.amin(imshape)))
+    abs_ft = scnd.gaussian_filter(np.abs(image_ft), 1)
+    peaks = abs_ft == scnd.maximum_filter(abs_ft, size=(2 * int(peak_dist)) + 1)
+    center = np.floor(imshape / 2).astype(int)
+    ky = np.arange(imshape[0]) - center[0]
+    kx = np.arange(imshape[1]) - center[1]
+    peaks[(ky[:, None] ** 2) + (kx[None, :] ** 2) < (min_radius ** 2)] = False
+    peaks[ky < 0, :] = False
+    peaks[center[0], kx <= 0] = False
+    peak_y, peak_x = np.nonzero(peaks)
+    order = np.argsort(abs_ft[peak_y, peak_x])[::-1]
+    peak_k = np.asarray((ky[peak_y[order]], kx[peak_x[order]]), dtype=np.float64).T
+    min_sin = np.sin(np.deg2rad(angle_tol))
+    chosen = []
+    for k_vec in peak_k:
+        k_norm = np.linalg.norm(k_vec)
+        collinear = False
+        for c_vec in chosen:
+            cross = np.abs((k_vec[0] * c_vec[1]) - (k_vec[1] * c_vec[0]))
+            if cross < (min_sin * k_norm * np.linalg.norm(c_vec)):
+                collinear = True
+        if not collinear:
+            chosen.append(k_vec)
+        if len(chosen) == no_spots:
+            break
+    if len(chosen) < no_spots:
+        raise RuntimeError("Could not find enough non-collinear diffraction spots")
+    usfac = int(usfac)
+    up_size = int(np.ceil(usfac * 3))
+    dftshift = np.fix(up_size / 2)
+    windowed = np.fft.ifftshift(image * ham)
+    gvecs = np.zeros((no_spots, 2), dtype=np.float64)
+    for ii, k_vec in enumerate(chosen):
+        up_ft = np.abs(
+            st.util.dftups(
+                windowed,
+                usfac,
+                up_size,
+                up_size,
+                dftshift - (k_vec[0] * usfac),
+                dftshift - (k_vec[1] * usfac),
+            )
+        )
+        up_y, up_x = np.unravel_index(np.argmax(up_ft), up_ft.shape)
+        gvecs[ii, 0] = (k_vec[0] + ((up_y - dftshift) / usfac)) / imshape[0]
+        gvecs[ii, 1] = (k_vec[1] + ((up_x - dftshift) / usfac)) / imshape[1]
+    return gvecs
+
+
+def fourier_mask(gvec, imshape, circ_size=0, g_blur=True):
+    """
+    Generate the Fourier space aperture around the
+    diffraction spot of a g vector
+
+    Parameters
+    ----------
+    g_vec:     ndarray
+               Shape is (2, 1) which is the G
+               vector in Fourier space in inverse pixels
+    imshape:   ndarray
+               Shape of the image
+    circ_size: float, optional
+               Size of the circle in pixels
+    g_blur:    bool, optional
+               Use a Gaussian aperture instead of a
+               hard edged one. Default is True
+
+    Returns
+    -------
+    four_mask: ndarray
+               Aperture of the same shape as the
+               shifted Fourier transform of the image
+
+    Notes
+    -----
+    Only the bounding box of the aperture is calculated,
+    as everything outside it is zero anyway.
+
+    See Also
+    --------
+    phase_matrix
+    """
+    imshape = np.asarray(imshape)
+    if circ_size == 0:
+        circ_rad = np.amin(0.01 * np.asarray(imshape))
+    else:
+        circ_rad = circ_size
+    circ_pos = np.multiply(np.flip(gvec), imshape) + (0.5 * imshape)
+    y_start = int(np.clip(np.floor(circ_pos[1] - circ_rad), 0, imshape[0]))
+    y_stop = int(np.clip(np.ceil(circ_pos[1] + circ_rad) + 1, 0, imshape[0]))
+    x_start = int(np.clip(np.floor(circ_pos[0] - circ_rad), 0, imshape[1]))
+    x_stop = int(np.clip(np.ceil(circ_pos[0] + circ_rad) + 1, 0, imshape[1]))
+    yy, xx = np.mgrid[y_start:y_stop, x_start:x_stop]
+    zz = ((yy - circ_pos[1]) ** 2) + ((xx - circ_pos[0]) ** 2)
+    circ_mask = (zz ** 0.5) < circ_rad
+    four_mask = np.zeros(imshape, dtype=np.float64)
+    if g_blur:
+        sigma2 = np.sum((0.5 * gvec * imshape) ** 2)
+        four_mask[y_start:y_stop, x_start:x_stop] = circ_mask * np.exp(
+            (-0.5) * (zz / sigma2)
+        )
+    else:
+        four_mask[y_start:y_stop, x_start:x_stop] = circ_mask
+    return four_mask
+
+
+def phase_matrix(gvec, image, circ_size=0, g_blur=True, image_ft=None):
     """
     Use the g vector in Fourier coordinates
     to select only the subset of phases
@@ -182,6 +416,10 @@ def phase_matrix(gvec, image, circ_size=0, g_blur=True):
     circ_size: float, optional
                Size of the circle in pixels
     g_blur:    bool, optional
+    image_ft:  ndarray, optional
+               Shifted Fourier transform of the Hamming
+               windowed image. If this is given, the
+               Fourier transform is not recalculated.
 
     Returns
     -------
@@ -203,37 +441,162 @@ def phase_matrix(gvec, image, circ_size=0, g_blur=True):
     See Also
     --------
     g_matrix
+    fourier_mask
     """
     imshape = np.asarray(np.shape(image))
-    if circ_size == 0:
-        circ_rad = np.amin(0.01 * np.asarray(imshape))
-    else:
-        circ_rad = circ_size
-    yy, xx = np.mgrid[0 : imshape[0], 0 : imshape[1]]
-    circ_pos = np.multiply(np.flip(gvec), imshape) + (0.5 * imshape)
-    circ_mask = (
-        st.util.make_circle(imshape, circ_pos[0], circ_pos[1], circ_rad)
-    ).astype(bool)
-    ham = np.sqrt(np.outer(np.hamming(imshape[0]), np.hamming(imshape[1])))
+    if image_ft is None:
+        ham = np.sqrt(np.outer(np.hamming(imshape[0]), np.hamming(imshape[1])))
+        image_ft = np.fft.fftshift(np.fft.fft2(image * ham))
+    four_mask = fourier_mask(gvec, imshape, circ_size, g_blur)
+    P_matrix = np.angle(np.fft.ifft2(four_mask * image_ft))
+    return P_matrix
 
-    if g_blur:
-        sigma2 = np.sum((0.5 * gvec * imshape) ** 2)
-        zz = (
-            ((yy[circ_mask] - circ_pos[1]) ** 2) + ((xx[circ_mask] - circ_pos[0]) ** 2)
-        ) / sigma2
-        four_mask = np.zeros_like(yy, dtype=np.float)
-        four_mask[circ_mask] = np.exp((-0.5) * zz)
-        P_matrix = np.angle(
-            np.fft.ifft2(four_mask * np.fft.fftshift(np.fft.fft2(image * ham)))
-        )
-    else:
-        P_matrix = np.angle(
-            np.fft.ifft2(circ_mask * np.fft.fftshift(np.fft.fft2(image * ham)))
+
+def phase_stack(gvecs, image_ft, circ_size=0, g_blur=True, threads=None):
+    """
+    Phase matrices for many g vectors from a single
+    batched inverse Fourier transform
+
+    Parameters
+    ----------
+    gvecs:     ndarray
+               Shape is (N, 2) where every row is
+               a g vector in inverse pixels
+    image_ft:  ndarray
+               Shifted Fourier transform of the Hamming
+               windowed image
+    circ_size: float, optional
+               Size of the circle in pixels
+    g_blur:    bool, optional
+               Use a Gaussian aperture. Default is True
+    threads:   int, optional
+               Number of threads used by the Fourier transform.
+               Default is None, which uses all the CPUs
+
+    Returns
+    -------
+    masks:      ndarray
+                Shape is (N, Y, X), the Fourier space
+                aperture of every g vector
+    P_matrices: ndarray
+                Shape is (N, Y, X), the phase matrix
+                of every g vector
+
+    See Also
+    --------
+    fourier_mask
+    phase_matrix
+    """
+    gvecs = np.reshape(np.asarray(gvecs, dtype=np.float64), (-1, 2))
+    imshape = np.asarray(image_ft.shape)
+    if threads is None:
+        threads = os.cpu_count()
+    masks = np.zeros((gvecs.shape[0], imshape[0], imshape[1]), dtype=np.float64)
+    for ii in range(gvecs.shape[0]):
+        masks[ii, :, :] = fourier_mask(gvecs[ii, :], imshape, circ_size, g_blur)
+    P_matrices = np.angle(
+        pfi.numpy_fft.ifft2(masks * image_ft, axes=(-2, -1), threads=threads)
+    )
+    return masks, P_matrices
+
+
+def demodulate_phase(P_matrices, gvecs):
+    """
+    Subtract the phase of the reference lattice from
+    phase matrices
+
+    Parameters
+    ----------
+    P_matrices: ndarray
+                Phase matrices from `phase_matrix` or
+                `phase_stack`, of shape (..., N, Y, X)
+    gvecs:      ndarray
+                Shape is (N, 2) where every row is the g vector
+                in inverse pixels of the matching phase matrix
+
+    Returns
+    -------
+    P_demod: ndarray
+             Phase matrices with the reference lattice
+             phase removed
+
+    Notes
+    -----
+    The inverse Fourier transform of the aperture around a
+    diffraction spot still oscillates with the spot frequency,
+    and as the aperture is applied to the shifted Fourier
+    transform, the frequency is offset by the shift. Removing
+    this carrier leaves only the local deviation of the lattice
+    from the reference g vector, which is small and smooth, so
+    its derivatives are unaffected by phase wrapping.
+    """
+    P_matrices = np.asarray(P_matrices)
+    gvecs = np.reshape(np.asarray(gvecs, dtype=np.float64), (-1, 2))
+    im_y, im_x = P_matrices.shape[-2:]
+    carrier_y = gvecs[:, 0] + (np.floor(im_y / 2) / im_y)
+    carrier_x = gvecs[:, 1] + (np.floor(im_x / 2) / im_x)
+    G_r = (
+        2
+        * np.pi
+        * (
+            (carrier_y[:, None, None] * np.arange(im_y)[None, :, None])
+            + (carrier_x[:, None, None] * np.arange(im_x)[None, None, :])
         )
-    return P_matrix
+    )
+    P_demod = phase_subtract(P_matrices, G_r)
+    return P_demod
+
+
+def strain_P(P_matrices, a_matrix):
+    """
+    Use the phase matrices and lattice matrix to
+    calculate the strain matrices of every pixel at once
+
+    Parameters
+    ----------
+    P_matrices: ndarray
+                Phase matrices of shape (..., N, Y, X), with one
+                phase matrix for each of the N g vectors. Any
+                leading dimensions, such as a stack of images, are
+                handled in the same call.
+    a_matrix:   ndarray
+                ndarray of shape (2, N) that converts the phases
+                to displacements
+
+    Returns
+    -------
+    e_xx: ndarray
+          Strain along X direction
+    e_yy: ndarray
+          Strain along Y direction
+    e_th: ndarray
+          Rotational strain
+    e_dg: ndarray
+          Diagonal Strain
+
+    Notes
+    -----
+    The phase gradients are calculated with `phase_diff`, and
+    every component of the per pixel product of the lattice matrix
+    with the gradient matrix is a weighted sum over the g vectors,
+    which is a single `einsum` for the whole stack.
+
+    See Also
+    --------
+    phase_diff
+    GPA.get_strain
+    """
+    a_matrix = np.asarray(a_matrix, dtype=np.float64) / (2 * np.pi)
+    P_x, P_y = phase_diff(P_matrices)
+    e_xx = np.einsum("n,...nij->...ij", a_matrix[0, :], P_x)
+    e_xy = np.einsum("n,...nij->...ij", a_matrix[0, :], P_y)
+    e_yx = np.einsum("n,...nij->...ij", a_matrix[1, :], P_x)
+    e_yy = np.einsum("n,...nij->...ij", a_matrix[1, :], P_y)
+    e_th = 0.5 * (e_xy - e_yx)
+    e_dg = 0.5 * (e_xy + e_yx)
+    return e_xx, e_yy, e_th, e_dg
 
 
-@numba.jit(cache=True, parallel=True)
 def numba_strain_P(P_1, P_2, a_matrix):
     """
     Use the refined phase matrices and lattice matrix 
@@ -262,42 +625,90 @@ def numba_strain_P(P_1, P_2, a_matrix):
 
     Notes
     -----
-    This is a numba accelerated JIT compiled
-    version of the method `gen_strain()` in the
-    where a for loop is used to refine the strain
-    at every pixel position. 
+    This used to be a numba loop over every pixel, and
+    is now kept for compatibility as a wrapper around the
+    vectorized `strain_P`.
     
     See Also 
     -------- 
-    phase_diff 
-    GPA.gen_strain()
+    strain_P
     """
-    P1_x, P1_y = phase_diff(P_1)
-    P2_x, P2_y = phase_diff(P_2)
-    P_shape = np.shape(P_1)
-    yy, xx = np.mgrid[0 : P_shape[0], 0 : P_shape[1]]
-    yy = np.ravel(yy)
-    xx = np.ravel(xx)
-    P_mat = np.zeros((2, 2), dtype=np.float)
-    e_xx = np.zeros_like(P_1)
-    e_xy = np.zeros_like(P_1)
-    e_yx = np.zeros_like(P_1)
-    e_yy = np.zeros_like(P_1)
-    for ii in numba.prange(len(yy)):
-        ypos = yy[ii]
-        xpos = xx[ii]
-        P_mat[0, 0] = P1_x[ypos, xpos]
-        P_mat[0, 1] = P1_y[ypos, xpos]
-        P_mat[1, 0] = P2_x[ypos, xpos]
-        P_mat[1, 1] = P2_y[ypos, xpos]
-        e_mat = ((1) / (2 * np.pi)) * np.matmul(a_matrix, P_mat)
-        e_xx[ypos, xpos] = e_mat[0, 0]
-        e_xy[ypos, xpos] = e_mat[0, 1]
-        e_yx[ypos, xpos] = e_mat[1, 0]
-        e_yy[ypos, xpos] = e_mat[1, 1]
-    e_th = 0.5 * (e_xy - e_yx)
-    e_dg = 0.5 * (e_xy + e_yx)
-    return e_xx, e_yy, e_th, e_dg
+    return strain_P(np.asarray((P_1, P_2)), a_matrix)
+
+
+def refine_gvecs(
+    image_ft,
+    gvecs,
+    ref_reg,
+    circ_size=0,
+    g_blur=True,
+    ref_iter=20,
+    P_matrices=None,
+    threads=None,
+):
+    """
+    Refine g vectors and their phase matrices with
+    respect to a reference region
+
+    Parameters
+    ----------
+    image_ft:   ndarray
+                Shifted Fourier transform of the Hamming
+                windowed image
+    gvecs:      ndarray
+                Shape is (N, 2), the initial g vectors
+                in inverse pixels
+    ref_reg:    ndarray
+                Boolean mask of the reference region
+    circ_size:  float, optional
+                Size of the circle in pixels
+    g_blur:     bool, optional
+                Use a Gaussian aperture. Default is True
+    ref_iter:   int, optional
+                Number of refinement iterations. Default is 20
+    P_matrices: ndarray, optional
+                Phase matrices of the initial g vectors, if they
+                have already been calculated
+    threads:    int, optional
+                Number of threads used by the Fourier transforms
+
+    Returns
+    -------
+    gvecs_fin:  ndarray
+                Refined g vectors
+    masks:      ndarray
+                Fourier space apertures of the refined g vectors
+    P_matrices: ndarray
+                Phase matrices of the refined g vectors
+
+    Notes
+    -----
+    In every iteration the phase matrices are demodulated with the
+    current g vectors, and the median phase gradient in the reference
+    region, divided by 2 pi, is the remaining error of every g vector.
+    Starting close to the answer, such as from the g vectors of the
+    previous frame of a movie, this converges in a couple of
+    iterations. This is the refinement loop of `GPA.refine_phase`
+    without any of the interactive parts, so it can be run on many
+    images with the same reference region and g vectors, such as by
+    `gpa_series`.
+
+    See Also
+    --------
+    GPA.refine_phase
+    phase_stack
+    """
+    gvecs_fin = np.copy(np.reshape(np.asarray(gvecs, dtype=np.float64), (-1, 2)))
+    ref_reg = np.asarray(ref_reg, dtype=bool)
+    masks = None
+    if P_matrices is None:
+        masks, P_matrices = phase_stack(gvecs_fin, image_ft, circ_size, g_blur, threads)
+    for _ in range(int(ref_iter)):
+        P_x, P_y = phase_diff(demodulate_phase(P_matrices, gvecs_fin))
+        gvecs_fin[:, 0] += np.median(P_y[:, ref_reg], axis=-1) / (2 * np.pi)
+        gvecs_fin[:, 1] += np.median(P_x[:, ref_reg], axis=-1) / (2 * np.pi)
+        masks, P_matrices = phase_stack(gvecs_fin, image_ft, circ_size, g_blur, threads)
+    return gvecs_fin, masks, P_matrices
 
 
 class GPA(object):
@@ -379,6 +790,10 @@ class GPA(object):
             raise RuntimeError("Please ensure that the image is a square image")
         self.circ_0 = 0.5 * self.imshape
         self.inv_cal_units = "1/" + calib_units
+        self.ham = np.sqrt(
+            np.outer(np.hamming(self.imshape[0]), np.hamming(self.imshape[1]))
+        )
+        self.image_ft = np.fft.fftshift(np.fft.fft2(self.image * self.ham))
         self.spots_check = False
         self.reference_check = False
         self.refining_check = False
@@ -402,24 +817,28 @@ class GPA(object):
         plt.gca().add_artist(scalebar)
         plt.axis("off")
 
-    def find_spots(self, circ1, circ2, circ_size=15, imsize=(10, 10)):
+    def find_spots(self, circ1, circ2, circ_size=15, imsize=(10, 10), extra_spots=()):
         """
         Locate the diffraction spots visually.
 
         Parameters
         ----------
-        circ1:     ndarray
-                   Position of the first beam in
-                   the Fourier pattern
-        circ2:     ndarray
-                   Position of the second beam in
-                   the Fourier pattern
-        circ_size: float
-                   Size of the circle in pixels
-        imsize:    tuple, optional
-                   Size in inches of the image with the 
-                   diffraction spots marked. Default is 
-                   (10, 10)
+        circ1:       ndarray
+                     Position of the first beam in
+                     the Fourier pattern
+        circ2:       ndarray
+                     Position of the second beam in
+                     the Fourier pattern
+        circ_size:   float
+                     Size of the circle in pixels
+        imsize:      tuple, optional
+                     Size in inches of the image with the 
+                     diffraction spots marked. Default is 
+                     (10, 10)
+        extra_spots: list of tuples, optional
+                     Positions of any additional beams, such as
+                     the higher order reflections, in the same
+                     units as `circ1` and `circ2`. Default is none
 
         Notes
         -----
@@ -428,20 +847,24 @@ class GPA(object):
         the positions. We also convert the circle locations 
         to G vectors by calling the static method `circ_to_G`.
         We use the G vector locations to also generate the
-        initial phase matrices. 
+        initial phase matrices. Any extra spots are marked in
+        yellow, and all the spots are used together in the least
+        squares displacement calculation of `get_strain`. The phase
+        matrices of all the spots come from one batched inverse
+        Fourier transform.
         
         See Also
         --------
         circ_to_G
-        phase_matrix
+        phase_stack
         """
         self.circ_1 = (self.imshape / 2) + (np.asarray(circ1) / self.inv_calib)
         self.circ_2 = (self.imshape / 2) + (np.asarray(circ2) / self.inv_calib)
+        self.circ_extra = [
+            (self.imshape / 2) + (np.asarray(spot) / self.inv_calib)
+            for spot in extra_spots
+        ]
         self.circ_size = circ_size
-        self.ham = np.sqrt(
-            np.outer(np.hamming(self.imshape[0]), np.hamming(self.imshape[1]))
-        )
-        self.image_ft = np.fft.fftshift(np.fft.fft2(self.image * self.ham))
         log_abs_ft = scnd.filters.gaussian_filter(np.log10(np.abs(self.image_ft)), 3)
 
         pixel_list = np.arange(
@@ -462,21 +885,81 @@ class GPA(object):
         ax.add_artist(circ_0_im)
         ax.add_artist(circ_1_im)
         ax.add_artist(circ_2_im)
+        for circ_n in self.circ_extra:
+            ax.add_artist(
+                plt.Circle(circ_n, self.circ_size, color="yellow", alpha=0.75)
+            )
         plt.xticks(x_positions, x_labels)
         plt.yticks(x_positions, x_labels)
         plt.xlabel("Distance along X-axis (" + self.inv_cal_units + ")")
         plt.ylabel("Distance along Y-axis (" + self.inv_cal_units + ")")
 
-        self.gvec_1_ini = st.gpa.circ_to_G(self.circ_1, self.image)
-        self.gvec_2_ini = st.gpa.circ_to_G(self.circ_2, self.image)
-        self.P_matrix1_ini = st.gpa.phase_matrix(
-            self.gvec_1_ini, self.image, self.circ_size, self.blur
+        self.gvecs_ini = np.asarray(
+            [
+                st.gpa.circ_to_G(circ_n, self.image)
+                for circ_n in [self.circ_1, self.circ_2] + self.circ_extra
+            ]
         )
-        self.P_matrix2_ini = st.gpa.phase_matrix(
-            self.gvec_2_ini, self.image, self.circ_size, self.blur
+        self.masks, self.P_matrices_ini = st.gpa.phase_stack(
+            self.gvecs_ini, self.image_ft, self.circ_size, self.blur
         )
+        self.gvec_1_ini = self.gvecs_ini[0, :]
+        self.gvec_2_ini = self.gvecs_ini[1, :]
+        self.P_matrix1_ini = self.P_matrices_ini[0, :, :]
+        self.P_matrix2_ini = self.P_matrices_ini[1, :, :]
         self.spots_check = True
 
+    def auto_spots(self, circ_size=15, no_spots=2, **kwargs):
+        """
+        Locate the diffraction spots automatically.
+
+        Parameters
+        ----------
+        circ_size: float, optional
+                   Size of the circle in pixels. Default is 15
+        no_spots:  int, optional
+                   Number of spots, the first two of which are
+                   used as the first and second g vectors.
+                   Default is 2
+        **kwargs:  dict
+                   Any other arguments for `detect_gvecs`
+
+        Returns
+        -------
+        gvecs: ndarray
+               The located g vectors in inverse pixels
+
+        Notes
+        -----
+        This is an unattended alternative to `find_spots`, which
+        locates the strongest non-collinear spots in the cached
+        Fourier transform of the image with `detect_gvecs`, and
+        sets up the initial phase matrices the same way, without
+        plotting anything.
+
+        See Also
+        --------
+        detect_gvecs
+        find_spots
+        """
+        self.circ_size = circ_size
+        self.gvecs_ini = st.gpa.detect_gvecs(
+            self.image, self.image_ft, no_spots, **kwargs
+        )
+        circ_all = [st.gpa.G_to_circ(gvec, self.image) for gvec in self.gvecs_ini]
+        self.circ_1 = circ_all[0]
+        self.circ_2 = circ_all[1]
+        self.circ_extra = circ_all[2:]
+        self.masks, self.P_matrices_ini = st.gpa.phase_stack(
+            self.gvecs_ini, self.image_ft, self.circ_size, self.blur
+        )
+        self.gvec_1_ini = self.gvecs_ini[0, :]
+        self.gvec_2_ini = self.gvecs_ini[1, :]
+        self.P_matrix1_ini = self.P_matrices_ini[0, :, :]
+        self.P_matrix2_ini = self.P_matrices_ini[1, :, :]
+        self.spots_check = True
+        return self.gvecs_ini
+
     def define_reference(self, A_pt, B_pt, C_pt, D_pt, imsize=(10, 10), tColor="k"):
         """
         Locate the reference image.
@@ -501,7 +984,9 @@ class GPA(object):
         Notes
         -----
         Locates a reference region bounded by the four points given in
-        length units. Choose the points in a clockwise fashion.
+        length units. The region is rasterized with `util.polygon_mask`,
+        so the points can go around the region either clockwise or
+        counter-clockwise, and the quadrilateral need not be convex.
         """
         if not self.spots_check:
             raise RuntimeError(
@@ -513,46 +998,7 @@ class GPA(object):
         C = np.asarray(C_pt) / self.calib
         D = np.asarray(D_pt) / self.calib
 
-        yy, xx = np.mgrid[0 : self.imshape[0], 0 : self.imshape[1]]
-        yy = np.ravel(yy)
-        xx = np.ravel(xx)
-        ptAA = np.asarray((xx, yy)).transpose() - A
-        ptBB = np.asarray((xx, yy)).transpose() - B
-        ptCC = np.asarray((xx, yy)).transpose() - C
-        ptDD = np.asarray((xx, yy)).transpose() - D
-        angAABB = np.arccos(
-            np.sum(ptAA * ptBB, axis=1)
-            / (
-                ((np.sum(ptAA ** 2, axis=1)) ** 0.5)
-                * ((np.sum(ptBB ** 2, axis=1)) ** 0.5)
-            )
-        )
-        angBBCC = np.arccos(
-            np.sum(ptBB * ptCC, axis=1)
-            / (
-                ((np.sum(ptBB ** 2, axis=1)) ** 0.5)
-                * ((np.sum(ptCC ** 2, axis=1)) ** 0.5)
-            )
-        )
-        angCCDD = np.arccos(
-            np.sum(ptCC * ptDD, axis=1)
-            / (
-                ((np.sum(ptCC ** 2, axis=1)) ** 0.5)
-                * ((np.sum(ptDD ** 2, axis=1)) ** 0.5)
-            )
-        )
-        angDDAA = np.arccos(
-            np.sum(ptDD * ptAA, axis=1)
-            / (
-                ((np.sum(ptDD ** 2, axis=1)) ** 0.5)
-                * ((np.sum(ptAA ** 2, axis=1)) ** 0.5)
-            )
-        )
-        angsum = ((angAABB + angBBCC + angCCDD + angDDAA) / (2 * np.pi)).reshape(
-            self.image.shape
-        )
-        self.ref_reg = np.isclose(angsum, 1)
-        self.ref_reg = np.flipud(self.ref_reg)
+        self.ref_reg = np.flipud(st.util.polygon_mask(self.imshape, (A, B, C, D)))
 
         pixel_list = np.arange(0, self.calib * self.imshape[0], self.calib)
         no_labels = 10
@@ -561,10 +1007,6 @@ class GPA(object):
         x_labels = np.round(pixel_list[::step_x], 1)
         fsize = int(1.5 * np.mean(np.asarray(imsize)))
 
-        print(
-            "Choose your points in a clockwise fashion, or else you will get a wrong result"
-        )
-
         plt.figure(figsize=imsize)
         plt.imshow(
             np.flipud(st.util.image_normalizer(self.image) + 0.33 * self.ref_reg),
@@ -619,55 +1061,48 @@ class GPA(object):
         -----
         Iteratively refine the G vector and the phase matrices,
         so that the phase variation in the reference region is
-        minimized.
+        minimized. The windowed Fourier transform of the image
+        and the coordinate grids are calculated once when the
+        class is initialized, so every iteration only needs one
+        inverse Fourier transform per g vector.
         
         See Also
         --------
-        phase_diff
-        phase_matrix
+        refine_gvecs
+        phase_stack
         """
         if not self.reference_check:
             raise RuntimeError(
                 "Please locate the reference region first as define_reference()"
             )
-        ry = np.arange(start=-self.imshape[0] / 2, stop=self.imshape[0] / 2, step=1)
-        rx = np.arange(start=-self.imshape[1] / 2, stop=self.imshape[1] / 2, step=1)
-        R_x, R_y = np.meshgrid(rx, ry)
-        self.gvec_1_fin = self.gvec_1_ini
-        self.gvec_2_fin = self.gvec_2_ini
-        self.P_matrix1_fin = self.P_matrix1_ini
-        self.P_matrix2_fin = self.P_matrix2_ini
-        for _ in range(int(self.ref_iter)):
-            G1_x, G1_y = st.gpa.phase_diff(self.P_matrix1_fin)
-            G2_x, G2_y = st.gpa.phase_diff(self.P_matrix2_fin)
-            g1_r = (G1_x + G1_y) / (2 * np.pi)
-            g2_r = (G2_x + G2_y) / (2 * np.pi)
-            del_g1 = np.asarray(
-                (
-                    np.median(g1_r[self.ref_reg] / R_y[self.ref_reg]),
-                    np.median(g1_r[self.ref_reg] / R_x[self.ref_reg]),
-                )
-            )
-            del_g2 = np.asarray(
-                (
-                    np.median(g2_r[self.ref_reg] / R_y[self.ref_reg]),
-                    np.median(g2_r[self.ref_reg] / R_x[self.ref_reg]),
-                )
-            )
-            self.gvec_1_fin += del_g1
-            self.gvec_2_fin += del_g2
-            self.P_matrix1_fin = st.gpa.phase_matrix(
-                self.gvec_1_fin, self.image, self.circ_size, self.blur
-            )
-            self.P_matrix2_fin = st.gpa.phase_matrix(
-                self.gvec_2_fin, self.image, self.circ_size, self.blur
-            )
+        self.gvecs_fin, masks, self.P_matrices_fin = st.gpa.refine_gvecs(
+            self.image_ft,
+            self.gvecs_ini,
+            self.ref_reg,
+            self.circ_size,
+            self.blur,
+            self.ref_iter,
+            self.P_matrices_ini,
+        )
+        if masks is not None:
+            self.masks = masks
+        self.gvec_1_fin = self.gvecs_fin[0, :]
+        self.gvec_2_fin = self.gvecs_fin[1, :]
+        self.P_matrix1_fin = self.P_matrices_fin[0, :, :]
+        self.P_matrix2_fin = self.P_matrices_fin[1, :, :]
         self.refining_check = True
 
-    def get_strain(self):
+    def get_strain(self, displacement=False):
         """
         Use the refined phase matrix and g vectors to calculate
         the strain matrices. 
+
+        Parameters
+        ----------
+        displacement: bool, optional
+                      Also calculate the displacement maps `u_x`
+                      and `u_y`, which needs the phases to be
+                      unwrapped. Default is False
         
         Returns
         -------
@@ -684,32 +1119,35 @@ class GPA(object):
         -----
         Use the refined G vectors to generate a matrix
         of the lattice parameters, which is stored as the
-        class attribute `a_matrix`. This is multiplied by the
-        refined phase matrix, and the multiplicand is subsequently
-        differentiated to get the strain parameters.
+        class attribute `a_matrix`. The refined phase matrices are
+        demodulated with the refined g vectors, and their wrap-safe
+        gradients multiplied by `a_matrix` give the strain parameters
+        directly, so no phase unwrapping is needed. With more than
+        two g vectors, `a_matrix` is the pseudo-inverse of the g vector
+        matrix, which gives the least squares solution from all the
+        phase matrices. If the displacements are asked for, the phases
+        are unwrapped with the least squares unwrapper `unwrap_ls`.
         
         See Also
         --------
-        phase_diff
+        strain_P
+        unwrap_ls
         """
         if not self.reference_check:
             raise RuntimeError(
                 "Please refine the phase and g vectors first as refine_phase()"
             )
-        g_matrix = np.zeros((2, 2), dtype=np.float64)
-        g_matrix[0, :] = np.flip(np.asarray(self.gvec_1_fin))
-        g_matrix[1, :] = np.flip(np.asarray(self.gvec_2_fin))
-        self.a_matrix = np.linalg.inv(np.transpose(g_matrix))
-        P1 = skr.unwrap_phase(self.P_matrix1_fin)
-        P2 = skr.unwrap_phase(self.P_matrix1_fin)
-        rolled_p = np.asarray((np.reshape(P1, -1), np.reshape(P2, -1)))
-        u_matrix = np.matmul(self.a_matrix, rolled_p)
-        u_x = np.reshape(u_matrix[0, :], P1.shape)
-        u_y = np.reshape(u_matrix[1, :], P2.shape)
-        self.e_xx, e_xy = st.gpa.phase_diff(u_x)
-        e_yx, self.e_yy = st.gpa.phase_diff(u_y)
-        self.e_th = 0.5 * (e_xy - e_yx)
-        self.e_dg = 0.5 * (e_xy + e_yx)
+        g_matrix = np.flip(np.asarray(self.gvecs_fin, dtype=np.float64), axis=1)
+        self.a_matrix = np.linalg.pinv(g_matrix)
+        self.P_demod = st.gpa.demodulate_phase(self.P_matrices_fin, self.gvecs_fin)
+        if displacement:
+            unwrapped = st.gpa.unwrap_ls(self.P_demod)
+            u_matrix = np.einsum("in,njk->ijk", self.a_matrix, unwrapped) / (2 * np.pi)
+            self.u_x = u_matrix[0, :, :]
+            self.u_y = u_matrix[1, :, :]
+        self.e_xx, self.e_yy, self.e_th, self.e_dg = st.gpa.strain_P(
+            self.P_demod, self.a_matrix
+        )
         self.e_yy -= np.median(self.e_yy[self.ref_reg])
         self.e_dg -= np.median(self.e_dg[self.ref_reg])
         self.e_th -= np.median(self.e_th[self.ref_reg])
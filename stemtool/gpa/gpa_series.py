@@ -0,0 +1,320 @@
+import numpy as np
+import concurrent.futures
+import stemtool as st
+
+
+def frame_strain(
+    image, gvecs, ref_reg, circ_size=0, g_blur=True, ref_iter=20, threads=1
+):
+    """
+    Strain maps of a single image with known g vectors
+    and reference region
+
+    Parameters
+    ----------
+    image:     ndarray
+               The image
+    gvecs:     ndarray
+               Shape is (N, 2), the starting g vectors in
+               inverse pixels
+    ref_reg:   ndarray
+               Boolean mask of the reference region
+    circ_size: float, optional
+               Size of the circle in pixels
+    g_blur:    bool, optional
+               Use a Gaussian aperture. Default is True
+    ref_iter:  int, optional
+               Number of refinement iterations. Default is 20
+    threads:   int, optional
+               Number of threads used by the Fourier transforms.
+               Default is 1
+
+    Returns
+    -------
+    strain:    ndarray
+               Strain maps stacked as e_xx, e_yy, e_th and e_dg,
+               set to zero in the reference region
+    gvecs_fin: ndarray
+               Refined g vectors
+
+    Notes
+    -----
+    This does the same calculation as `GPA.refine_phase` followed
+    by `GPA.get_strain`, without creating any figures.
+
+    See Also
+    --------
+    refine_gvecs
+    strain_P
+    """
+    imshape = np.asarray(image.shape)
+    ham = np.sqrt(np.outer(np.hamming(imshape[0]), np.hamming(imshape[1])))
+    image_ft = np.fft.fftshift(np.fft.fft2(image * ham))
+    gvecs_fin, _, P_matrices = st.gpa.refine_gvecs(
+        image_ft, gvecs, ref_reg, circ_size, g_blur, ref_iter, threads=threads
+    )
+    P_demod = st.gpa.demodulate_phase(P_matrices, gvecs_fin)
+    a_matrix = np.linalg.pinv(np.flip(gvecs_fin, axis=1))
+    strain = np.asarray(st.gpa.strain_P(P_demod, a_matrix))
+    strain -= np.median(strain[:, ref_reg], axis=-1)[:, None, None]
+    return strain, gvecs_fin
+
+
+def memmap_spec(stack):
+    """
+    Description of a memory mapped stack from which the workers
+    can reopen it
+
+    Parameters
+    ----------
+    stack: ndarray
+           Image stack
+
+    Returns
+    -------
+    stack_spec: tuple
+                The stack as (filename, dtype, shape, offset), or None
+                if the stack can't be reopened from its file
+
+    Notes
+    -----
+    A slice of a memory mapped array keeps the `offset` of the array
+    it was sliced from, so the byte offset of the slice in the file
+    is found from how far its data is from the start of the mapped
+    array. Only C contiguous stacks are described, as every other
+    view, such as one with a step or transposed axes, can't be
+    reopened as a plain memory mapped array.
+    """
+    if (not isinstance(stack, np.memmap)) or (stack.filename is None):
+        return None
+    if not stack.flags.c_contiguous:
+        return None
+    root = stack
+    while isinstance(root.base, np.memmap):
+        root = root.base
+    offset = root.offset + (stack.ctypes.data - root.ctypes.data)
+    return (stack.filename, stack.dtype, stack.shape, offset)
+
+
+def load_frames(stack, start, stop):
+    """
+    Read a block of frames, reopening memory mapped stacks
+    from their description
+    """
+    if isinstance(stack, tuple):
+        filename, dtype, shape, offset = stack
+        stack = np.memmap(filename, dtype=dtype, mode="r", offset=offset, shape=shape)
+    return np.asarray(stack[start:stop], dtype=np.float64)
+
+
+def gpa_frames(
+    stack,
+    start,
+    stop,
+    gvecs,
+    ref_reg,
+    circ_size,
+    g_blur,
+    ref_iter,
+    warm_start,
+    output,
+    out_start,
+):
+    """
+    Run GPA on a contiguous block of frames
+
+    Parameters
+    ----------
+    stack:      ndarray or tuple
+                Image stack, or the description of a memory
+                mapped stack from `memmap_spec`
+    start:      int
+                First frame of the block
+    stop:       int
+                One past the last frame of the block
+    gvecs:      ndarray
+                Starting g vectors of the first frame
+    ref_reg:    ndarray
+                Boolean mask of the reference region
+    circ_size:  float
+                Size of the circle in pixels
+    g_blur:     bool
+                Use a Gaussian aperture
+    ref_iter:   int
+                Number of refinement iterations
+    warm_start: bool
+                Start every frame from the refined g vectors
+                of the previous frame
+    output:     str
+                The .npy file the strain maps are written to. If
+                None, the strain maps are returned instead.
+    out_start:  int
+                Position of the first frame of the block in the
+                output file
+
+    Returns
+    -------
+    strain:    ndarray
+               Strain maps of the block, or None if they were
+               written to `output`
+    gvecs_all: ndarray
+               Refined g vectors of every frame in the block
+    """
+    frames = load_frames(stack, start, stop)
+    gvecs_all = np.zeros((stop - start,) + np.shape(gvecs), dtype=np.float64)
+    strain = np.zeros(
+        (stop - start, 4, frames.shape[1], frames.shape[2]), dtype=np.float64
+    )
+    gvecs_start = np.asarray(gvecs, dtype=np.float64)
+    for ii in range(stop - start):
+        strain[ii], gvecs_all[ii] = frame_strain(
+            frames[ii], gvecs_start, ref_reg, circ_size, g_blur, ref_iter
+        )
+        if warm_start:
+            gvecs_start = gvecs_all[ii]
+    if output is not None:
+        out_map = np.load(output, mmap_mode="r+")
+        out_map[out_start : (out_start + stop - start)] = strain
+        out_map.flush()
+        del out_map
+        strain = None
+    return strain, gvecs_all
+
+
+def gpa_series(
+    stack,
+    gvecs,
+    ref_reg,
+    circ_size=15,
+    g_blur=True,
+    ref_iter=20,
+    warm_start=True,
+    output=None,
+    workers=1,
+    chunk_size=8,
+    dtype=np.float32,
+):
+    """
+    Geometric Phase Analysis of every frame in an image stack
+
+    Parameters
+    ----------
+    stack:      ndarray
+                Image stack of shape (frames, Y, X), which can be a
+                memory mapped array such as from `np.load` with
+                `mmap_mode="r"`
+    gvecs:      ndarray
+                Shape is (N, 2), the g vectors in inverse pixels,
+                such as `GPA.gvecs_fin` from a GPA run on one frame
+    ref_reg:    ndarray
+                Boolean mask of the reference region, such as
+                `GPA.ref_reg`
+    circ_size:  float, optional
+                Size of the circle in pixels. Default is 15
+    g_blur:     bool, optional
+                Use a Gaussian aperture. Default is True
+    ref_iter:   int, optional
+                Number of refinement iterations per frame.
+                Default is 20
+    warm_start: bool, optional
+                Start the refinement of every frame from the
+                refined g vectors of the previous frame. Default
+                is True
+    output:     str, optional
+                The .npy file the strain maps are written to. If
+                None, the strain maps are kept in memory.
+    workers:    int, optional
+                Number of worker processes. Default is 1, where
+                the chunks are analyzed in this process
+    chunk_size: int, optional
+                Number of consecutive frames given to a worker
+                at a time. Default is 8
+    dtype:      data-type, optional
+                Data type of the strain maps. Default is np.float32
+
+    Returns
+    -------
+    strain:    ndarray
+               Strain maps of shape (frames, 4, Y, X) stacked as
+               e_xx, e_yy, e_th and e_dg for every frame. This is a
+               memory mapped array if `output` was given.
+    gvecs_all: ndarray
+               Refined g vectors of every frame
+
+    Notes
+    -----
+    The g vectors and the reference region are fixed once for the
+    whole stack, so no spots need to be picked and no figures are
+    made. The frames are split into blocks of consecutive frames
+    that are processed in parallel worker processes. Within a block,
+    every frame can be warm started from the previous one, which
+    tracks slow drifts of the lattice and needs fewer iterations,
+    while every block starts again from `gvecs`. With an output file,
+    every worker writes its block to the file as soon as it is done,
+    so the full strain stack is never in memory. Contiguous memory
+    mapped input stacks, including slices of them, are reopened by
+    the workers instead of being copied.
+
+    Examples
+    --------
+    Refine the g vectors on the first frame with the `GPA` class,
+    and then:
+
+    >>> strain, gvecs = st.gpa.gpa_series(movie, im_gpa.gvecs_fin,
+    ...                                   im_gpa.ref_reg, output="strain.npy")
+
+    See Also
+    --------
+    GPA
+    frame_strain
+    memmap_spec
+    """
+    no_frames = int(stack.shape[0])
+    gvecs = np.reshape(np.asarray(gvecs, dtype=np.float64), (-1, 2))
+    ref_reg = np.asarray(ref_reg, dtype=bool)
+    if ref_reg.shape != tuple(stack.shape[1:3]):
+        raise ValueError("The reference region does not match the image size")
+    if output is not None:
+        out_map = np.lib.format.open_memmap(
+            output,
+            mode="w+",
+            dtype=dtype,
+            shape=(no_frames, 4, stack.shape[1], stack.shape[2]),
+        )
+        del out_map
+    stack_spec = memmap_spec(stack)
+    chunk_size = int(max(chunk_size, 1))
+    jobs = []
+    for start in range(0, no_frames, chunk_size):
+        stop = min(start + chunk_size, no_frames)
+        if stack_spec is None:
+            jobs.append((np.asarray(stack[start:stop]), 0, stop - start, start))
+        else:
+            jobs.append((stack_spec, start, stop, start))
+    common_args = (gvecs, ref_reg, circ_size, g_blur, ref_iter, warm_start, output)
+    gvecs_all = np.zeros((no_frames,) + gvecs.shape, dtype=np.float64)
+    if output is None:
+        strain = np.zeros((no_frames, 4, stack.shape[1], stack.shape[2]), dtype=dtype)
+    if workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(gpa_frames, *job[0:3], *common_args, job[3]): job
+                for job in jobs
+            }
+            for future in concurrent.futures.as_completed(futures):
+                job = futures[future]
+                block_strain, block_gvecs = future.result()
+                block = slice(job[3], job[3] + job[2] - job[1])
+                gvecs_all[block] = block_gvecs
+                if output is None:
+                    strain[block] = block_strain
+    else:
+        for job in jobs:
+            block_strain, block_gvecs = gpa_frames(*job[0:3], *common_args, job[3])
+            block = slice(job[3], job[3] + job[2] - job[1])
+            gvecs_all[block] = block_gvecs
+            if output is None:
+                strain[block] = block_strain
+    if output is not None:
+        strain = np.load(output, mmap_mode="r+")
+    return strain, gvecs_all
@@ -0,0 +1,239 @@
+import numpy as np
+import h5py
+import stemtool as st
+
+
+def tile_phase(image_ft, gvec, origin, g_radius, g_blur=True):
+    """
+    Demodulated geometric phase of a single tile in the
+    coordinates of the full image
+
+    Parameters
+    ----------
+    image_ft: ndarray
+              Unshifted Fourier transform of the Hamming
+              windowed tile
+    gvec:     ndarray
+              g vector as (y, x) in inverse pixels
+    origin:   tuple
+              Position of the top left pixel of the tile
+              in the full image as (y, x)
+    g_radius: float
+              Radius of the Fourier space aperture in
+              inverse pixels
+    g_blur:   bool, optional
+              Use a Gaussian aperture. Default is True
+
+    Returns
+    -------
+    P_matrix: ndarray
+              Phase of the tile, after subtracting the phase
+              of the reference lattice given by the g vector
+
+    Notes
+    -----
+    The aperture is defined in inverse pixels, so it covers the
+    same part of Fourier space for tiles of any shape. Since the
+    reference lattice phase is subtracted using the global pixel
+    positions, the phases of all tiles are in the same frame and
+    neighboring tiles agree in their overlap.
+    """
+    tile_shape = image_ft.shape
+    qy = np.fft.fftfreq(tile_shape[0])
+    qx = np.fft.fftfreq(tile_shape[1])
+    dist2 = ((qy[:, None] - gvec[0]) ** 2) + ((qx[None, :] - gvec[1]) ** 2)
+    four_mask = np.asarray(dist2 < (g_radius ** 2), dtype=np.float64)
+    if g_blur:
+        sigma2 = np.sum((0.5 * np.asarray(gvec)) ** 2)
+        four_mask *= np.exp((-0.5) * (dist2 / sigma2))
+    yy = np.arange(tile_shape[0]) + origin[0]
+    xx = np.arange(tile_shape[1]) + origin[1]
+    G_r = 2 * np.pi * ((yy[:, None] * gvec[0]) + (xx[None, :] * gvec[1]))
+    P_matrix = np.angle(np.fft.ifft2(four_mask * image_ft) * np.exp(-1j * G_r))
+    return P_matrix
+
+
+def tile_strain(tile, origin, gvecs, g_radius, g_blur=True):
+    """
+    Strain maps of a single tile
+
+    Parameters
+    ----------
+    tile:     ndarray
+              Image tile
+    origin:   tuple
+              Position of the top left pixel of the tile
+              in the full image as (y, x)
+    gvecs:    ndarray
+              Shape is (N, 2), the g vectors as (y, x) in
+              inverse pixels
+    g_radius: float
+              Radius of the Fourier space aperture in
+              inverse pixels
+    g_blur:   bool, optional
+              Use a Gaussian aperture. Default is True
+
+    Returns
+    -------
+    strain: ndarray
+            Strain maps stacked as e_xx, e_yy, e_th and e_dg
+
+    Notes
+    -----
+    Like `GPA.get_strain`, the strain comes from the
+    pseudo-inverse of the g vector matrix, which is the least
+    squares solution from all the phases when there are more
+    than two g vectors.
+
+    See Also
+    --------
+    tile_phase
+    strain_P
+    """
+    ham = np.sqrt(np.outer(np.hamming(tile.shape[0]), np.hamming(tile.shape[1])))
+    image_ft = np.fft.fft2(tile * ham)
+    P_matrices = np.asarray(
+        [tile_phase(image_ft, gvec, origin, g_radius, g_blur) for gvec in gvecs]
+    )
+    a_matrix = np.linalg.pinv(np.flip(np.asarray(gvecs, dtype=np.float64), axis=1))
+    strain = np.asarray(st.gpa.strain_P(P_matrices, a_matrix), dtype=np.float64)
+    return strain
+
+
+def tiled_gpa(
+    image,
+    gvecs,
+    tile_size=2048,
+    overlap=256,
+    g_radius=0,
+    g_blur=True,
+    ref_reg=None,
+    output=None,
+    dtype=np.float32,
+):
+    """
+    Out-of-core Geometric Phase Analysis of very large images
+
+    Parameters
+    ----------
+    image:     ndarray
+               The image, which can be a numpy array, a memory
+               mapped array or a HDF5 dataset. It need not be square.
+    gvecs:     ndarray
+               Shape is (N, 2), two or more g vectors as (y, x)
+               in inverse pixels, as given by `circ_to_G` or
+               `GPA.gvecs_fin`
+    tile_size: int, optional
+               Size of the square tiles. Default is 2048
+    overlap:   int, optional
+               Overlap between neighboring tiles. Default is 256
+    g_radius:  float, optional
+               Radius of the Fourier space aperture in inverse
+               pixels. Default is 0, upon which half the length of
+               the shortest g vector is used
+    g_blur:    bool, optional
+               Use a Gaussian aperture. Default is True
+    ref_reg:   tuple, optional
+               Reference region as (y_start, y_stop, x_start, x_stop)
+               in pixels. If given, the g vectors are refined in the
+               reference region and the strain there is set to zero.
+    output:    str, optional
+               File the strain maps are written to. Names ending in
+               .h5 or .hdf5 are written as the HDF5 dataset "strain",
+               and all other names as a .npy file. Default is None,
+               where the strain maps are kept in memory.
+    dtype:     data-type, optional
+               Data type of the strain maps. Default is np.float32
+
+    Returns
+    -------
+    strain: ndarray
+            Strain maps of shape (4, Y, X), stacked as e_xx, e_yy,
+            e_th and e_dg. This is a memory mapped array for .npy
+            outputs and an open HDF5 dataset for HDF5 outputs, where
+            the file should be closed with `strain.file.close()`
+    gvecs:  ndarray
+            The g vectors, refined if `ref_reg` was given
+
+    Notes
+    -----
+    Only one tile of the image is read into memory at a time. The g
+    vectors are shared by all the tiles, and the geometric phase of
+    every tile is demodulated with the global pixel positions, so the
+    phases of neighboring tiles are continuous across their overlap.
+    The strain of every tile is calculated from the wrap-safe phase
+    derivatives, and the core of the tile is written to the output
+    as soon as it is done. With a reference region, the g vectors are
+    first corrected by the mean phase gradient in the region, which is
+    the same correction that `GPA.refine_phase` iterates towards.
+
+    See Also
+    --------
+    GPA
+    util.tile_slices
+    tile_strain
+    """
+    image_shape = image.shape[0:2]
+    gvecs = np.array(gvecs, dtype=np.float64)
+    if (gvecs.ndim != 2) or (gvecs.shape[0] < 2) or (gvecs.shape[1] != 2):
+        raise ValueError("gvecs must be an array of at least two (y, x) g vectors")
+    if g_radius == 0:
+        g_radius = 0.5 * np.amin(np.linalg.norm(gvecs, axis=1))
+    strain_ref = np.zeros(4, dtype=np.float64)
+    if ref_reg is not None:
+        half_overlap = int(overlap / 2)
+        y_start = int(max(ref_reg[0] - half_overlap, 0))
+        y_stop = int(min(ref_reg[1] + half_overlap, image_shape[0]))
+        x_start = int(max(ref_reg[2] - half_overlap, 0))
+        x_stop = int(min(ref_reg[3] + half_overlap, image_shape[1]))
+        ref_tile = np.asarray(image[y_start:y_stop, x_start:x_stop], dtype=np.float64)
+        ref_slice = np.s_[
+            (ref_reg[0] - y_start) : (ref_reg[1] - y_start),
+            (ref_reg[2] - x_start) : (ref_reg[3] - x_start),
+        ]
+        ham = np.sqrt(
+            np.outer(np.hamming(ref_tile.shape[0]), np.hamming(ref_tile.shape[1]))
+        )
+        ref_ft = np.fft.fft2(ref_tile * ham)
+        for gvec in gvecs:
+            P_ref = tile_phase(ref_ft, gvec, (y_start, x_start), g_radius, g_blur)
+            P_x, P_y = st.gpa.phase_diff(P_ref)
+            gvec += np.asarray(
+                (np.mean(P_y[ref_slice]), np.mean(P_x[ref_slice]))
+            ) / (2 * np.pi)
+        strain_ref = np.median(
+            tile_strain(ref_tile, (y_start, x_start), gvecs, g_radius, g_blur)[
+                (slice(None),) + ref_slice
+            ],
+            axis=(-2, -1),
+        )
+    out_shape = (4, image_shape[0], image_shape[1])
+    if output is None:
+        strain = np.zeros(out_shape, dtype=dtype)
+    elif output.endswith(".h5") or output.endswith(".hdf5"):
+        h5_file = h5py.File(output, "w")
+        strain = h5_file.create_dataset("strain", out_shape, dtype=dtype)
+    else:
+        strain = np.lib.format.open_memmap(
+            output, mode="w+", dtype=dtype, shape=out_shape
+        )
+    for y_window in st.util.tile_slices(image_shape[0], tile_size, overlap):
+        for x_window in st.util.tile_slices(image_shape[1], tile_size, overlap):
+            tile = np.asarray(
+                image[y_window[0] : y_window[1], x_window[0] : x_window[1]],
+                dtype=np.float64,
+            )
+            tile_e = tile_strain(
+                tile, (y_window[0], x_window[0]), gvecs, g_radius, g_blur
+            )
+            core = tile_e[
+                :,
+                (y_window[2] - y_window[0]) : (y_window[3] - y_window[0]),
+                (x_window[2] - x_window[0]) : (x_window[3] - x_window[0]),
+            ]
+            strain[
+                :, y_window[2] : y_window[3], x_window[2] : x_window[3]
+            ] = core - strain_ref[:, None, None]
+    if isinstance(strain, np.memmap):
+        strain.flush()
+    return strain, gvecs
@@ -317,6 +317,57 @@ def aperture_image(data4D, center, radius):
     return df_image
 
 
+def aperture_preview(
+    data4D, center, radius, levels=((8, 4), (4, 2), (2, 1), (1, 1)), background=True
+):
+    """
+    Progressive virtual image preview for a given aperture
+
+    Parameters
+    ----------
+    data4D:     ndarray of shape (4,4)
+                the first two dimensions are Fourier
+                space, while the next two dimensions
+                are real space
+    center:     ndarray of shape (1,2)
+                Center of the circular aperture
+    radius:     float
+                Radius of the circular aperture
+    levels:     tuple, optional
+                Sequence of (scan_step, detector_bin) pairs from
+                the coarsest to the finest level
+    background: bool, optional
+                Refine the finer levels in a background thread.
+                Default is True
+
+    Returns
+    -------
+    df_preview: ndarray of shape (2,2)
+                Virtual image at the coarsest level
+    preview:    progressive_4D
+                The running preview. The virtual image of every
+                finished level is at `preview.levels[ii]["virtual"][0]`
+
+    Notes
+    -----
+    The coarsest level only reads every few scan positions and
+    bins the detector, so it is available in a fraction of the
+    time that `aperture_image` takes on the full dataset. The
+    finest level with the default levels matches `aperture_image`.
+
+    See Also
+    --------
+    aperture_image
+    dpc.progressive_4D
+    """
+    preview = st.dpc.progressive_4D(
+        data4D, apertures=[(center[0], center[1], radius)], levels=levels
+    )
+    coarse = preview.start(background)
+    df_preview = coarse["virtual"][0]
+    return df_preview, preview
+
+
 def custom_detector(data4D, det_inner, det_outer, det_center=(0, 0), mrad_calib=0):
     """
     Generate an image with a custom annular detector 
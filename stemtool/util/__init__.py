@@ -3,3 +3,4 @@ from .gauss_utils import *
 from .image_utils import *
 from .sobel_canny import *
 from .pnccd import *
+from .ref_region import *
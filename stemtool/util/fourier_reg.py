@@ -330,10 +330,10 @@ def dftregistration(buf1ft, buf2ft, usfac=1):
             # Matrix multiply DFT around the current shift estimate
             CC = np.conj(
                 dftups(
-                    ft_mult,
+                    np.conj(ft_mult),
+                    usfac,
                     np.ceil(usfac * 1.5),
                     np.ceil(usfac * 1.5),
-                    usfac,
                     dftrow,
                     dftcol,
                 )
@@ -45,15 +45,7 @@ def gaussian_2D_function(xy, x0, y0, theta, sigma_x, sigma_y, amplitude):
     """
     x = xy[0] - x0
     y = xy[1] - y0
-    term_1 = (((np.cos(theta)) ** 2) / (2 * (sigma_x ** 2))) + (
-        ((np.sin(theta)) ** 2) / (2 * (sigma_y ** 2))
-    )
-    term_2 = ((np.sin(2 * theta)) / (2 * (sigma_x ** 2))) - (
-        (np.sin(2 * theta)) / (2 * (sigma_y ** 2))
-    )
-    term_3 = (((np.sin(theta)) ** 2) / (2 * (sigma_x ** 2))) + (
-        ((np.cos(theta)) ** 2) / (2 * (sigma_y ** 2))
-    )
+    term_1, term_2, term_3 = gaussian_2D_terms(theta, sigma_x, sigma_y)[0]
     expo_1 = term_1 * (x ** 2)
     expo_2 = term_2 * x * y
     expo_3 = term_3 * (y ** 2)
@@ -61,6 +53,210 @@ def gaussian_2D_function(xy, x0, y0, theta, sigma_x, sigma_y, amplitude):
     return gaussvals
 
 
+def gaussian_2D_terms(theta, sigma_x, sigma_y):
+    """
+    Coefficients of the exponent of a rotated 2D Gaussian
+    and their derivatives
+
+    Parameters
+    ----------
+    theta:   float
+             Rotation of the 2D gaussian peak in radians
+    sigma_x: float
+             Standard deviation of the 2D Gaussian along x
+    sigma_y: float
+             Standard deviation of the 2D Gaussian along y
+
+    Returns
+    -------
+    terms:   tuple
+             The coefficients of x^2, xy and y^2 in the exponent
+    d_theta: tuple
+             Derivatives of the coefficients with respect to theta
+    d_sig_x: tuple
+             Derivatives of the coefficients with respect to sigma_x
+    d_sig_y: tuple
+             Derivatives of the coefficients with respect to sigma_y
+
+    Notes
+    -----
+    The trigonometric terms only depend on the parameters, so they
+    are calculated once here for every parameter set, and not for
+    every position. The parameters may be arrays, such as columns
+    of parameters for many Gaussians, as long as they broadcast
+    against the positions.
+    """
+    cos_2 = (np.cos(theta)) ** 2
+    sin_2 = (np.sin(theta)) ** 2
+    sin_2t = np.sin(2 * theta)
+    cos_2t = np.cos(2 * theta)
+    inv_x = 1 / (2 * (sigma_x ** 2))
+    inv_y = 1 / (2 * (sigma_y ** 2))
+    term_1 = (cos_2 / (2 * (sigma_x ** 2))) + (sin_2 / (2 * (sigma_y ** 2)))
+    term_2 = (sin_2t / (2 * (sigma_x ** 2))) - (sin_2t / (2 * (sigma_y ** 2)))
+    term_3 = (sin_2 / (2 * (sigma_x ** 2))) + (cos_2 / (2 * (sigma_y ** 2)))
+    d_theta = (
+        sin_2t * (inv_y - inv_x),
+        2 * cos_2t * (inv_x - inv_y),
+        sin_2t * (inv_x - inv_y),
+    )
+    d_sig_x = (
+        (-2) * inv_x * cos_2 / sigma_x,
+        (-2) * inv_x * sin_2t / sigma_x,
+        (-2) * inv_x * sin_2 / sigma_x,
+    )
+    d_sig_y = (
+        (-2) * inv_y * sin_2 / sigma_y,
+        2 * inv_y * sin_2t / sigma_y,
+        (-2) * inv_y * cos_2 / sigma_y,
+    )
+    return (term_1, term_2, term_3), d_theta, d_sig_x, d_sig_y
+
+
+def gaussian_2D_fused(xy, x0, y0, theta, sigma_x, sigma_y, amplitude):
+    """
+    Values and analytic Jacobian of the 2D Gaussian function
+    from a single evaluation
+
+    Parameters
+    ----------
+    xy:        tuple
+               x and y positions
+    x0:        float
+               x center of Gaussian peak
+    y0:        float
+               y center of Gaussian peak
+    theta:     float
+               Rotation of the 2D gaussian peak in radians
+    sigma_x:   float
+               Standard deviation of the 2D Gaussian along x
+    sigma_y:   float
+               Standard deviation of the 2D Gaussian along y
+    amplitude: float
+               Peak intensity
+
+    Returns
+    -------
+    gaussvals: ndarray
+               The Gaussian at the positions, in the shape
+               the positions and parameters broadcast to
+    jacobian:  ndarray
+               Derivatives of the Gaussian with respect to the
+               six parameters, stacked along the first axis
+
+    Notes
+    -----
+    All the derivatives are the Gaussian itself times a polynomial
+    in the position, so the exponential is calculated once and shared
+    by the values and all six derivatives. Finite difference Jacobians
+    need six more full evaluations of the Gaussian instead.
+
+    See also
+    --------
+    gaussian_2D_function
+    gaussian_2D_jacobian
+    gaussian_2D_terms
+    """
+    x = xy[0] - x0
+    y = xy[1] - y0
+    terms, d_theta, d_sig_x, d_sig_y = gaussian_2D_terms(theta, sigma_x, sigma_y)
+    xx_2 = x ** 2
+    xy_2 = x * y
+    yy_2 = y ** 2
+    expo = np.exp(
+        (-1) * ((terms[0] * xx_2) + (terms[1] * xy_2) + (terms[2] * yy_2))
+    )
+    gaussvals = amplitude * expo
+    jacobian = np.empty((6,) + np.shape(gaussvals), dtype=np.float64)
+    jacobian[0] = gaussvals * ((2 * terms[0] * x) + (terms[1] * y))
+    jacobian[1] = gaussvals * ((terms[1] * x) + (2 * terms[2] * y))
+    jacobian[2] = (-gaussvals) * (
+        (d_theta[0] * xx_2) + (d_theta[1] * xy_2) + (d_theta[2] * yy_2)
+    )
+    jacobian[3] = (-gaussvals) * (
+        (d_sig_x[0] * xx_2) + (d_sig_x[1] * xy_2) + (d_sig_x[2] * yy_2)
+    )
+    jacobian[4] = (-gaussvals) * (
+        (d_sig_y[0] * xx_2) + (d_sig_y[1] * xy_2) + (d_sig_y[2] * yy_2)
+    )
+    jacobian[5] = expo
+    return gaussvals, jacobian
+
+
+def gaussian_2D_jacobian(xy, x0, y0, theta, sigma_x, sigma_y, amplitude):
+    """
+    Analytic Jacobian of `gaussian_2D_function`, of shape
+    (positions, 6), in the form `scipy.optimize.curve_fit`
+    accepts as `jac`
+    """
+    _, jacobian = gaussian_2D_fused(xy, x0, y0, theta, sigma_x, sigma_y, amplitude)
+    return np.transpose(np.reshape(jacobian, (6, -1)))
+
+
+def fused_curve_fit(model, xdata, ydata, p0, bounds, ftol=1e-08, xtol=1e-08):
+    """
+    Bounded least squares fit of a model that returns its
+    values and Jacobian together
+
+    Parameters
+    ----------
+    model: callable
+           Called as model(xdata, *params), returning the
+           values and the Jacobian, such as `gaussian_2D_fused`
+    xdata: ndarray
+           Positions passed to the model
+    ydata: ndarray
+           Data to be fitted
+    p0:    ndarray
+           Starting parameters
+    bounds: tuple
+            Lower and upper bounds of the parameters
+    ftol:  float, optional
+           Tolerance of the cost. Default is 1e-08
+    xtol:  float, optional
+           Tolerance of the parameters. Default is 1e-08
+
+    Returns
+    -------
+    popt: ndarray
+          Fitted parameters
+
+    Notes
+    -----
+    This runs the same trust region reflective solver as
+    `scipy.optimize.curve_fit` with bounds. The Jacobian is always
+    requested at the parameters where the residuals were just
+    calculated, so the Jacobian from that model evaluation is kept
+    and handed back instead of evaluating the model again.
+    """
+    ydata = np.ravel(ydata)
+    cache = {}
+
+    def residuals(params):
+        values, jacobian = model(xdata, *params)
+        cache["params"] = np.copy(params)
+        cache["jacobian"] = np.transpose(np.reshape(jacobian, (-1, ydata.size)))
+        return np.ravel(values) - ydata
+
+    def jacobian(params):
+        if not np.array_equal(cache.get("params"), params):
+            residuals(params)
+        return cache["jacobian"]
+
+    result = spo.least_squares(
+        residuals,
+        np.asarray(p0, dtype=np.float64),
+        jac=jacobian,
+        bounds=bounds,
+        method="trf",
+        ftol=ftol,
+        xtol=xtol,
+    )
+    if not result.success:
+        raise RuntimeError("Optimal parameters not found: " + result.message)
+    return result.x
+
+
 def gauss2D(im_size, x0, y0, theta, sigma_x, sigma_y, amplitude):
     """
     Return a 2D Gaussian function centered at x0, y0
@@ -214,11 +410,15 @@ def fit_gaussian2D_mask(
     
     Notes
     -----
-    This code uses the `scipy.optimize.curve_fit` module to fit a 2D
-    Gaussian peak to masked data. `mask_x` and `mask_y` refer to the
+    This code uses the same solver as the `scipy.optimize.curve_fit`
+    module to fit a 2D Gaussian peak to masked data, with the analytic
+    Jacobian from `gaussian_2D_fused`. `mask_x` and `mask_y` refer to the
     initial starting positions. Also, this can take in `minima` as a
     string for initializing Gaussian peaks, which allows for atom column
     mapping in inverted contrast images too.
+    Only the bounding box of the mask is read from the image, so the
+    cost does not depend on the image size, and pixels that are not
+    finite, such as NaN padding, are left out of the fit.
     
     See also
     --------
@@ -229,7 +429,12 @@ def fit_gaussian2D_mask(
     Debangshu Mukherjee <mukherjeed@ornl.gov>
     """
     p, q = np.shape(image_data)
-    yV, xV = np.mgrid[0:p, 0:q]
+    y_start = int(np.clip(np.floor(mask_y - mask_radius), 0, p))
+    y_stop = int(np.clip(np.ceil(mask_y + mask_radius) + 1, 0, p))
+    x_start = int(np.clip(np.floor(mask_x - mask_radius), 0, q))
+    x_stop = int(np.clip(np.ceil(mask_x + mask_radius) + 1, 0, q))
+    yV, xV = np.mgrid[y_start:y_stop, x_start:x_stop]
+    image_box = image_data[y_start:y_stop, x_start:x_stop]
     if mask_type == "circular":
         sub = ((((yV - mask_y) ** 2) + ((xV - mask_x) ** 2)) ** 0.5) < mask_radius
     elif mask_type == "square":
@@ -238,9 +443,10 @@ def fit_gaussian2D_mask(
         )
     else:
         raise ValueError("Unknown Mask Type")
+    sub = np.logical_and(sub, np.isfinite(image_box))
     x_pos = np.asarray(xV[sub], dtype=np.float64)
     y_pos = np.asarray(yV[sub], dtype=np.float64)
-    masked_image = np.asarray(image_data[sub], dtype=np.float64)
+    masked_image = np.asarray(image_box[sub], dtype=np.float64)
     mi_min = np.amin(masked_image)
     mi_max = np.amax(masked_image)
     if center_type == "minima":
@@ -266,8 +472,8 @@ def fit_gaussian2D_mask(
         (2.5 * initial_guess[5]),
     )
     xy = (x_pos, y_pos)
-    popt, _ = spo.curve_fit(
-        gaussian_2D_function,
+    popt = fused_curve_fit(
+        gaussian_2D_fused,
         xy,
         calc_image,
         initial_guess,
@@ -281,6 +487,172 @@ def fit_gaussian2D_mask(
     return popt
 
 
+def initialize_gauss2D_batch(xx, yy, zz, mask):
+    """
+    Approximate Gaussians for many sets of points at once
+
+    Parameters
+    ----------
+    xx:   ndarray
+          X positions of shape (N, P)
+    yy:   ndarray
+          Y positions of shape (N, P)
+    zz:   ndarray
+          Normalized image values at the positions
+    mask: ndarray
+          Boolean array, which is True for the points
+          that belong to every set
+
+    Returns
+    -------
+    gauss_ini: ndarray
+               Shape is (N, 6), as X_center, Y_center, Angle,
+               X_std, Y_std, Amplitude for every set
+
+    Notes
+    -----
+    This is the `COM` initialization of `initialize_gauss2D`
+    applied to every row, where the points outside the mask
+    are ignored.
+
+    See Also
+    --------
+    initialize_gauss2D
+    """
+    zz = np.where(mask, zz, 0)
+    total = np.sum(zz, axis=1)
+    x_com = np.sum(xx * zz, axis=1) / total
+    y_com = np.sum(yy * zz, axis=1) / total
+    z_min = np.amin(np.where(mask, zz, np.inf), axis=1)
+    z_max = np.amax(np.where(mask, zz, -np.inf), axis=1)
+    half_max = np.logical_and(
+        mask, ((zz - z_min[:, None]) / (z_max - z_min)[:, None]) > 0.5
+    )
+    x_fwhm = np.amax(np.where(half_max, np.abs(xx - x_com[:, None]), 0), axis=1)
+    y_fwhm = np.amax(np.where(half_max, np.abs(yy - y_com[:, None]), 0), axis=1)
+    gauss_ini = np.zeros((len(xx), 6), dtype=np.float64)
+    gauss_ini[:, 0] = x_com
+    gauss_ini[:, 1] = y_com
+    gauss_ini[:, 3] = x_fwhm / (2 * ((2 * np.log(2)) ** 0.5))
+    gauss_ini[:, 4] = y_fwhm / (2 * ((2 * np.log(2)) ** 0.5))
+    gauss_ini[:, 5] = z_max
+    return gauss_ini
+
+
+def fit_gaussian2D_batch(
+    xx, yy, zz, mask, initial, lower, upper, tol_val=0.01, max_iter=50
+):
+    """
+    Fit 2D Gaussians to many sets of points at once
+
+    Parameters
+    ----------
+    xx:       ndarray
+              X positions of shape (N, P)
+    yy:       ndarray
+              Y positions of shape (N, P)
+    zz:       ndarray
+              Values at the positions
+    mask:     ndarray
+              Boolean array, which is True for the points
+              that belong to every set
+    initial:  ndarray
+              Starting parameters of shape (N, 6), in the order
+              of `gaussian_2D_function`
+    lower:    ndarray
+              Lower bounds of the parameters, of shape (N, 6)
+    upper:    ndarray
+              Upper bounds of the parameters, of shape (N, 6)
+    tol_val:  float, optional
+              Relative tolerance of the cost and the parameters.
+              Default is 0.01
+    max_iter: int, optional
+              Maximum number of iterations. Default is 50
+
+    Returns
+    -------
+    popt: ndarray
+          Fitted parameters of shape (N, 6)
+
+    Notes
+    -----
+    This is a Levenberg-Marquardt least squares solver that works on
+    all the N fits together. Every iteration builds the analytic
+    Jacobians of all the fits with `gaussian_2D_fused`, solves the
+    N damped 6x6 normal equations with one batched call, and accepts
+    or rejects the step of every fit separately, adapting its own
+    damping. The steps are clipped to the
+    bounds. The damping never drops below one, so every fit creeps
+    from its starting point to the closest minimum instead of jumping
+    to a far away one, and a fit stops once its cost improves by less
+    than `tol_val`, much like `scipy.optimize.curve_fit` with the same
+    tolerances does. Fits that have converged drop out of the following
+    iterations, so the cost of every iteration shrinks as the fits
+    finish.
+
+    See Also
+    --------
+    fit_gaussian2D_mask
+    gaussian_2D_fused
+    """
+    xx = np.asarray(xx, dtype=np.float64)
+    yy = np.asarray(yy, dtype=np.float64)
+    weights = np.asarray(mask, dtype=np.float64)
+    zz = np.where(mask, zz, 0)
+    lower = np.asarray(lower, dtype=np.float64)
+    upper = np.asarray(upper, dtype=np.float64)
+    popt = np.clip(np.asarray(initial, dtype=np.float64), lower, upper)
+
+    def residuals(sel, params, jacobian=False):
+        xy = (xx[sel], yy[sel])
+        params = tuple(params[:, ii : (ii + 1)] for ii in range(6))
+        if not jacobian:
+            gauss = np.reshape(gaussian_2D_function(xy, *params), xy[0].shape)
+            return weights[sel] * (gauss - zz[sel])
+        gauss, jac = gaussian_2D_fused(xy, *params)
+        res = weights[sel] * (gauss - zz[sel])
+        return res, np.transpose(jac, (1, 0, 2)) * weights[sel][:, None, :]
+
+    all_sets = np.arange(len(popt))
+    res = residuals(all_sets, popt)
+    cost = np.sum(res ** 2, axis=1)
+    damping = np.ones(len(popt), dtype=np.float64)
+    active = np.ones(len(popt), dtype=bool)
+    diag = np.arange(6)
+    for _ in range(max_iter):
+        sel = all_sets[active]
+        if len(sel) == 0:
+            break
+        params = popt[sel]
+        res_sel, jacobian = residuals(sel, params, True)
+        jtj = np.matmul(jacobian, np.transpose(jacobian, (0, 2, 1)))
+        jtr = np.matmul(jacobian, res_sel[:, :, None])
+        lhs = np.copy(jtj)
+        lhs[:, diag, diag] += (damping[sel, None] * jtj[:, diag, diag]) + 1e-12
+        delta = -np.linalg.solve(lhs, jtr)[:, :, 0]
+        new_params = np.clip(params + delta, lower[sel], upper[sel])
+        new_res = residuals(sel, new_params)
+        new_cost = np.sum(new_res ** 2, axis=1)
+        better = new_cost < cost[sel]
+        converged = np.logical_or(
+            (cost[sel] - new_cost) <= (tol_val * cost[sel]),
+            np.all(
+                np.abs(new_params - params) <= (tol_val * (np.abs(params) + tol_val)),
+                axis=1,
+            ),
+        )
+        accepted = sel[better]
+        popt[accepted] = new_params[better]
+        res[accepted] = new_res[better]
+        cost[accepted] = new_cost[better]
+        damping[sel] = np.where(
+            better, np.maximum(damping[sel] / 10, 1), damping[sel] * 10
+        )
+        active[sel[np.logical_and(better, converged)]] = False
+        active[damping > 1e10] = False
+    return popt
+
+
 def gaussian_1D_function(x, x0, sigma_x, amplitude):
     """
     The underlying 1D Gaussian function
@@ -322,6 +694,55 @@ def gaussian_1D_function(x, x0, sigma_x, amplitude):
     return gaussvals
 
 
+def gaussian_1D_fused(x, x0, sigma_x, amplitude):
+    """
+    Values and analytic Jacobian of the 1D Gaussian function
+    from a single evaluation
+
+    Parameters
+    ----------
+    x:         ndarray
+               x positions
+    x0:        float
+               x center of Gaussian peak
+    sigma_x:   float
+               Standard deviation of the Gaussian
+    amplitude: float
+               Peak intensity
+
+    Returns
+    -------
+    gaussvals: ndarray
+               The Gaussian at the positions
+    jacobian:  ndarray
+               Derivatives of the Gaussian with respect to the
+               three parameters, stacked along the first axis
+
+    See also
+    --------
+    gaussian_1D_function
+    gaussian_2D_fused
+    """
+    x = x - x0
+    inv_var = 1 / (sigma_x ** 2)
+    expo = np.exp((-0.5) * (x ** 2) * inv_var)
+    gaussvals = amplitude * expo
+    jacobian = np.empty((3,) + np.shape(gaussvals), dtype=np.float64)
+    jacobian[0] = gaussvals * x * inv_var
+    jacobian[1] = gaussvals * (x ** 2) * inv_var / sigma_x
+    jacobian[2] = expo
+    return gaussvals, jacobian
+
+
+def gaussian_1D_jacobian(x, x0, sigma_x, amplitude):
+    """
+    Analytic Jacobian of `gaussian_1D_function`, in the form
+    `scipy.optimize.curve_fit` accepts as `jac`
+    """
+    _, jacobian = gaussian_1D_fused(x, x0, sigma_x, amplitude)
+    return np.transpose(np.reshape(jacobian, (3, -1)))
+
+
 def initialize_gauss1D(xx, yy, center_type="COM"):
     """
     Generate an approximate Gaussian based on signal
@@ -411,26 +832,26 @@ def fit_gaussian1D_mask(signal, position, mask_width, center_type="COM"):
     :Authors:
     Debangshu Mukherjee <mukherjeed@ornl.gov>
     """
-    xV = np.arange(np.len(signal))
+    xV = np.arange(len(signal))
     sub = np.abs(xV - position) < mask_width
-    x_pos = np.asarray(xV[sub], dtype=np.float)
-    masked_signal = np.asarray(signal[sub], dtype=np.float)
+    x_pos = np.asarray(xV[sub], dtype=np.float64)
+    masked_signal = np.asarray(signal[sub], dtype=np.float64)
     mi_min = np.amin(masked_signal)
     mi_max = np.amax(masked_signal)
     if center_type == "minima":
         calc_signal = (masked_signal - mi_max) / (mi_min - mi_max)
         initial_guess = initialize_gauss1D(x_pos, calc_signal, "maxima")
     else:
-        calc_image = (masked_image - mi_min) / (mi_max - mi_min)
+        calc_signal = (masked_signal - mi_min) / (mi_max - mi_min)
         initial_guess = initialize_gauss1D(x_pos, calc_signal, center_type)
-    lower_bound = ((initial_guess[0] - mask_width), 0, ((-2.5) * initial_guess[5]))
+    lower_bound = ((initial_guess[0] - mask_width), 0, ((-2.5) * initial_guess[2]))
     upper_bound = (
-        (initial_guess[0] + mask_radius),
-        (2.5 * mask_radius),
-        (2.5 * initial_guess[5]),
+        (initial_guess[0] + mask_width),
+        (2.5 * mask_width),
+        (2.5 * initial_guess[2]),
     )
-    popt, _ = spo.curve_fit(
-        gaussian_1D_function,
+    popt = fused_curve_fit(
+        gaussian_1D_fused,
         x_pos,
         calc_signal,
         initial_guess,
@@ -511,6 +511,7 @@ def sobel_circle(image):
         xdata=np.ravel(rr),
         ydata=np.ravel(sobel_image),
         p0=initial_guess,
+        jac=st.util.gaussian_1D_jacobian,
     )
     radius = popt[0]
     return center_x, center_y, radius
@@ -701,3 +702,45 @@ def cp_image_val(comp_image):
     hsv_image[:, :, 2] = real_image
     colored_image = skc.hsv2rgb(hsv_image)
     return colored_image
+
+
+def tile_slices(length, tile_size, overlap):
+    """
+    Split an image axis into overlapping tiles
+
+    Parameters
+    ----------
+    length:    int
+               Number of pixels along the axis
+    tile_size: int
+               Size of every tile, including the overlap
+    overlap:   int
+               Number of pixels shared by neighboring tiles
+
+    Returns
+    -------
+    tiles: list
+           List of tuples as (window_start, window_stop,
+           core_start, core_stop) for every tile
+
+    Notes
+    -----
+    The cores of the tiles cover the axis exactly once, and
+    every window extends half the overlap beyond its core on
+    either side, except at the edges of the image. Only the core
+    of a tile is kept, so whatever goes wrong near the edges of a
+    tile, such as windowing or missing neighbors, never reaches
+    the output.
+    """
+    overlap = int(overlap)
+    step = int(tile_size) - overlap
+    if step < 1:
+        raise ValueError("The overlap must be smaller than the tile size")
+    half_overlap = int(overlap / 2)
+    tiles = []
+    for core_start in range(0, int(length), step):
+        core_stop = int(min(core_start + step, length))
+        window_start = int(max(core_start - half_overlap, 0))
+        window_stop = int(min(core_stop + (overlap - half_overlap), length))
+        tiles.append((window_start, window_stop, core_start, core_stop))
+    return tiles
@@ -0,0 +1,196 @@
+import numpy as np
+import functools
+
+
+@functools.lru_cache(maxsize=4)
+def raster_polygon(imshape, vertices):
+    """
+    Rasterize a polygon with the even-odd rule
+
+    Parameters
+    ----------
+    imshape:  tuple
+              Shape of the image as (Y, X)
+    vertices: tuple
+              Tuple of (x, y) tuples with the vertices of
+              the polygon in pixels
+
+    Returns
+    -------
+    poly_mask: ndarray
+               Read-only boolean mask, which is True for the
+               pixels whose centers are inside the polygon
+
+    Notes
+    -----
+    For every pixel row, the crossings of the row with the edges of
+    the polygon are found, and the pixel in which every crossing lies
+    is toggled. A cumulative exclusive or along the row then marks the
+    pixels between odd and even crossings. This works for any polygon,
+    convex or not, irrespective of the order of the vertices, and the
+    only full size array is the mask itself. The results for the last
+    few geometries are cached, which is why the returned mask is
+    read-only - use `polygon_mask` for the public interface. As every
+    cached mask is as large as the image, the cache only holds four of
+    them, and `raster_polygon.cache_clear()` frees them all.
+
+    See Also
+    --------
+    polygon_mask
+    """
+    im_y = int(imshape[0])
+    im_x = int(imshape[1])
+    poly = np.asarray(vertices, dtype=np.float64)
+    x_start = poly[:, 0]
+    y_start = poly[:, 1]
+    x_stop = np.roll(x_start, -1)
+    y_stop = np.roll(y_start, -1)
+    toggles = np.zeros((im_y, im_x + 1), dtype=np.uint8)
+    for ii in range(poly.shape[0]):
+        if y_start[ii] == y_stop[ii]:
+            continue
+        y_low = min(y_start[ii], y_stop[ii])
+        y_high = max(y_start[ii], y_stop[ii])
+        rows = np.arange(
+            int(np.clip(np.ceil(y_low), 0, im_y)),
+            int(np.clip(np.ceil(y_high), 0, im_y)),
+        )
+        crossings = x_start[ii] + (
+            (rows - y_start[ii])
+            * ((x_stop[ii] - x_start[ii]) / (y_stop[ii] - y_start[ii]))
+        )
+        columns = np.clip(np.ceil(crossings), 0, im_x).astype(int)
+        np.bitwise_xor.at(toggles, (rows, columns), 1)
+    poly_mask = np.bitwise_xor.accumulate(toggles, axis=1)[:, 0:im_x].astype(bool)
+    poly_mask.setflags(write=False)
+    return poly_mask
+
+
+def polygon_mask(imshape, vertices):
+    """
+    Boolean mask of a polygonal region
+
+    Parameters
+    ----------
+    imshape:  tuple
+              Shape of the image as (Y, X)
+    vertices: ndarray
+              Vertices of the polygon as (x, y) pixel positions,
+              of shape (N, 2)
+
+    Returns
+    -------
+    poly_mask: ndarray
+               Boolean mask which is True inside the polygon.
+               The mask is cached and read-only, so copy it before
+               modifying it.
+
+    Examples
+    --------
+    >>> ref_reg = st.util.polygon_mask(image.shape, ((10, 10), (90, 15), (50, 80)))
+
+    See Also
+    --------
+    raster_polygon
+    ellipse_mask
+    """
+    imshape = tuple(int(ii) for ii in imshape[0:2])
+    vertices = tuple(
+        (float(vv[0]), float(vv[1])) for vv in np.reshape(np.asarray(vertices), (-1, 2))
+    )
+    if len(vertices) < 3:
+        raise ValueError("A polygon needs at least three vertices")
+    return raster_polygon(imshape, vertices)
+
+
+@functools.lru_cache(maxsize=4)
+def raster_ellipse(imshape, center, axes, angle):
+    """
+    Rasterize a rotated ellipse
+
+    Parameters
+    ----------
+    imshape: tuple
+             Shape of the image as (Y, X)
+    center:  tuple
+             Center of the ellipse as (x, y) in pixels
+    axes:    tuple
+             Semi-axes of the ellipse in pixels, the first of
+             which is along X before rotation
+    angle:   float
+             Counter-clockwise rotation in degrees
+
+    Returns
+    -------
+    ell_mask: ndarray
+              Read-only boolean mask, which is True for the
+              pixels whose centers are inside the ellipse
+
+    Notes
+    -----
+    Only the bounding box of the ellipse is evaluated. Like
+    `raster_polygon`, the masks of the last four geometries are
+    cached, and `raster_ellipse.cache_clear()` frees them.
+
+    See Also
+    --------
+    ellipse_mask
+    """
+    im_y = int(imshape[0])
+    im_x = int(imshape[1])
+    theta = np.deg2rad(angle)
+    half_x = ((axes[0] * np.cos(theta)) ** 2 + (axes[1] * np.sin(theta)) ** 2) ** 0.5
+    half_y = ((axes[0] * np.sin(theta)) ** 2 + (axes[1] * np.cos(theta)) ** 2) ** 0.5
+    y_start = int(np.clip(np.floor(center[1] - half_y), 0, im_y))
+    y_stop = int(np.clip(np.ceil(center[1] + half_y) + 1, 0, im_y))
+    x_start = int(np.clip(np.floor(center[0] - half_x), 0, im_x))
+    x_stop = int(np.clip(np.ceil(center[0] + half_x) + 1, 0, im_x))
+    yy, xx = np.mgrid[y_start:y_stop, x_start:x_stop]
+    yy = yy - center[1]
+    xx = xx - center[0]
+    x_rot = (xx * np.cos(theta)) + (yy * np.sin(theta))
+    y_rot = (yy * np.cos(theta)) - (xx * np.sin(theta))
+    ell_mask = np.zeros((im_y, im_x), dtype=bool)
+    ell_mask[y_start:y_stop, x_start:x_stop] = (
+        ((x_rot / axes[0]) ** 2) + ((y_rot / axes[1]) ** 2)
+    ) <= 1
+    ell_mask.setflags(write=False)
+    return ell_mask
+
+
+def ellipse_mask(imshape, center, axes, angle=0):
+    """
+    Boolean mask of an elliptical region
+
+    Parameters
+    ----------
+    imshape: tuple
+             Shape of the image as (Y, X)
+    center:  tuple
+             Center of the ellipse as (x, y) in pixels
+    axes:    tuple
+             Semi-axes of the ellipse in pixels. A single
+             number gives a circle.
+    angle:   float, optional
+             Counter-clockwise rotation in degrees. Default is 0
+
+    Returns
+    -------
+    ell_mask: ndarray
+              Boolean mask which is True inside the ellipse.
+              The mask is cached and read-only, so copy it before
+              modifying it.
+
+    See Also
+    --------
+    raster_ellipse
+    polygon_mask
+    """
+    imshape = tuple(int(ii) for ii in imshape[0:2])
+    center = (float(center[0]), float(center[1]))
+    axes = np.ravel(np.asarray(axes, dtype=np.float64))
+    if axes.size == 1:
+        axes = np.repeat(axes, 2)
+    if np.any(axes <= 0):
+        raise ValueError("The semi-axes of the ellipse must be positive")
+    return raster_ellipse(imshape, center, (axes[0], axes[1]), float(angle))
@@ -0,0 +1,317 @@
+import numpy as np
+import pytest
+import scipy.ndimage as scnd
+import scipy.optimize as spo
+import stemtool as st
+
+
+def brute_remove_close_vals(input_arr, limit):
+    result = np.copy(input_arr)
+    ii = 0
+    newlen = len(result)
+    while ii < newlen:
+        dist = (np.sum(((result[:, 0:2] - result[ii, 0:2]) ** 2), axis=1)) ** 0.5
+        distbool = dist > limit
+        distbool[ii] = True
+        result = np.copy(result[distbool, :])
+        ii = ii + 1
+        newlen = len(result)
+    return result
+
+
+def brute_nearest_distance(positions):
+    dist = np.sum(
+        (positions[:, None, 0:2] - positions[None, :, 0:2]) ** 2, axis=-1
+    ) ** 0.5
+    dist[dist == 0] = np.inf
+    return np.amin(dist, axis=1)
+
+
+def random_lattice(seed=0):
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:20, 0:20]
+    positions = 10.0 * np.stack((np.ravel(yy), np.ravel(xx)), axis=1)
+    positions += rng.normal(0, 1.5, positions.shape)
+    return positions
+
+
+def test_nearest_distance():
+    positions = random_lattice()
+    index = st.afit.atom_index(positions)
+    assert np.allclose(index.nearest_distance(), brute_nearest_distance(positions))
+    assert np.isclose(
+        index.median_distance(), np.median(brute_nearest_distance(positions))
+    )
+    assert np.isclose(
+        st.afit.med_dist_numba(positions),
+        0.5 * np.median(brute_nearest_distance(positions)),
+    )
+
+
+def test_within():
+    positions = random_lattice()
+    index = st.afit.atom_index(positions)
+    points = np.asarray([[50.0, 50.0], [0.0, 0.0], [123.4, 87.6]])
+    for point, found in zip(points, index.within(points, 12)):
+        dist = np.sum((positions - point) ** 2, axis=1) ** 0.5
+        assert sorted(found) == list(np.where(dist <= 12)[0])
+
+
+def test_remove_close_vals():
+    rng = np.random.default_rng(1)
+    positions = rng.uniform(0, 100, (400, 3))
+    for limit in (2, 5, 10):
+        assert np.array_equal(
+            st.afit.remove_close_vals(positions, limit),
+            brute_remove_close_vals(positions, limit),
+        )
+
+
+def gaussian_lattice(shape=(108, 108), spacing=10, sigma=1.5, noise=0.01, seed=2):
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0 : int(shape[0] / spacing), 0 : int(shape[1] / spacing)]
+    positions = spacing * np.stack((np.ravel(yy), np.ravel(xx)), axis=1) + 8.0
+    positions += rng.uniform(-1, 1, positions.shape)
+    image_y, image_x = np.mgrid[0 : shape[0], 0 : shape[1]]
+    image = np.zeros(shape, dtype=np.float64)
+    for pos in positions:
+        dist2 = ((image_y - pos[0]) ** 2) + ((image_x - pos[1]) ** 2)
+        image += np.exp(-dist2 / (2 * (sigma ** 2)))
+    image += rng.normal(0, noise, shape)
+    return image, positions
+
+
+def test_refine_atoms():
+    image, positions = gaussian_lattice()
+    starts = np.round(positions)
+    refined = st.afit.refine_atoms(image, starts)
+    error = np.amax(np.abs(refined[:, 0:2] - positions), axis=1)
+    assert np.amax(error) < 0.05
+    # At least as good as the old fits on the full image
+    med_dist = 0.5 * st.afit.atom_index(starts).median_distance()
+    full_image = np.asarray(
+        [st.util.fit_gaussian2D_mask(image, pos[1], pos[0], med_dist) for pos in starts]
+    )
+    old_error = np.amax(np.abs(np.flip(full_image[:, 0:2], axis=1) - positions), axis=1)
+    assert np.median(error) <= np.median(old_error)
+    # Workers and chunks don't change the fits
+    popt = st.afit.refine_patches(image, starts, med_dist, workers=2, chunk_size=16)
+    assert np.array_equal(np.flip(popt[:, 0:2], axis=1), refined[:, 0:2])
+    assert np.array_equal(popt[:, 2:6], refined[:, 2:6])
+
+
+def loop_mpfit(main_image, initial_peaks, peak_runs=16, cut_point=2 / 3, tol_val=0.01):
+    med_dist = np.median(brute_nearest_distance(initial_peaks))
+    mpfit_peaks = np.zeros_like(initial_peaks, dtype=np.float64)
+    yy, xx = np.mgrid[0 : main_image.shape[0], 0 : main_image.shape[1]]
+    cvals = np.zeros((peak_runs, 4), dtype=np.float64)
+    for jj in np.arange(len(initial_peaks)):
+        ystart = initial_peaks[jj, 0]
+        xstart = initial_peaks[jj, 1]
+        sub = np.logical_and(
+            np.abs(yy - ystart) < med_dist, np.abs(xx - xstart) < med_dist
+        )
+        xy = (xx[sub], yy[sub])
+        zvals = main_image[sub]
+        zcalc = np.zeros_like(zvals)
+        for ii in np.arange(peak_runs):
+            zvals = zvals - zcalc
+            z_range = np.amax(zvals) - np.amin(zvals)
+            zgaus = (zvals - np.amin(zvals)) / z_range
+            guess = st.util.initialize_gauss2D(xy[0], xy[1], zgaus)
+            popt, _ = spo.curve_fit(
+                st.util.gaussian_2D_function,
+                xy,
+                zgaus,
+                guess,
+                bounds=(
+                    (
+                        guess[0] - med_dist,
+                        guess[1] - med_dist,
+                        -180,
+                        0,
+                        0,
+                        -2.5 * guess[5],
+                    ),
+                    (
+                        guess[0] + med_dist,
+                        guess[1] + med_dist,
+                        180,
+                        2.5 * med_dist,
+                        2.5 * med_dist,
+                        2.5 * guess[5],
+                    ),
+                ),
+                ftol=tol_val,
+                xtol=tol_val,
+            )
+            cvals[ii, :] = (
+                popt[1],
+                popt[0],
+                (((popt[0] - xstart) ** 2) + ((popt[1] - ystart) ** 2)) ** 0.5,
+                popt[-1] * z_range,
+            )
+            zcalc = (st.util.gaussian_2D_function(xy, *popt) * z_range) + np.amin(zvals)
+        required = cvals[:, 2] < (cut_point * med_dist)
+        total = np.sum(cvals[required, 3])
+        mpfit_peaks[jj, 0] = np.sum(cvals[required, 0] * cvals[required, 3]) / total
+        mpfit_peaks[jj, 1] = np.sum(cvals[required, 1] * cvals[required, 3]) / total
+    return mpfit_peaks
+
+
+def test_mpfit():
+    image, positions = gaussian_lattice((64, 64), noise=0.02)
+    starts = np.round(positions)
+    # The atom by atom path reproduces the original mpfit
+    single = st.afit.mpfit(image, starts, batch=False)
+    assert np.array_equal(single, loop_mpfit(image, starts))
+    inner = np.all(np.logical_and(starts > 10, starts < 54), axis=1)
+    batched = st.afit.mpfit(image, starts)
+    assert np.median(np.abs(batched[inner] - positions[inner])) < 0.5
+    assert np.median(np.abs(single[inner] - positions[inner])) < 0.5
+    voronoi = st.afit.mpfit_voronoi(image, starts)
+    assert np.median(np.abs(voronoi[inner] - positions[inner])) < 1
+
+
+def test_joint_fit_dumbbells():
+    rng = np.random.default_rng(4)
+    cell_y, cell_x = np.mgrid[0:6, 0:6]
+    centers = 12.0 * np.stack((np.ravel(cell_y), np.ravel(cell_x)), axis=1) + 10
+    positions = np.concatenate((centers - [0, 1.4], centers + [0, 1.4]))
+    positions += rng.uniform(-0.3, 0.3, positions.shape)
+    image_y, image_x = np.mgrid[0:80, 0:80]
+    image = np.full((80, 80), 0.3)
+    for pos in positions:
+        dist2 = ((image_y - pos[0]) ** 2) + ((image_x - pos[1]) ** 2)
+        image += np.exp(-dist2 / (2 * (1.2 ** 2)))
+    image += rng.normal(0, 0.01, image.shape)
+    starts = positions + rng.uniform(-0.5, 0.5, positions.shape)
+    joint, background = st.afit.joint_fit(image, starts, radius=6, tile_size=0)
+    error = np.abs(joint[:, 0:2] - positions)
+    assert np.median(error) < 0.02
+    assert np.amax(error) < 0.2
+    assert np.allclose(background, 0.3, atol=0.02)
+    # The overlapping columns bias the separate fits
+    separate = st.afit.refine_atoms(image, starts)
+    assert np.median(error) < np.median(np.abs(separate[:, 0:2] - positions))
+    tiled, _ = st.afit.joint_fit(image, starts, radius=6, tile_size=48)
+    assert np.allclose(tiled[:, 0:2], joint[:, 0:2], atol=0.02)
+
+
+def test_track_atoms_drifting_lattice():
+    rng = np.random.default_rng(5)
+    cell_y, cell_x = np.mgrid[0:7, 0:7]
+    lattice = 10.0 * np.stack((np.ravel(cell_y), np.ravel(cell_x)), axis=1) + 12
+    no_frames = 8
+    drift = np.cumsum(rng.uniform(-0.8, 0.8, (no_frames, 2)), axis=0)
+    drift[0] = 0
+    image_y, image_x = np.mgrid[0:96, 0:96]
+    movie = np.zeros((no_frames, 96, 96), dtype=np.float64)
+    truth = np.zeros((no_frames, len(lattice), 2), dtype=np.float64)
+    for ii in range(no_frames):
+        truth[ii] = lattice + drift[ii] + rng.normal(0, 0.05, lattice.shape)
+        for jj, pos in enumerate(truth[ii]):
+            # Three columns vanish half way, and get refitted on noise
+            if (ii >= 3) and (jj in (10, 24, 30)):
+                continue
+            dist2 = ((image_y - pos[0]) ** 2) + ((image_x - pos[1]) ** 2)
+            movie[ii] += np.exp(-dist2 / (2 * (1.5 ** 2)))
+        movie[ii] += rng.normal(0, 0.02, (96, 96))
+    tracks, found_drift, refitted = st.afit.track_atoms(movie, np.round(lattice))
+    assert np.all(np.isfinite(tracks))
+    assert np.all(tracks[:, :, 3:5] > 0)
+    assert np.allclose(found_drift, drift, atol=0.05)
+    present = np.ones(len(lattice), dtype=bool)
+    present[[10, 24, 30]] = False
+    error = np.abs(tracks[:, present, 0:2] - truth[:, present])
+    assert np.median(error) < 0.1
+    assert np.amax(error) < 0.3
+    assert np.all(refitted[0])
+    assert np.all(refitted[3:, [10, 24, 30]])
+
+
+def drifting_stack(n=8, size=64, noise=0.01, seed=6):
+    rng = np.random.default_rng(seed)
+    base = scnd.gaussian_filter(rng.normal(size=(size, size)), 2, mode="wrap")
+    shifts = np.cumsum(rng.uniform(-1.5, 1.5, (n, 2)), axis=0)
+    shifts[0] = 0
+    qy = np.fft.fftfreq(size)[None, :, None]
+    qx = np.fft.fftfreq(size)[None, None, :]
+    ramp = qy * shifts[:, 0, None, None] + qx * shifts[:, 1, None, None]
+    stack = np.real(np.fft.ifft2(np.fft.fft2(base)[None] * np.exp(-2j * np.pi * ramp)))
+    stack += rng.normal(0, noise, stack.shape)
+    return stack, shifts
+
+
+def test_multi_image_drift_modes():
+    stack, shifts = drifting_stack()
+    expect_r = shifts[:, None, 0] - shifts[None, :, 0]
+    expect_c = shifts[:, None, 1] - shifts[None, :, 1]
+    for mode in ("all", "reference", "sequential", "sparse"):
+        corr = st.afit.multi_image_drift(stack, 100)
+        corr.get_shape_stack(mode=mode, reference=2)
+        assert np.allclose(corr.row_stack, expect_r, atol=0.02), mode
+        assert np.allclose(corr.col_stack, expect_c, atol=0.02), mode
+    with pytest.raises(ValueError):
+        st.afit.multi_image_drift(stack, 100).get_shape_stack(mode="bogus")
+
+
+def test_drift_average():
+    stack, shifts = drifting_stack(n=10)
+    mean_image, var_image, found = st.afit.drift_average(
+        stack, sampling=100, batch_size=4, variance=True
+    )
+    assert np.allclose(found, -shifts, atol=0.02)
+    q_y = np.fft.fftfreq(stack.shape[1])[None, :, None]
+    q_x = np.fft.fftfreq(stack.shape[2])[None, None, :]
+    ramp = q_y * found[:, 0, None, None] + q_x * found[:, 1, None, None]
+    moved = np.real(np.fft.ifft2(np.fft.fft2(stack) * np.exp(-2j * np.pi * ramp)))
+    assert np.allclose(mean_image, np.mean(moved, axis=0))
+    assert np.allclose(var_image, np.var(moved, axis=0))
+    single_mean, single_shifts = st.afit.drift_average(stack, 100, batch_size=1)
+    assert np.allclose(single_shifts, found, atol=0.02)
+    assert np.allclose(single_mean, mean_image, atol=0.01)
+    corr = st.afit.multi_image_drift(stack, 100)
+    stream_mean, stream_var = corr.stream_average(batch_size=4, variance=True)
+    assert np.allclose(stream_mean, mean_image)
+    assert np.allclose(stream_var, var_image)
+
+
+def test_nonrigid_average():
+    rng = np.random.default_rng(7)
+    size = 128
+    base = scnd.gaussian_filter(rng.normal(size=(size, size)), 2, mode="wrap")
+    yy, xx = np.mgrid[0:size, 0:size].astype(np.float64)
+    rigid = rng.uniform(-1.5, 1.5, (6, 2))
+    shear = rng.uniform(-1, 1, (6, 2))
+    fields = np.zeros((6, 2, size, size))
+    fields[:, 0] = rigid[:, 0, None, None] + shear[:, 0, None, None] * (xx / size - 0.5)
+    fields[:, 1] = rigid[:, 1, None, None] + shear[:, 1, None, None] * (yy / size - 0.5)
+    stack = np.asarray(
+        [
+            scnd.map_coordinates(base, [yy - field[0], xx - field[1]], mode="wrap")
+            for field in fields
+        ]
+    )
+    stack += rng.normal(0, 0.01, stack.shape)
+    corr_image, displacements, (cy, cx) = st.afit.nonrigid_average(
+        stack, patch_size=32, step=16
+    )
+    truth = fields[:, :, cy[:, None], cx[None, :]]
+    error = (displacements - np.mean(displacements, axis=0)) - (
+        truth - np.mean(truth, axis=0)
+    )
+    assert np.abs(error[:, :, 1:-1, 1:-1]).max() < 0.15
+    grid = st.afit.grid_coordinates(stack.shape[1:3], cy, cx)
+    warped = np.asarray(
+        [st.afit.warp_image(stack[ii], displacements[ii], grid) for ii in range(6)]
+    )
+    assert np.allclose(np.mean(warped, axis=0), corr_image)
+    _, rigid_var, _ = st.afit.drift_average(stack, 20, variance=True)
+    inner = np.s_[16:-16, 16:-16]
+    assert np.std(warped, axis=0)[inner].max() < np.sqrt(rigid_var)[inner].max()
+    par_image, par_displacements, _ = st.afit.nonrigid_average(
+        stack, patch_size=32, step=16, workers=2, chunk_size=2
+    )
+    assert np.allclose(par_image, corr_image)
+    assert np.allclose(par_displacements, displacements)
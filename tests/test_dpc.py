@@ -0,0 +1,101 @@
+import numpy as np
+import stemtool as st
+
+
+def shifted_disks(scan_shape=(6, 5), det_shape=(32, 32), radius=6, seed=0):
+    rng = np.random.default_rng(seed)
+    shifts = rng.uniform(-2, 2, scan_shape + (2,))
+    qy, qx = np.mgrid[0 : det_shape[0], 0 : det_shape[1]]
+    qy = qy - (0.5 * det_shape[0])
+    qx = qx - (0.5 * det_shape[1])
+    data4D = np.zeros(det_shape + scan_shape, dtype=np.float64)
+    for ii in range(scan_shape[0]):
+        for jj in range(scan_shape[1]):
+            dist2 = ((qy - shifts[ii, jj, 0]) ** 2) + ((qx - shifts[ii, jj, 1]) ** 2)
+            data4D[:, :, ii, jj] = dist2 <= (radius ** 2)
+    return data4D, shifts
+
+
+def test_segmented_dpc():
+    data4D, shifts = shifted_disks()
+    seg_images, dpc_x, dpc_y, _ = st.dpc.segmented_dpc(data4D, 0, 12, chunk_size=4)
+    qy, qx = np.mgrid[0:32, 0:32] - 16
+    rr = ((qy ** 2) + (qx ** 2)) ** 0.5
+    phi = np.mod(np.arctan2(qy, qx), 2 * np.pi)
+    for seg in range(4):
+        seg_mask = np.logical_and(
+            rr <= 12,
+            np.logical_and(phi >= (seg * np.pi / 2), phi < ((seg + 1) * np.pi / 2)),
+        )
+        brute = np.sum(data4D[seg_mask, :, :], axis=0)
+        assert np.allclose(seg_images[seg], brute)
+    # The differential signals follow the beam shift
+    assert np.corrcoef(np.ravel(dpc_x), np.ravel(shifts[..., 1]))[0, 1] > 0.95
+    assert np.corrcoef(np.ravel(dpc_y), np.ravel(shifts[..., 0]))[0, 1] > 0.95
+
+
+def test_progressive_4D():
+    data4D, shifts = shifted_disks(scan_shape=(8, 7))
+    qy, qx = np.mgrid[0:32, 0:32]
+    total = np.sum(data4D, axis=(0, 1))
+    com_x = np.einsum("ij,ijkl->kl", qx, data4D) / total
+    com_y = np.einsum("ij,ijkl->kl", qy, data4D) / total
+    aperture_mask = (((qy - 14) ** 2) + ((qx - 18) ** 2)) <= 25
+    preview = st.dpc.progressive_4D(
+        data4D,
+        apertures=[(18, 14, 5)],
+        levels=((2, 2), (1, 1)),
+        center=(16, 16),
+        chunk_size=3,
+    )
+    coarse = preview.start()
+    full = preview.wait()
+    assert preview.done
+    assert coarse["com_x"].shape == (4, 4)
+    # The coarse level only differs by the detector binning
+    assert np.allclose(coarse["com_x"], com_x[::2, ::2] - 16, atol=0.1)
+    assert np.allclose(coarse["com_y"], com_y[::2, ::2] - 16, atol=0.1)
+    assert np.allclose(full["com_x"], com_x - 16)
+    assert np.allclose(full["com_y"], com_y - 16)
+    assert np.allclose(full["virtual"][0], np.sum(data4D[aperture_mask], axis=0))
+    scan_first = st.dpc.progressive_4D(
+        np.transpose(data4D, (2, 3, 0, 1)),
+        levels=((1, 1),),
+        center=(16, 16),
+        scan_first=True,
+    )
+    assert np.allclose(scan_first.start()["com_x"], full["com_x"])
+
+
+def test_ssb_ptycho_weak_phase():
+    size = 64
+    pixel = 0.25
+    alpha = (20 / 1000) / st.sim.wavelength_ang(300)
+    kk = np.fft.fftfreq(size, pixel)
+    probe = np.fft.ifft2(
+        np.asarray(np.hypot(kk[:, None], kk[None, :]) <= alpha, dtype=np.complex128)
+    )
+    yy, xx = np.mgrid[0:size, 0:size]
+    phase_obj = (0.1 * np.cos(2 * np.pi * xx / 16)) + (
+        0.05 * np.sin(2 * np.pi * yy / 32)
+    )
+    step = 2
+    scan = int(size / step)
+    data4D = np.zeros((size, size, scan, scan), dtype=np.float64)
+    for ii in range(scan):
+        for jj in range(scan):
+            wave = np.roll(probe, (ii * step, jj * step), axis=(0, 1))
+            wave = wave * np.exp(1j * phase_obj)
+            data4D[:, :, ii, jj] = np.abs(np.fft.fftshift(np.fft.fft2(wave))) ** 2
+    beam_radius = alpha * size * pixel
+    phase, psi = st.dpc.ssb_ptycho(
+        data4D, step * pixel, 20, 300, (32, 32), beam_radius, chunk_size=50, workers=2
+    )
+    assert (
+        np.corrcoef(np.ravel(phase), np.ravel(phase_obj[::step, ::step]))[0, 1] > 0.95
+    )
+    # Chunking and threads don't change the sum
+    _, single_psi = st.dpc.ssb_ptycho(
+        data4D, step * pixel, 20, 300, (32, 32), beam_radius, chunk_size=5000
+    )
+    assert np.allclose(psi, single_psi)
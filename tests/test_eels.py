@@ -0,0 +1,154 @@
+import numpy as np
+import pytest
+import pywt
+import scipy.optimize as spo
+import scipy.signal as scisig
+import stemtool as st
+
+
+def loop_powerlaw_fit(xdata, ydata, xrange):
+    start_val = int((xrange[0] - np.amin(xdata)) / (np.median(np.diff(xdata))))
+    stop_val = int((xrange[1] - np.amin(xdata)) / (np.median(np.diff(xdata))))
+    xlog = np.log(xdata[start_val:stop_val][np.where(ydata[start_val:stop_val] > 0)])
+    ylog = np.log(ydata[start_val:stop_val][np.where(ydata[start_val:stop_val] > 0)])
+    power, const = np.polyfit(xlog, ylog, 1)
+    return np.exp(const) * (xdata ** power)
+
+
+def loop_eels_3D(eels_dict, fit_range, peak_range, LBA_radius=3):
+    fit_range = np.asarray(fit_range)
+    peak_range = np.asarray(peak_range)
+    no_elements = len(peak_range)
+    eels_array = eels_dict["data"]
+    elemental_subtracted = np.zeros(
+        (eels_array.shape[0], eels_array.shape[1], eels_array.shape[2], no_elements),
+        dtype=np.float64,
+    )
+    yy, xx = np.mgrid[0 : eels_array.shape[1], 0 : eels_array.shape[2]]
+    xdata = (np.arange(eels_array.shape[0]) - eels_dict["pixelOrigin"][0]) * eels_dict[
+        "pixelSize"
+    ][0]
+    peak_values = np.zeros(
+        (eels_array.shape[-2], eels_array.shape[-1], no_elements), dtype=np.float64
+    )
+    for ii in range(eels_array.shape[-2]):
+        for jj in range(eels_array.shape[-1]):
+            for qq in range(no_elements):
+                eels_data = eels_array[:, ii, jj]
+                fit_points = fit_range[qq, :]
+                peak_point = peak_range[qq, :]
+                lbi = ((yy - ii) ** 2) + ((xx - jj) ** 2) <= LBA_radius ** 2
+                eels_lbi = np.mean(eels_array[:, lbi], axis=-1)
+                bg = loop_powerlaw_fit(xdata, eels_lbi, fit_points)
+                subtracted_data = eels_data - bg
+                elemental_subtracted[:, ii, jj, qq] = subtracted_data
+                start_val = int(
+                    (peak_point[0] - np.amin(xdata)) / (np.median(np.diff(xdata)))
+                )
+                stop_val = int(
+                    (peak_point[1] - np.amin(xdata)) / (np.median(np.diff(xdata)))
+                )
+                peak_sum = np.sum(subtracted_data[start_val:stop_val])
+                peak_values[ii, jj, qq] = peak_sum
+    return peak_values, elemental_subtracted
+
+
+def test_eels_3D_matches_loop():
+    rng = np.random.default_rng(0)
+    energy = (np.arange(300) + 1000) * 0.5
+    amplitude = rng.uniform(1e5, 2e5, (12, 10))
+    power = rng.uniform(-3.2, -2.8, (12, 10))
+    data = amplitude[None] * (energy[:, None, None] ** power[None]) * 1e8
+    data += rng.normal(0, 0.5, data.shape)
+    data[200:, 5:, :] += 30
+    eels_dict = {"data": data, "pixelOrigin": [-1000], "pixelSize": [0.5]}
+    fit_range = [[560, 590], [600, 620]]
+    peak_range = [[600, 640], [630, 650]]
+    peaks, subtracted = st.eels.eels_3D(eels_dict, fit_range, peak_range, 3)
+    ref_peaks, ref_subtracted = loop_eels_3D(eels_dict, fit_range, peak_range, 3)
+    assert np.allclose(peaks, ref_peaks, rtol=1e-6, atol=1e-6)
+    assert np.allclose(subtracted, ref_subtracted, rtol=1e-6, atol=1e-6)
+
+
+def test_fit_lcpl_batch_matches_curve_fit():
+    rng = np.random.default_rng(1)
+    xdata = np.linspace(280, 300, 40)
+    consts = np.stack((rng.uniform(1e8, 2e8, 20), rng.uniform(1e6, 2e6, 20)), axis=1)
+    ydata = (consts[:, 0:1] * (xdata ** -3.5)) + (consts[:, 1:2] * (xdata ** -2))
+    ydata *= 1 + rng.normal(0, 0.01, ydata.shape)
+    lower = np.asarray((1e7, -3.5035, 1e5, -2.002))
+    upper = np.asarray((1e9, -3.4965, 1e7, -1.998))
+    initial = np.tile((1.5e8, -3.5, 1.5e6, -2), (20, 1))
+    popt = st.eels.fit_lcpl_batch(
+        xdata,
+        ydata,
+        initial,
+        np.broadcast_to(lower, initial.shape),
+        np.broadcast_to(upper, initial.shape),
+    )
+    for ii in range(20):
+        ref, _ = spo.curve_fit(
+            st.eels.lcpl,
+            xdata,
+            ydata[ii],
+            p0=initial[ii],
+            bounds=(lower, upper),
+            ftol=1e-10,
+            xtol=1e-10,
+            max_nfev=20000,
+        )
+        fitted = st.eels.lcpl(xdata, *popt[ii])
+        expected = st.eels.lcpl(xdata, *ref)
+        assert np.allclose(fitted, expected, rtol=1e-3)
+        assert np.sum((fitted - ydata[ii]) ** 2) <= 1.001 * np.sum(
+            (expected - ydata[ii]) ** 2
+        )
+
+
+def test_eels_3D_LCPL_edge_map():
+    rng = np.random.default_rng(0)
+    energy = (np.arange(300) + 1000) * 0.5
+    data = 1.5e13 * np.ones((300, 12, 10)) * (energy[:, None, None] ** -3)
+    data += rng.normal(0, 0.5, data.shape)
+    data[200:, 5:, :] += 30
+    eels_dict = {"data": data, "pixelOrigin": [-1000], "pixelSize": [0.5]}
+    peaks, subtracted = st.eels.eels_3D_LCPL(eels_dict, [560, 590], [600, 640], 1)
+    assert peaks.shape == (12, 10, 1)
+    assert subtracted.shape == (300, 12, 10, 1)
+    assert np.abs(subtracted[120:180]).max() < 5
+    assert np.abs(peaks[:5]).max() < 50
+    assert np.allclose(peaks[6:], 30 * 80, rtol=0.02)
+    par_peaks, par_subtracted = st.eels.eels_3D_LCPL(
+        eels_dict, [560, 590], [600, 640], 1, workers=2, chunk_size=32
+    )
+    assert np.array_equal(par_peaks, peaks)
+    assert np.array_equal(par_subtracted, subtracted)
+
+
+def loop_clean_wavelet(data, threshold):
+    max_level = pywt.dwt_max_level(len(data), pywt.Wavelet("sym4").dec_len)
+    coeffs = pywt.wavedec(data, "sym4", level=max_level)
+    for ii in range(1, len(coeffs)):
+        coeffs[ii] = pywt.threshold(coeffs[ii], threshold * np.amax(coeffs[ii]))
+    return pywt.waverec(coeffs, "sym4")[0 : len(data)]
+
+
+def test_cleanEELS_3D_matches_loop():
+    rng = np.random.default_rng(3)
+    energy = np.linspace(0, 1, 128)
+    data = np.exp(-(((energy - 0.5) / 0.1) ** 2))[:, None, None] * rng.uniform(
+        1, 2, (1, 9, 7)
+    )
+    data += rng.normal(0, 0.05, data.shape)
+    wavelet = st.eels.cleanEELS_3D(data, "wavelet", 0.2, chunk_size=4)
+    median = st.eels.cleanEELS_3D(data, "median", 5, chunk_size=4)
+    for ii in range(data.shape[1]):
+        for jj in range(data.shape[2]):
+            expected = loop_clean_wavelet(data[:, ii, jj], 0.2)
+            assert np.array_equal(wavelet[:, ii, jj], expected)
+            assert np.array_equal(median[:, ii, jj], scisig.medfilt(data[:, ii, jj], 5))
+    threaded = st.eels.cleanEELS_3D(data, "wavelet", 0.2, workers=2, chunk_size=2)
+    assert np.array_equal(threaded, wavelet)
+    assert st.eels.cleanEELS_3D(data, "median") is data
+    with pytest.raises(ValueError):
+        st.eels.cleanEELS_3D(data, "mean", 5)
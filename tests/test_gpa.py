@@ -0,0 +1,96 @@
+import matplotlib
+
+matplotlib.use("Agg")
+
+import os
+import numpy as np
+import stemtool as st
+
+
+def stretched_lattice(size=256, period=8, eps=0.02):
+    yy, xx = np.mgrid[0:size, 0:size].astype(np.float64)
+    ux = np.where(xx > (size / 2), eps * (xx - (size / 2)), 0)
+    return np.cos(2 * np.pi * (xx - ux) / period) + np.cos(2 * np.pi * yy / period)
+
+
+def test_tiled_gpa(tmp_path):
+    image = stretched_lattice()
+    gvecs = np.asarray([[0, 0.125], [0.125, 0]])
+    strain, refined = st.gpa.tiled_gpa(
+        image, gvecs, tile_size=128, overlap=32, ref_reg=(16, 112, 16, 112)
+    )
+    assert np.array_equal(gvecs, [[0, 0.125], [0.125, 0]])
+    assert np.allclose(refined, gvecs, atol=1e-4)
+    # The strain follows the sign convention of GPA.get_strain
+    assert np.isclose(np.median(strain[0, 32:224, 160:224]), -0.02, atol=2e-3)
+    assert np.isclose(np.median(strain[1, 32:224, 160:224]), 0, atol=2e-3)
+    assert np.isclose(np.median(strain[0, 32:224, 32:96]), 0, atol=2e-3)
+    # No seams between the tiles in the uniform regions
+    assert np.amax(np.abs(strain[0:2, 32:224, 32:96])) < 1e-3
+    assert np.amax(np.abs(strain[1, 32:224, 168:224])) < 1e-3
+    on_disk, _ = st.gpa.tiled_gpa(
+        image,
+        gvecs,
+        tile_size=128,
+        overlap=32,
+        ref_reg=(16, 112, 16, 112),
+        output=os.path.join(str(tmp_path), "strain.npy"),
+    )
+    assert isinstance(on_disk, np.memmap)
+    assert np.array_equal(on_disk, strain)
+
+
+def test_get_strain_uniform_stretch():
+    image = stretched_lattice(eps=0.02)
+    gpa = st.gpa.GPA(image, 1.0, "px")
+    gpa.auto_spots(circ_size=8)
+    gpa.define_reference((16, 16), (112, 16), (112, 240), (16, 240))
+    gpa.refine_phase()
+    e_xx, e_yy, e_th, e_dg = gpa.get_strain()
+    # The strain is a_matrix.grad(P) / 2pi, as it always was in
+    # stemtool, so a stretch along x gives a negative e_xx
+    assert np.isclose(np.median(e_xx[32:224, 160:224]), -0.02, atol=2e-3)
+    assert np.isclose(np.median(e_yy[32:224, 160:224]), 0, atol=2e-3)
+    assert np.isclose(np.median(e_xx[32:224, 32:96]), 0, atol=2e-3)
+    assert np.isclose(np.median(e_dg[32:224, 160:224]), 0, atol=2e-3)
+
+
+def test_gpa_series_memmap_slices(tmp_path):
+    eps = 0.004 * np.arange(6)
+    stack = np.asarray([stretched_lattice(128, 8, ee) for ee in eps])
+    filename = os.path.join(str(tmp_path), "movie.npy")
+    np.save(filename, stack)
+    movie = np.load(filename, mmap_mode="r")
+    gvecs = np.asarray([[0, 0.125], [0.125, 0]])
+    ref_reg = np.zeros((128, 128), dtype=bool)
+    ref_reg[16:112, 8:56] = True
+    in_memory, _ = st.gpa.gpa_series(stack[3:6], gvecs, ref_reg, circ_size=8)
+    e_xx = np.median(in_memory[:, 0, 16:112, 80:112], axis=(-2, -1))
+    assert np.allclose(e_xx, -eps[3:6], atol=2e-3)
+    # Slices of a memory mapped stack keep the offset of the whole
+    # file, so they must still give the frames they point to
+    for workers in (1, 2):
+        sliced, _ = st.gpa.gpa_series(
+            movie[3:6], gvecs, ref_reg, circ_size=8, workers=workers, chunk_size=2
+        )
+        assert np.allclose(sliced, in_memory)
+    strided, _ = st.gpa.gpa_series(movie[1::2], gvecs, ref_reg, circ_size=8)
+    assert np.allclose(
+        strided, st.gpa.gpa_series(stack[1::2], gvecs, ref_reg, circ_size=8)[0]
+    )
+
+
+def test_detect_gvecs():
+    yy, xx = np.mgrid[0:200, 0:200].astype(np.float64)
+    gvecs = np.asarray([[0.1113, 0.0217], [0, 0.1237], [0.0731, -0.0912]])
+    image = np.zeros((200, 200), dtype=np.float64)
+    for gvec, amplitude in zip(gvecs, (1, 0.7, 0.4)):
+        image += amplitude * np.cos(2 * np.pi * ((gvec[0] * yy) + (gvec[1] * xx)))
+    # Strongest first, to a fraction of a Fourier pixel
+    found = st.gpa.detect_gvecs(image, no_spots=3)
+    assert np.allclose(found, gvecs, atol=0.2 / 200)
+    gpa = st.gpa.GPA(image, 1.0, "px")
+    assert np.array_equal(gpa.auto_spots(circ_size=8, no_spots=3), found)
+    assert np.array_equal(gpa.gvec_1_ini, found[0])
+    assert np.array_equal(gpa.gvec_2_ini, found[1])
+    assert gpa.P_matrices_ini.shape == (3, 200, 200)
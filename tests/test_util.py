@@ -0,0 +1,187 @@
+import numpy as np
+import matplotlib.path as mpath
+import scipy.optimize as spo
+import stemtool as st
+
+
+def angle_sum_mask(imshape, A, B, C, D):
+    yy, xx = np.mgrid[0 : imshape[0], 0 : imshape[1]]
+    points = np.asarray((np.ravel(xx), np.ravel(yy))).transpose()
+    angsum = 0
+    corners = (A, B, C, D)
+    for ii in range(4):
+        pt_a = points - np.asarray(corners[ii])
+        pt_b = points - np.asarray(corners[(ii + 1) % 4])
+        angsum = angsum + np.arccos(
+            np.sum(pt_a * pt_b, axis=1)
+            / (
+                ((np.sum(pt_a ** 2, axis=1)) ** 0.5)
+                * ((np.sum(pt_b ** 2, axis=1)) ** 0.5)
+            )
+        )
+    return np.isclose(angsum / (2 * np.pi), 1).reshape(imshape)
+
+
+def test_polygon_mask():
+    corners = ((10.3, 12.7), (80.6, 20.2), (70.1, 90.4), (15.5, 61.3))
+    mask = st.util.polygon_mask((100, 120), corners)
+    assert np.array_equal(mask, angle_sum_mask((100, 120), *corners))
+    assert np.array_equal(mask, st.util.polygon_mask((100, 120), corners[::-1]))
+    concave = ((5.5, 5.5), (90.5, 10.2), (40.3, 40.7), (85.1, 90.6), (8.2, 70.4))
+    yy, xx = np.mgrid[0:100, 0:120]
+    inside = mpath.Path(concave).contains_points(
+        np.stack((np.ravel(xx), np.ravel(yy)), axis=1)
+    )
+    assert np.array_equal(
+        st.util.polygon_mask((100, 120), concave), inside.reshape((100, 120))
+    )
+
+
+def test_ellipse_mask():
+    yy, xx = np.mgrid[0:100, 0:120]
+    theta = np.deg2rad(30)
+    x_rot = ((xx - 60.2) * np.cos(theta)) + ((yy - 45.7) * np.sin(theta))
+    y_rot = ((yy - 45.7) * np.cos(theta)) - ((xx - 60.2) * np.sin(theta))
+    brute = ((x_rot / 30.5) ** 2) + ((y_rot / 12.3) ** 2) <= 1
+    assert np.array_equal(
+        st.util.ellipse_mask((100, 120), (60.2, 45.7), (30.5, 12.3), 30), brute
+    )
+
+
+def test_region_cache_is_bounded():
+    st.util.raster_polygon.cache_clear()
+    for ii in range(10):
+        st.util.polygon_mask((64, 64), ((ii, 0), (40, 5), (30, 50)))
+    assert st.util.raster_polygon.cache_info().currsize <= 4
+
+
+def gaussian_spots(shape, centers, sigma):
+    yy, xx = np.mgrid[0 : shape[0], 0 : shape[1]]
+    image = np.zeros(shape, dtype=np.float64)
+    for y0, x0 in centers:
+        image += np.exp(-(((yy - y0) ** 2) + ((xx - x0) ** 2)) / (2 * (sigma ** 2)))
+    return image
+
+
+def test_fit_gaussian2D_batch():
+    rng = np.random.default_rng(1)
+    centers = np.stack(
+        (np.repeat(np.arange(12, 64, 12), 4), np.tile(np.arange(12, 60, 12), 5)),
+        axis=1,
+    ) + rng.uniform(-1, 1, (20, 2))
+    image = gaussian_spots((72, 64), centers, 2) + rng.normal(0, 0.01, (72, 64))
+    radius = 5
+    guesses = np.round(centers)
+    yV, xV = np.mgrid[-radius : radius + 1, -radius : radius + 1]
+    yy = guesses[:, 0:1] + np.ravel(yV)[None, :]
+    xx = guesses[:, 1:2] + np.ravel(xV)[None, :]
+    zz = image[yy.astype(int), xx.astype(int)]
+    mask = (((yy - guesses[:, 0:1]) ** 2) + ((xx - guesses[:, 1:2]) ** 2)) < (
+        radius ** 2
+    )
+    z_min = np.amin(np.where(mask, zz, np.inf), axis=1, keepdims=True)
+    z_max = np.amax(np.where(mask, zz, -np.inf), axis=1, keepdims=True)
+    zz = np.where(mask, (zz - z_min) / (z_max - z_min), 0)
+    initial = st.util.initialize_gauss2D_batch(xx, yy, zz, mask)
+    lower = np.copy(initial)
+    upper = np.copy(initial)
+    lower[:, 0:2] -= radius
+    upper[:, 0:2] += radius
+    lower[:, 2] = -180
+    upper[:, 2] = 180
+    lower[:, 3:5] = 0
+    upper[:, 3:5] = 2.5 * radius
+    lower[:, 5] = (-2.5) * initial[:, 5]
+    upper[:, 5] = 2.5 * initial[:, 5]
+    popt = st.util.fit_gaussian2D_batch(xx, yy, zz, mask, initial, lower, upper)
+    single = np.asarray(
+        [
+            st.util.fit_gaussian2D_mask(image, guesses[ii, 1], guesses[ii, 0], radius)
+            for ii in range(len(centers))
+        ]
+    )
+    assert np.allclose(popt[:, 0:2], single[:, 0:2], atol=0.05)
+    assert np.allclose(popt[:, 0:2], np.flip(centers, axis=1), atol=0.05)
+
+    def cost(params):
+        model = st.util.gaussian_2D_function(
+            (xx, yy),
+            params[:, 0:1],
+            params[:, 1:2],
+            params[:, 2:3],
+            params[:, 3:4],
+            params[:, 4:5],
+            params[:, 5:6],
+        )
+        misfit = np.where(mask, zz - np.reshape(model, xx.shape), 0)
+        return np.sum(misfit ** 2, axis=1)
+
+    # Converged tightly, every batch fit is at least as good as the
+    # curve_fit one on the same normalized window
+    tight = st.util.fit_gaussian2D_batch(
+        xx, yy, zz, mask, initial, lower, upper, 1e-8, 1000
+    )
+    single[:, 5] = (single[:, 5] - z_min[:, 0]) / (z_max[:, 0] - z_min[:, 0])
+    assert np.all(cost(tight) <= ((1 + 1e-6) * cost(single)))
+
+
+def test_gaussian_jacobians():
+    yy, xx = np.mgrid[0:15, 0:17].astype(np.float64)
+    params = np.asarray((8.3, 6.9, 0.4, 2.1, 1.4, 1.7))
+    values, jacobian = st.util.gaussian_2D_fused((xx, yy), *params)
+    assert np.allclose(
+        np.ravel(values), st.util.gaussian_2D_function((xx, yy), *params)
+    )
+    for ii in range(6):
+        step = np.zeros(6)
+        step[ii] = 1e-6
+        numerical = (
+            st.util.gaussian_2D_function((xx, yy), *(params + step))
+            - st.util.gaussian_2D_function((xx, yy), *(params - step))
+        ) / 2e-6
+        assert np.allclose(jacobian[ii], np.reshape(numerical, xx.shape), atol=1e-6)
+    x_1D = np.linspace(0, 20, 41)
+    params_1D = np.asarray((9.2, 2.3, 1.6))
+    values, jacobian = st.util.gaussian_1D_fused(x_1D, *params_1D)
+    assert np.allclose(values, st.util.gaussian_1D_function(x_1D, *params_1D))
+    for ii in range(3):
+        step = np.zeros(3)
+        step[ii] = 1e-6
+        numerical = (
+            st.util.gaussian_1D_function(x_1D, *(params_1D + step))
+            - st.util.gaussian_1D_function(x_1D, *(params_1D - step))
+        ) / 2e-6
+        assert np.allclose(jacobian[ii], numerical, atol=1e-6)
+
+
+def test_fused_curve_fit():
+    rng = np.random.default_rng(3)
+    yy, xx = np.mgrid[0:21, 0:21].astype(np.float64)
+    xy = (np.ravel(xx), np.ravel(yy))
+    zz = st.util.gaussian_2D_function(xy, 10.4, 9.7, 0.3, 2.5, 1.8, 1.2)
+    zz = zz + rng.normal(0, 0.01, zz.shape)
+    start = (10, 10, 0, 2, 2, 1)
+    bounds = ((5, 5, -180, 0, 0, 0), (15, 15, 180, 10, 10, 3))
+    popt = st.util.fused_curve_fit(st.util.gaussian_2D_fused, xy, zz, start, bounds)
+    popt_ref, _ = spo.curve_fit(
+        st.util.gaussian_2D_function, xy, zz, start, bounds=bounds
+    )
+    # The rotation is only defined up to multiples of pi
+    assert np.allclose(popt[[0, 1, 3, 4, 5]], popt_ref[[0, 1, 3, 4, 5]], atol=1e-5)
+    assert np.isclose(np.cos(2 * (popt[2] - popt_ref[2])), 1)
+    assert np.allclose(popt[[0, 1, 3, 4, 5]], (10.4, 9.7, 2.5, 1.8, 1.2), atol=0.05)
+
+
+def test_dftregistration_subpixel():
+    rng = np.random.default_rng(0)
+    image = gaussian_spots((128, 128), rng.uniform(10, 118, (40, 2)), 3)
+    shift = (3.3, -1.7)
+    qy = np.fft.fftfreq(128)[:, None]
+    qx = np.fft.fftfreq(128)[None, :]
+    image_ft = np.fft.fft2(image)
+    shifted_ft = image_ft * np.exp(-2j * np.pi * ((qy * shift[0]) + (qx * shift[1])))
+    row_shift, col_shift, _, _, _ = st.util.dftregistration(
+        image_ft, shifted_ft, 100
+    )
+    assert np.isclose(row_shift, -shift[0], atol=0.02)
+    assert np.isclose(col_shift, -shift[1], atol=0.02)